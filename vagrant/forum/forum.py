@@ -4,10 +4,19 @@
 
 # The forumdb module is where the database interface code goes.
 import forumdb
+import ingest
+import metrics
+import pagecache
+import throttle
 
 # Other modules used to run a web server.
 import cgi
-from wsgiref.simple_server import make_server
+import email.utils
+import hashlib
+import itertools
+import time
+import urllib
+from wsgiref.handlers import format_date_time
 from wsgiref import util
 
 # HTML template for the forum page
@@ -24,6 +33,7 @@ HTML_WRAP = '''\
 		 margin: 10px 20%%; }
       hr.postbound { width: 50%%; }
       em.date { color: #999 }
+      div.older { text-align: center; }
     </style>
   </head>
   <body>
@@ -32,6 +42,9 @@ HTML_WRAP = '''\
       <div><textarea id="content" name="content"></textarea></div>
       <div><button id="go" type="submit">Post message</button></div>
     </form>
+    <form method=get action="/search">
+      <div><input name="q"> <button type="submit">Search</button></div>
+    </form>
     <!-- post content will go here -->
 %s
   </body>
@@ -43,48 +56,309 @@ POST = '''\
     <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
 '''
 
+# HTML template for the link to the next page of older posts
+OLDER = '''\
+    <div class=older><a href="/?before=%s">Older posts</a></div>
+'''
+
+# HTML template for the heading of the search results
+SEARCH = '''\
+    <h2>Posts matching &quot;%s&quot;</h2>
+'''
+
+# HTML template for a search with no results
+NO_RESULTS = '''\
+    <div class=older>No posts found.</div>
+'''
+
+# HTML template for a link to another page of search results
+SEARCH_PAGE = '''\
+    <div class=older><a href="/search?q=%s&amp;page=%d">%s</a></div>
+'''
+
+# Number of posts shown per page
+PAGE_SIZE = 50
+
+# Largest request body accepted by Post, and the size it is read in
+MAX_BODY_SIZE = 64 * 1024
+READ_SIZE = 8192
+
+# Number of search results shown per page, and the last page shown
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE = 50
+
+# Number of posts read from the database and sent at a time
+CHUNK_SIZE = 20
+
+# The parts of HTML_WRAP before and after the posts, sent separately
+(HEAD, FOOT) = (HTML_WRAP % '%s').split('%s')
+
+# Rendered pages, keyed by their 'before' cursor (None for the front page).
+# Only the front page changes when a post is added; older pages never do.
+CACHE = pagecache.PageCache()
+
+## New posts are saved in batches by a background thread.  Set
+# WRITER.synchronous to save each post before redirecting instead.
+def _PostsSaved(count):
+    # The front page shows the new posts; older pages are unchanged
+    CACHE.Invalidate(None)
+
+WRITER = ingest.PostWriter(on_commit=_PostsSaved)
+
+## Limits how fast each client may post, and drops repeated posts.  Set to
+# None to accept every post.
+THROTTLE = throttle.Throttle(throttle.MemoryStore())
+
+# Part of every ETag, so cached copies are dropped when the templates change
+TEMPLATE_TAG = hashlib.sha1(HTML_WRAP + POST + OLDER +
+                            str(PAGE_SIZE)).hexdigest()[:8]
+
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and the previously posted messages, a
+    page at a time.  The query string parameter 'before' selects the page of
+    posts older than the post with that cursor.
+
+    Cached pages are sent whole.  Otherwise the page is sent as it is read
+    from the database, CHUNK_SIZE posts at a time, and cached once complete.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
+    query = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    before = query.get('before', [None])[0]
+    if before is None:
+        # The front page is current while the newest post is the same, even
+        # if it was cached (or the post added) by another server process.
+        latest = forumdb.LatestPost()
+        version = latest and latest[0]
+        etag = '"%s-%s"' % (TEMPLATE_TAG, version)
+    else:
+        version = None
+        etag = '"%s-b%s"' % (TEMPLATE_TAG,
+                             hashlib.sha1(before).hexdigest()[:16])
+    page = CACHE.Get(before, version)
+    if page is None:
+        if _NotModified(env, etag, None):
+            return _SendNotModified(resp, etag, None)
+        # Read the first chunk before responding, to find the page's date and
+        # to answer 400 rather than a broken page for an invalid cursor
+        chunks = forumdb.IterPosts(PAGE_SIZE, before, CHUNK_SIZE)
+        try:
+            first = next(chunks, [])
+        except ValueError:
+            resp('400 Bad Request', [('Content-type', 'text/plain')])
+            return ['Bad Request: invalid page']
+        last_modified = None
+        if first:
+            last_modified = time.mktime(first[0]['datetime'].timetuple())
+        if _NotModified(env, etag, last_modified):
+            chunks.close()
+            return _SendNotModified(resp, etag, last_modified)
+        headers = [('Content-type', 'text/html'),
+                   ('ETag', etag),
+                   ('Cache-Control', 'no-cache')]
+        if last_modified is not None:
+            headers.append(('Last-Modified', format_date_time(last_modified)))
+        resp('200 OK', headers)
+        return _StreamPage(before, etag, last_modified, version, first, chunks)
+    if _NotModified(env, page.etag, page.last_modified):
+        return _SendNotModified(resp, page.etag, page.last_modified)
     # send results
-    headers = [('Content-type', 'text/html')]
+    headers = [('Content-type', 'text/html'),
+               ('Content-Length', str(len(page.body))),
+               ('ETag', page.etag),
+               ('Cache-Control', 'no-cache')]
+    if page.last_modified is not None:
+        headers.append(('Last-Modified', format_date_time(page.last_modified)))
     resp('200 OK', headers)
-    return [HTML_WRAP % ''.join(POST % p for p in posts)]
+    return [page.body]
+
+def _StreamPage(before, etag, last_modified, version, first, chunks):
+    '''Yields the page of posts older than the before cursor in chunks.
+
+    first is the first chunk of posts and chunks yields the rest.  The page
+    is cached once it has all been sent, unless it is too big to cache.
+    '''
+    parts = [HEAD]
+    size = len(HEAD)
+    yield HEAD
+    count = 0
+    last = None
+    try:
+        for posts in itertools.chain([first], chunks):
+            if not posts:
+                continue
+            html = ''.join(POST % p for p in posts)
+            count += len(posts)
+            last = posts[-1]
+            size += len(html)
+            if parts is not None:
+                parts.append(html)
+                if size > CACHE.max_bytes:
+                    parts = None
+            yield html
+    finally:
+        chunks.close()
+    html = FOOT
+    if count == PAGE_SIZE:
+        html = OLDER % urllib.quote(last['cursor']) + html
+    yield html
+    if parts is not None:
+        parts.append(html)
+        CACHE.Put(before, pagecache.Page(''.join(parts), etag, last_modified,
+                                         version))
+
+def _NotModified(env, etag, last_modified):
+    '''Checks the request's conditional headers against a page.'''
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return (if_none_match.strip() == '*' or
+                etag in [tag.strip() for tag in if_none_match.split(',')])
+    if_modified_since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since is not None:
+            return int(last_modified) <= email.utils.mktime_tz(since)
+    return False
+
+def _SendNotModified(resp, etag, last_modified):
+    headers = [('ETag', etag)]
+    if last_modified is not None:
+        headers.append(('Last-Modified', format_date_time(last_modified)))
+    resp('304 Not Modified', headers)
+    return []
+
+## Request handler for searching posts
+def Search(env, resp):
+    '''Search shows the posts matching the query string parameter 'q', best
+    matches first.
+
+    Results are shown SEARCH_PAGE_SIZE at a time; the parameter 'page'
+    selects a page, starting from 1.
+    '''
+    query = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    text = query.get('q', [''])[0].strip()
+    try:
+        page = int(query.get('page', ['1'])[0])
+    except ValueError:
+        page = 0
+    if not 1 <= page <= SEARCH_MAX_PAGE:
+        resp('400 Bad Request', [('Content-type', 'text/plain')])
+        return ['Bad Request: invalid page']
+    html = SEARCH % cgi.escape(text, quote=True)
+    posts = []
+    if text:
+        # Fetch one more post than is shown, to know if there is a next page
+        posts = forumdb.SearchPosts(text, SEARCH_PAGE_SIZE + 1,
+                                    (page - 1) * SEARCH_PAGE_SIZE)
+    html += ''.join(POST % p for p in posts[:SEARCH_PAGE_SIZE])
+    if not posts:
+        html += NO_RESULTS
+    quoted = urllib.quote_plus(text)
+    if page > 1:
+        html += SEARCH_PAGE % (quoted, page - 1, 'Better matches')
+    if len(posts) > SEARCH_PAGE_SIZE and page < SEARCH_MAX_PAGE:
+        html += SEARCH_PAGE % (quoted, page + 1, 'More results')
+    body = HTML_WRAP % html
+    resp('200 OK', [('Content-type', 'text/html'),
+                    ('Content-Length', str(len(body)))])
+    return [body]
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
     '''Post handles a submission of the forum's form.
   
-    The message the user posted is saved in the database, then it sends a 302
-    Redirect back to the main page so the user can see their new post.
+    The message the user posted is queued to be saved in the database, then
+    it sends a 302 Redirect back to the main page so the user can see their
+    new post.  A post repeating one made shortly before is dropped.  If the
+    client is posting too fast it sends a 429 instead, and if too many posts
+    are waiting to be saved a 503.
     '''
     # Get post content
-    input = env['wsgi.input']
-    length = int(env.get('CONTENT_LENGTH', 0))
+    try:
+        length = int(env.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        resp('400 Bad Request', [('Content-type', 'text/plain')])
+        return ['Bad Request: invalid Content-Length']
+    if length > MAX_BODY_SIZE:
+        # Refuse before reading any of it
+        resp('413 Request Entity Too Large', [('Content-type', 'text/plain')])
+        return ['Request Entity Too Large: posts are limited to %d bytes'
+                % MAX_BODY_SIZE]
     # If length is zero, post is empty - don't save it.
     if length > 0:
-        postdata = input.read(length)
-        fields = cgi.parse_qs(postdata)
-        content = fields['content'][0]
+        postdata = _ReadBody(env['wsgi.input'], length)
+        if postdata is None:
+            resp('400 Bad Request', [('Content-type', 'text/plain')])
+            return ['Bad Request: incomplete request body']
+        content = _FormField(postdata, 'content') or ''
         # If the post is just whitespace, don't save it.
         content = content.strip()
+        client = env.get('REMOTE_ADDR', '')
+        checked = THROTTLE if content else None
+        if checked is not None:
+            refused = checked.Check(client, content)
+            if refused == throttle.RATE_LIMITED:
+                resp('429 Too Many Requests',
+                     [('Content-type', 'text/plain'),
+                      ('Retry-After', str(checked.RetryAfter()))])
+                return ['Too Many Requests: please wait before posting again']
+            if refused == throttle.DUPLICATE:
+                content = None
         if content:
-            # Save it in the database
-            forumdb.AddPost(content)
+            # Save it in the database.  If it is not saved, the client may
+            # send it again without it being counted as a repeat.
+            try:
+                WRITER.Submit(content)
+            except ingest.Busy:
+                if checked is not None:
+                    checked.Release(client, content)
+                resp('503 Service Unavailable',
+                     [('Content-type', 'text/plain'), ('Retry-After', '1')])
+                return ['Service Unavailable: too many posts, try again']
+            except Exception:
+                if checked is not None:
+                    checked.Release(client, content)
+                raise
     # 302 redirect back to the main page
     headers = [('Location', '/'),
                ('Content-type', 'text/plain')]
     resp('302 REDIRECT', headers) 
     return ['Redirecting']
 
+def _ReadBody(input, length):
+    '''Reads a request body of length bytes, READ_SIZE at a time.
+
+    Returns:
+      The body, or None if the client sent less than length bytes.
+    '''
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        chunk = input.read(min(remaining, READ_SIZE))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
+
+def _FormField(body, name):
+    '''Returns the first value of a field of a urlencoded form, or None.
+
+    Only the value asked for is decoded; the rest of the form is skipped.
+    '''
+    prefix = name + '='
+    for field in body.split('&'):
+        if field.startswith(prefix):
+            return urllib.unquote_plus(field[len(prefix):])
+    return None
+
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -99,9 +373,60 @@ def Dispatcher(env, resp):
         resp(status, headers)    
         return ['Not Found: ' + page]
 
+## The application served: the Dispatcher, with its metrics at /metrics
+METRICS = metrics.MetricsMiddleware(Dispatcher, DISPATCH)
 
-# Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
-
+if __name__ == '__main__':
+    import argparse
+    import server
+    parser = argparse.ArgumentParser(description='Run the DB Forum server.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of pre-forked worker processes')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='request threads per worker process')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='listen backlog')
+    parser.add_argument('--keepalive', type=float, default=5,
+                        help='seconds to keep idle connections open')
+    parser.add_argument('--post-batch', type=int, default=WRITER.batch_size,
+                        help='most posts saved per transaction')
+    parser.add_argument('--post-flush', type=float,
+                        default=WRITER.flush_interval,
+                        help='seconds to wait for more posts to batch')
+    parser.add_argument('--sync-posts', action='store_true',
+                        help='save each post before redirecting')
+    parser.add_argument('--post-rate', type=float, default=THROTTLE.rate,
+                        help='posts a second each client may make')
+    parser.add_argument('--post-burst', type=int, default=THROTTLE.burst,
+                        help='posts each client may make at once')
+    parser.add_argument('--duplicate-seconds', type=float,
+                        default=THROTTLE.duplicate_seconds,
+                        help='seconds a repeated post is dropped for')
+    parser.add_argument('--redis',
+                        help='share the post limits between workers in the '
+                             'Redis server at this URL, like '
+                             'redis://localhost:6379/0')
+    parser.add_argument('--no-throttle', action='store_true',
+                        help='accept every post')
+    parser.add_argument('--max-body', type=int, default=MAX_BODY_SIZE,
+                        help='largest post request body, in bytes')
+    args = parser.parse_args()
+    if not args.no_throttle and not args.post_rate > 0:
+        parser.error('--post-rate must be positive')
+    WRITER.batch_size = args.post_batch
+    WRITER.flush_interval = args.post_flush
+    WRITER.synchronous = args.sync_posts
+    MAX_BODY_SIZE = args.max_body
+    if args.no_throttle:
+        THROTTLE = None
+    else:
+        if args.redis:
+            THROTTLE.store = throttle.RedisStore(args.redis)
+        THROTTLE.rate = args.post_rate
+        THROTTLE.burst = args.post_burst
+        THROTTLE.duplicate_seconds = args.duplicate_seconds
+    # Run this bad server only on localhost!
+    print "Serving HTTP on port %d..." % args.port
+    server.serve(METRICS, '', args.port, args.workers, args.threads,
+                 args.backlog, args.keepalive, cleanup=WRITER.Close)
@@ -1,5 +1,10 @@
-
 CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     id SERIAL );
+                     id SERIAL PRIMARY KEY,
+                     search TSVECTOR );
+
+-- Pages of posts are read newest first, starting after a (time, id) cursor
+CREATE INDEX posts_time ON posts (time DESC, id DESC);
 
+-- Full-text search; the search column is set from content by AddPost()
+CREATE INDEX posts_search ON posts USING GIN (search);
@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+#
+# Test cases for forum.py
+# These tests call the forum's WSGI application directly.  They need the
+# forum database, and add posts to it.
+#
+
+import httplib
+import logging
+import threading
+import time
+import urllib
+from StringIO import StringIO
+from wsgiref import util
+
+import forum
+import forumdb
+import ingest
+import loadtest
+import pagecache
+import server
+import throttle
+
+class CountingInput(object):
+    """A request body that records how much of it was read."""
+
+    def __init__(self, body):
+        self.body = StringIO(body)
+        self.read_sizes = []
+
+    def read(self, size=-1):
+        self.read_sizes.append(size)
+        return self.body.read(size)
+
+def request(path, query='', method='GET', body='', length=None, headers={},
+            input=None):
+    """Calls the forum application and returns (status, headers, body)."""
+    env = {'REQUEST_METHOD': method,
+           'PATH_INFO': path,
+           'QUERY_STRING': query,
+           'CONTENT_LENGTH': str(len(body) if length is None else length),
+           'wsgi.input': input or StringIO(body)}
+    env.update(headers)
+    util.setup_testing_defaults(env)
+    response = {}
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict(response_headers)
+    result = forum.METRICS(env, start_response)
+    try:
+        content = ''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return (response['status'], response['headers'], content)
+
+def post(content, **kwargs):
+    return request('/post', method='POST',
+                   body=urllib.urlencode({'content': content}), **kwargs)
+
+class ListHandler(logging.Handler):
+    """
+    Logging handler that keeps the records it receives.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class QuietRequestHandler(server.KeepAliveRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def setUp():
+    forum.WRITER.synchronous = True
+    forum.THROTTLE = None
+    forum.CACHE.Clear()
+
+def testPost():
+    """
+    Test that posts are saved and shown on the front page.
+    """
+    setUp()
+    content = "Hello and welcome %s" % time.time()
+    (status, headers, body) = post(content)
+    if not status.startswith('302'):
+        raise ValueError("Post should redirect. Got {s}".format(s=status))
+    print "1. A post is accepted with a redirect."
+    posts = forumdb.GetPosts(1)
+    if posts[0]['content'] != content:
+        raise ValueError("The post content should be decoded and saved. "
+                         "Got {c!r}".format(c=posts[0]['content']))
+    print "2. The post content is decoded and saved."
+    (status, headers, body) = request('/')
+    if content not in body:
+        raise ValueError("The new post should be on the front page.")
+    print "3. The front page shows the new post."
+
+def testPaging():
+    """
+    Test that pages of posts follow each other without gaps or repeats.
+    """
+    setUp()
+    for i in range(forum.PAGE_SIZE + 1):
+        post("Paging %d %s" % (i, time.time()))
+    (status, headers, body) = request('/')
+    if 'before=' not in body:
+        raise ValueError("A full page should link to older posts.")
+    first = forumdb.GetPosts(3)
+    second = forumdb.GetPosts(3, first[-1]['cursor'])
+    if [p['id'] for p in first + second] != \
+            [p['id'] for p in forumdb.GetPosts(6)]:
+        raise ValueError("The next page should start right after the last "
+                         "post of the previous one.")
+    print "4. Pages link to older posts and follow each other."
+    (status, headers, body) = request('/', 'before=nonsense')
+    if not status.startswith('400'):
+        raise ValueError("An invalid page cursor should get 400.")
+    print "5. An invalid page cursor is refused with 400."
+
+def testPageCache():
+    """
+    Test that pages are cached until a post is added, and that unchanged
+    pages get 304.
+    """
+    setUp()
+    request('/')
+    hits = forum.CACHE.hits
+    (status, headers, body) = request('/')
+    if forum.CACHE.hits != hits + 1:
+        raise ValueError("The front page should be served from the cache.")
+    content = "Cached %s" % time.time()
+    post(content)
+    if content not in request('/')[2]:
+        raise ValueError("A new post should replace the cached front page.")
+    print "6. Pages are cached until a post is added."
+    (status, headers, body) = request('/')
+    (status, h, again) = request('/', headers={
+        'HTTP_IF_NONE_MATCH': headers['ETag']})
+    if not status.startswith('304') or again:
+        raise ValueError("A matching ETag should get 304. "
+                         "Got {s}".format(s=status))
+    (status, h, again) = request('/', headers={
+        'HTTP_IF_MODIFIED_SINCE': headers['Last-Modified']})
+    if not status.startswith('304'):
+        raise ValueError("An unmodified page should get 304. "
+                         "Got {s}".format(s=status))
+    print "7. Unchanged pages get 304."
+    cache = pagecache.PageCache(max_pages=2)
+    for key in ('a', 'b'):
+        cache.Put(key, pagecache.Page(key, None, None, None))
+    cache.Get('a')
+    cache.Put('c', pagecache.Page('c', None, None, None))
+    if cache.Get('b') is not None or cache.Get('a') is None:
+        raise ValueError("The least recently used page should be evicted.")
+    print "8. The least recently used pages are evicted."
+
+def testServer():
+    """
+    Test that the thread pool server keeps connections alive and stops
+    gracefully.
+    """
+    setUp()
+    # Cache the front page; streamed pages have no length and close the
+    # connection
+    request('/')
+    httpd = server.ThreadPoolWSGIServer(('localhost', 0), threads=2,
+                                        handler=QuietRequestHandler)
+    httpd.set_app(forum.Dispatcher)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+        conn = httplib.HTTPConnection('localhost', httpd.server_port)
+        statuses = []
+        for i in range(3):
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            response.read()
+            statuses.append(response.status)
+            if response.getheader('Connection') == 'close':
+                raise ValueError("The connection should be kept alive.")
+        conn.close()
+        if statuses != [200] * 3:
+            raise ValueError("Every request should be served. "
+                             "Got {s}".format(s=statuses))
+        print "9. Requests on one connection are served with keep-alive."
+    finally:
+        httpd.Stop()
+        thread.join()
+    if any(worker.is_alive() for worker in httpd._threads):
+        raise ValueError("Stop() should wait for the request threads.")
+    print "10. The server stops its threads gracefully."
+
+def testWriter():
+    """
+    Test that queued posts are saved in batches, and that a full queue is
+    refused.
+    """
+    setUp()
+    committed = []
+    writer = ingest.PostWriter(batch_size=3, flush_interval=0.01,
+                               on_commit=committed.append)
+    contents = ["Queued %d %s" % (i, time.time()) for i in range(5)]
+    for content in contents:
+        writer.Submit(content)
+    writer.Close()
+    saved = [p['content'] for p in forumdb.GetPosts(5)]
+    if sorted(saved) != sorted(contents) or sum(committed) != 5:
+        raise ValueError("Every queued post should be saved when the writer "
+                         "is closed.")
+    if max(committed) > 3:
+        raise ValueError("No batch should be larger than batch_size. "
+                         "Got {c}".format(c=committed))
+    print "11. Queued posts are saved in batches."
+    writer = ingest.PostWriter(max_queue=1, submit_timeout=0.01)
+    # Hold the queue full without a writer thread to empty it
+    writer._EnsureThread = lambda: None
+    writer.Submit("Full %s" % time.time())
+    try:
+        writer.Submit("Refused %s" % time.time())
+    except ingest.Busy:
+        pass
+    else:
+        raise ValueError("A full queue should raise Busy.")
+    print "12. A full queue is refused with Busy."
+    writer = ingest.PostWriter(synchronous=True)
+    try:
+        writer.Submit("Invalid \x00 %s" % time.time())
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A post that cannot be saved synchronously should "
+                         "raise.")
+    committed = []
+    writer = ingest.PostWriter(retry_delay=0.001, on_commit=committed.append)
+    contents = ["Kept %s" % time.time(), "Lost \x00", "Also kept"]
+    handler = ListHandler()
+    ingest.log.addHandler(handler)
+    try:
+        for content in contents:
+            writer.Submit(content)
+        writer.Close()
+    finally:
+        ingest.log.removeHandler(handler)
+    if not any(r.levelno == logging.ERROR for r in handler.records):
+        raise ValueError("A lost post should be logged as an error.")
+    saved = [p['content'] for p in forumdb.GetPosts(2)]
+    if sorted(saved) != sorted(contents[::2]) or writer.failed != 1 or \
+            sum(committed) != 2:
+        raise ValueError("The rest of a failed batch should be saved and "
+                         "the lost post counted.")
+    print "13. Posts that cannot be saved are reported, not dropped silently."
+    def Fail(count):
+        raise RuntimeError("on_commit failed")
+    writer = ingest.PostWriter(flush_interval=0.01, on_commit=Fail)
+    handler = ListHandler()
+    ingest.log.addHandler(handler)
+    try:
+        writer.Submit("Before %s" % time.time())
+        time.sleep(0.1)
+        if not writer._thread.is_alive():
+            raise ValueError("An error in on_commit should not stop the "
+                             "writer thread.")
+        # Stop the writer thread behind its back
+        writer._queue.put(None)
+        writer._thread.join()
+        content = "After %s" % time.time()
+        writer.Submit(content)
+        writer.Close()
+    finally:
+        ingest.log.removeHandler(handler)
+    if forumdb.GetPosts(1)[0]['content'] != content:
+        raise ValueError("A post should be saved after on_commit failed and "
+                         "the writer thread stopped.")
+    print "14. The writer thread survives errors and is restarted if stopped."
+
+def testStreaming():
+    """
+    Test that uncached pages are streamed in chunks and cached once sent.
+    """
+    setUp()
+    for i in range(forum.CHUNK_SIZE + 1):
+        post("Streamed %d %s" % (i, time.time()))
+    forum.CACHE.Clear()
+    response = {}
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = status
+    env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'QUERY_STRING': ''}
+    util.setup_testing_defaults(env)
+    result = forum.View(env, start_response)
+    chunks = list(result)
+    if len(chunks) < 4:
+        raise ValueError("An uncached page should be sent in chunks. "
+                         "Got {n}".format(n=len(chunks)))
+    print "15. Uncached pages are sent a chunk of posts at a time."
+    page = forum.CACHE.Get(None, forumdb.LatestPost()[0])
+    if page is None or page.body != ''.join(chunks):
+        raise ValueError("The streamed page should be cached once sent.")
+    print "16. A streamed page is cached once it has been sent."
+
+def testSearch():
+    """
+    Test that posts are found by search, best matches first.
+    """
+    setUp()
+    word = "quokka%d" % int(time.time() * 1000)
+    post("A %s" % word)
+    post("%s %s %s" % (word, word, word))
+    (status, headers, body) = request('/search', urllib.urlencode(
+        {'q': word}))
+    if body.count('class=post') != 2:
+        raise ValueError("Search should find both posts.")
+    if body.index('%s %s' % (word, word)) > body.index('A %s' % word):
+        raise ValueError("The best match should be shown first.")
+    print "17. Search finds posts, best matches first."
+    (status, headers, body) = request('/search', 'q=%3Cb%3E')
+    if '<b>' in body:
+        raise ValueError("The search text should be escaped.")
+    (status, headers, body) = request('/search', 'q=x&page=0')
+    if not status.startswith('400'):
+        raise ValueError("An invalid search page should get 400.")
+    print "18. The search text is escaped and the page is checked."
+
+def testLoadTest():
+    """
+    Test that the load test sends requests and reports on each route.
+    """
+    setUp()
+    clients = [loadtest.InProcessClient(forum.Dispatcher) for i in range(2)]
+    (results, elapsed) = loadtest.Run(clients, 10, 40, 0.5, 1)
+    summary = loadtest.Summarize(results, elapsed)
+    if sorted(summary) != [loadtest.POST, loadtest.VIEW] or \
+            sum(r['requests'] for r in summary.values()) != 40:
+        raise ValueError("Both routes should be measured. "
+                         "Got {s}".format(s=summary))
+    if any(r['errors'] for r in summary.values()):
+        raise ValueError("No request should fail. "
+                         "Got {s}".format(s=results.statuses))
+    print "19. The load test measures views and posts."
+    slower = dict((route, dict(r, p50_ms=r['p50_ms'] * 2))
+                  for (route, r) in summary.items())
+    if loadtest.Compare(summary, summary, 1.25) or \
+            len(loadtest.Compare(slower, summary, 1.25)) != 2:
+        raise ValueError("Only slower routes should be regressions.")
+    print "20. Routes slower than the baseline are reported."
+    results = loadtest.Results()
+    results.Record(loadtest.VIEW, 0.5, 200)
+    results.Record(loadtest.VIEW, 0.001, 500)
+    results.Record(loadtest.POST, 0.001, None)
+    summary = loadtest.Summarize(results, 1.0)
+    view = summary[loadtest.VIEW]
+    if (view['requests'], view['errors'], view['p50_ms'],
+            view['requests_per_s']) != (2, 1, 500.0, 1.0) or \
+            summary[loadtest.POST]['p50_ms'] is not None:
+        raise ValueError("Failed requests should be counted apart from the "
+                         "latencies. Got {s}".format(s=summary))
+    print "33. Failed requests are kept out of the load test latencies."
+
+def testMetrics():
+    """
+    Test that requests are counted at /metrics.
+    """
+    setUp()
+    request('/')
+    request('/nowhere')
+    (status, headers, body) = request('/metrics')
+    if 'forum_requests_total{route="View",status="200"}' not in body:
+        raise ValueError("Requests should be counted by route and status.")
+    if 'forum_requests_total{route="other",status="404"}' not in body:
+        raise ValueError("Unknown paths should be counted as 'other'.")
+    if 'forum_db_seconds_count{route="View"}' not in body:
+        raise ValueError("Database time should be recorded.")
+    print "21. Requests are counted and timed at /metrics."
+
+def testThrottle():
+    """
+    Test that fast and repeated posts are refused.
+    """
+    setUp()
+    forum.THROTTLE = throttle.Throttle(throttle.MemoryStore(), rate=0.01,
+                                       burst=2, duplicate_seconds=60)
+    try:
+        content = "Repeated %s" % time.time()
+        post(content)
+        post(content)
+        saved = [p for p in forumdb.GetPosts(2) if p['content'] == content]
+        if len(saved) != 1:
+            raise ValueError("A repeated post should be dropped.")
+        print "22. A repeated post is dropped."
+        (status, headers, body) = post("One too many %s" % time.time())
+        if not status.startswith('429') or 'Retry-After' not in headers:
+            raise ValueError("A client posting too fast should get 429. "
+                             "Got {s}".format(s=status))
+        (status, headers, body) = post("Other client %s" % time.time(),
+                                       headers={'REMOTE_ADDR': '10.0.0.2'})
+        if not status.startswith('302'):
+            raise ValueError("Clients should be limited separately.")
+        print "23. Clients posting too fast are refused with 429."
+    finally:
+        forum.THROTTLE = None
+
+def testThrottleRetry():
+    """
+    Test that a post refused with 503 can be sent again.
+    """
+    setUp()
+    forum.THROTTLE = throttle.Throttle(throttle.MemoryStore(), rate=0.01,
+                                       burst=1, duplicate_seconds=60)
+    writer = forum.WRITER
+    # A writer whose queue stays full
+    forum.WRITER = ingest.PostWriter(max_queue=1, submit_timeout=0.01)
+    forum.WRITER._EnsureThread = lambda: None
+    forum.WRITER.Submit("Full %s" % time.time())
+    try:
+        content = "Retried %s" % time.time()
+        (status, headers, body) = post(content)
+        if not status.startswith('503'):
+            raise ValueError("A post should get 503 while the queue is full. "
+                             "Got {s}".format(s=status))
+        forum.WRITER = writer
+        (status, headers, body) = post(content)
+        if not status.startswith('302') or \
+                forumdb.GetPosts(1)[0]['content'] != content:
+            raise ValueError("A post retried after 503 should be saved. "
+                             "Got {s}".format(s=status))
+        print "29. A post retried after 503 is saved."
+    finally:
+        forum.WRITER = writer
+        forum.THROTTLE = None
+
+def testThrottleRate():
+    """
+    Test that a throttle without a positive rate is refused.
+    """
+    for rate in (0, -1):
+        try:
+            throttle.Throttle(throttle.MemoryStore(), rate=rate)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("A rate of {r} should be refused.".format(r=rate))
+    checked = throttle.Throttle(throttle.MemoryStore())
+    try:
+        checked.rate = 0
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Changing the rate to 0 should be refused.")
+    print "30. A throttle without a positive rate is refused."
+
+def testConnectionPool():
+    """
+    Test that a thread waits for a connection when all are in use, and that
+    the servers size the pool for their threads.
+    """
+    pool = forumdb._ConnectionPool(forumdb.DSN, 1, 5)
+    first = pool.GetConn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.GetConn()))
+    waiter.start()
+    time.sleep(0.1)
+    if got:
+        raise ValueError("A full pool should make threads wait.")
+    pool.PutConn(first)
+    waiter.join()
+    if got != [first]:
+        raise ValueError("A waiting thread should get the returned "
+                         "connection.")
+    pool.timeout = 0.05
+    try:
+        pool.GetConn()
+    except forumdb.PoolError:
+        pass
+    else:
+        raise ValueError("A full pool should time out.")
+    pool.PutConn(first, close=True)
+    print "31. Threads wait for a connection when all are in use."
+    httpd = server.ThreadPoolWSGIServer(('localhost', 0),
+                                        threads=forumdb.POOL_SIZE + 4,
+                                        handler=QuietRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    try:
+        if forumdb.POOL_SIZE < len(httpd._threads) + 1:
+            raise ValueError("The pool should have a connection for every "
+                             "request thread and the post writer.")
+    finally:
+        httpd.Stop()
+        thread.join()
+    print "32. The servers size the pool for their threads."
+
+def testPostFields():
+    """
+    Test that only the content field is used, and that empty posts are not
+    saved.
+    """
+    setUp()
+    latest = forumdb.LatestPost()
+    for body in ('', 'content=', 'content=+++%20', 'other=text'):
+        (status, headers, content) = request('/post', method='POST',
+                                             body=body)
+        if not status.startswith('302'):
+            raise ValueError("An empty post should redirect. Got {s} for "
+                             "{b!r}".format(s=status, b=body))
+    if forumdb.LatestPost() != latest:
+        raise ValueError("Empty posts should not be saved.")
+    print "24. Empty and blank posts are not saved."
+    content = "Field test %s" % time.time()
+    request('/post', method='POST',
+            body='before=1&content=%s&content=second&after=2'
+                 % urllib.quote_plus(content))
+    if forumdb.GetPosts(1)[0]['content'] != content:
+        raise ValueError("The first content field should be saved.")
+    print "25. Other form fields are ignored."
+
+def testBodyLimits():
+    """
+    Test that oversized and truncated bodies are refused.
+    """
+    setUp()
+    input = CountingInput('content=' + 'x' * forum.MAX_BODY_SIZE)
+    (status, headers, body) = request('/post', method='POST', input=input,
+                                      length=forum.MAX_BODY_SIZE + 9)
+    if not status.startswith('413'):
+        raise ValueError("An oversized post should be refused with 413. "
+                         "Got {s}".format(s=status))
+    if input.read_sizes:
+        raise ValueError("An oversized body should not be read.")
+    print "26. An oversized post is refused with 413 without reading it."
+    body = 'content=' + 'y' * forum.MAX_BODY_SIZE
+    body = body[:forum.MAX_BODY_SIZE]
+    input = CountingInput(body)
+    (status, headers, content) = request('/post', method='POST', input=input,
+                                         length=len(body))
+    if not status.startswith('302'):
+        raise ValueError("A post of the largest size should be accepted. "
+                         "Got {s}".format(s=status))
+    if max(input.read_sizes) > forum.READ_SIZE:
+        raise ValueError("The body should be read in chunks of at most "
+                         "READ_SIZE bytes.")
+    print "27. A post of the largest size is read in bounded chunks."
+    latest = forumdb.LatestPost()
+    (status, headers, content) = request('/post', method='POST',
+                                         body='content=truncated',
+                                         length=100)
+    if not status.startswith('400'):
+        raise ValueError("A truncated post should be refused with 400. "
+                         "Got {s}".format(s=status))
+    (status, headers, content) = request('/post', method='POST',
+                                         body='content=bad', length='ten')
+    if not status.startswith('400'):
+        raise ValueError("An invalid Content-Length should be refused with "
+                         "400. Got {s}".format(s=status))
+    if forumdb.LatestPost() != latest:
+        raise ValueError("Refused posts should not be saved.")
+    print "28. Truncated posts and invalid lengths are refused with 400."
+
+
+if __name__ == '__main__':
+    testPost()
+    testPaging()
+    testPageCache()
+    testServer()
+    testWriter()
+    testStreaming()
+    testSearch()
+    testLoadTest()
+    testMetrics()
+    testThrottle()
+    testPostFields()
+    testBodyLimits()
+    testThrottleRetry()
+    testThrottleRate()
+    testConnectionPool()
+    forum.WRITER.Close()
+    print "Success!  All tests pass!"
@@ -1,24 +1,298 @@
 #
 # Database access functions for the web forum.
-# 
+#
 
+import contextlib
+import os
+import threading
 import time
 
+import psycopg2
+import psycopg2.extensions
+
 ## Database connection
-DB = []
+DSN = "dbname=forum"
+
+# Connections the pool shared by the request handlers may open, at least;
+# the servers in server.py raise it to fit their threads (see SizePool()).
+# A thread needing a connection while all are in use waits for one to be
+# returned for up to POOL_TIMEOUT seconds.
+POOL_SIZE = 10
+POOL_TIMEOUT = 30
+
+# Text search configuration used to index and search posts
+SEARCH_CONFIG = 'english'
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Time spent and statements run in the database by each thread
+_db_time = threading.local()
+
+class _TimedCursor(psycopg2.extensions.cursor):
+    '''A cursor that adds the time taken by its calls to the thread's
+    database time.'''
+
+    def execute(self, query, vars=None):
+        start = time.time()
+        try:
+            return super(_TimedCursor, self).execute(query, vars)
+        finally:
+            _AddDBTime(time.time() - start, 1)
+
+    def fetchone(self):
+        start = time.time()
+        try:
+            return super(_TimedCursor, self).fetchone()
+        finally:
+            _AddDBTime(time.time() - start, 0)
+
+    def fetchmany(self, size=None):
+        start = time.time()
+        try:
+            if size is None:
+                return super(_TimedCursor, self).fetchmany()
+            return super(_TimedCursor, self).fetchmany(size)
+        finally:
+            _AddDBTime(time.time() - start, 0)
+
+    def fetchall(self):
+        start = time.time()
+        try:
+            return super(_TimedCursor, self).fetchall()
+        finally:
+            _AddDBTime(time.time() - start, 0)
+
+def _AddDBTime(seconds, statements):
+    _db_time.seconds = getattr(_db_time, 'seconds', 0.0) + seconds
+    _db_time.statements = getattr(_db_time, 'statements', 0) + statements
+
+def DBTime():
+    '''Returns the database time of the calling thread so far.
+
+    Returns:
+      A (seconds, statements) tuple: the total time spent in statements and
+      fetching their rows, and the number of statements run, by this thread.
+      Subtract two calls' results to measure the time taken in between.
+    '''
+    return (getattr(_db_time, 'seconds', 0.0),
+            getattr(_db_time, 'statements', 0))
+
+class PoolError(Exception):
+    '''Raised when no database connection is free in time.'''
+    pass
+
+class _ConnectionPool(object):
+    '''Database connections shared by threads.
+
+    Connections are opened as they are needed, up to size, and then kept
+    open for reuse.  A thread asking for one while all are in use waits
+    for one to be returned, for up to timeout seconds.
+    '''
+
+    def __init__(self, dsn, size, timeout):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._opened = 0
+
+    def GetConn(self):
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while not self._idle and self._opened >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError('No database connection was free within '
+                                    '%s seconds' % self.timeout)
+                self._cond.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            # Take the slot now, and connect without holding the lock
+            self._opened += 1
+        try:
+            return psycopg2.connect(self.dsn)
+        except Exception:
+            self._Release()
+            raise
+
+    def PutConn(self, conn, close=False):
+        '''Returns a connection, closing it instead if close is true or it
+        is broken.'''
+        if close or conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+            self._Release()
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def Resize(self, size):
+        with self._cond:
+            self.size = size
+            self._cond.notify_all()
+
+    def _Release(self):
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+def _GetPool():
+    '''Returns the connection pool of this process, creating it on first use.
+
+    Worker processes forked from a server each create their own pool rather
+    than sharing their parent's connections.
+    '''
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = _ConnectionPool(DSN, POOL_SIZE, POOL_TIMEOUT)
+                _pool_pid = os.getpid()
+    return _pool
+
+def SizePool(threads):
+    '''Makes room in the connection pool for threads request threads and
+    the post writer, so none of them has to wait for a connection.'''
+    global POOL_SIZE
+    with _pool_lock:
+        POOL_SIZE = max(POOL_SIZE, threads + 1)
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.Resize(POOL_SIZE)
+
+@contextlib.contextmanager
+def _Cursor(commit=False, name=None):
+    '''Yields a cursor on a pooled connection.
+
+    The transaction is committed at the end of the block if commit is true,
+    and rolled back otherwise or if the block raises.  If a name is given
+    the cursor is a server-side cursor, which fetches rows as they are
+    needed rather than all at once.
+    '''
+    pool = _GetPool()
+    conn = pool.GetConn()
+    try:
+        cursor = conn.cursor(name, cursor_factory=_TimedCursor)
+        try:
+            yield cursor
+            if commit:
+                start = time.time()
+                conn.commit()
+                _AddDBTime(time.time() - start, 0)
+        finally:
+            if not conn.closed:
+                conn.rollback()
+    finally:
+        pool.PutConn(conn, close=bool(conn.closed))
+
+def _Post(row):
+    '''Converts a (content, time, id) row to a post dictionary.'''
+    return {'content': str(row[0]), 'time': str(row[1]), 'id': row[2],
+            'datetime': row[1],
+            'cursor': '%s_%d' % (row[1].isoformat(), row[2])}
+
+def _PostsQuery(limit, before):
+    '''Returns the query and parameters selecting a page of posts.'''
+    if before is None:
+        query = '''SELECT content, time, id FROM posts
+                   ORDER BY time DESC, id DESC LIMIT %s'''
+        return (query, (limit,))
+    (before_time, sep, before_id) = before.rpartition('_')
+    try:
+        before_id = int(before_id)
+    except ValueError:
+        raise ValueError('Invalid post cursor: %r' % before)
+    query = '''SELECT content, time, id FROM posts
+               WHERE (time, id) < (%s::timestamp, %s)
+               ORDER BY time DESC, id DESC LIMIT %s'''
+    return (query, (before_time, before_id, limit))
 
 ## Get posts from database.
+def GetPosts(limit, before=None):
+    '''Get a page of posts from the database, sorted with the newest first.
+
+    Pages are found with an index range scan on (time, id), so fetching a
+    page costs the same no matter how many posts there are.
+
+    Args:
+      limit: The maximum number of posts to return.
+      before: The 'cursor' of the last post of the previous page, to get the
+        posts older than it; or None to get the newest posts.
+
+    Returns:
+      A list of dictionaries, where each dictionary has a 'content' key
+      pointing to the post content, a 'time' key pointing to the time
+      it was posted (and 'datetime', the same as a datetime), an 'id' key
+      and a 'cursor' key to pass as `before` to get the posts that follow
+      it.
+
+    Raises:
+      ValueError: if `before` is not a valid cursor.
+    '''
+    (query, params) = _PostsQuery(limit, before)
+    with _Cursor() as cursor:
+        try:
+            cursor.execute(query, params)
+        except psycopg2.DataError:
+            raise ValueError('Invalid post cursor: %r' % before)
+        return [_Post(row) for row in cursor.fetchall()]
+
+def IterPosts(limit, before=None, chunk_size=20):
+    '''Get a page of posts a chunk at a time, sorted with the newest first.
+
+    The posts are read from a server-side cursor, so at most chunk_size of
+    them are held in memory at once.  A pooled connection stays checked out
+    until the generator is exhausted or closed.
+
+    Args:
+      limit, before: as for GetPosts().
+      chunk_size: The number of posts fetched at a time.
+
+    Yields:
+      Lists of at most chunk_size posts, in the same format as GetPosts().
+
+    Raises:
+      ValueError: if `before` is not a valid cursor.
+    '''
+    (query, params) = _PostsQuery(limit, before)
+    with _Cursor(name='posts') as cursor:
+        try:
+            cursor.execute(query, params)
+        except psycopg2.DataError:
+            raise ValueError('Invalid post cursor: %r' % before)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield [_Post(row) for row in rows]
+
+def LatestPost():
+    '''Get the id and time of the newest post.
+
+    Returns:
+      An (id, time) tuple, where time is a datetime; or None if there are no
+      posts.
+    '''
+    with _Cursor() as cursor:
+        cursor.execute('''SELECT id, time FROM posts
+                          ORDER BY time DESC, id DESC LIMIT 1''')
+        return cursor.fetchone()
+
 def GetAllPosts():
     '''Get all the posts from the database, sorted with the newest first.
 
     Returns:
-      A list of dictionaries, where each dictionary has a 'content' key
-      pointing to the post content, and 'time' key pointing to the time
-      it was posted.
+      A list of dictionaries, in the same format as GetPosts().
     '''
-    posts = [{'content': str(row[1]), 'time': str(row[0])} for row in DB]
-    posts.sort(key=lambda row: row['time'], reverse=True)
-    return posts
+    with _Cursor() as cursor:
+        cursor.execute('''SELECT content, time, id FROM posts
+                          ORDER BY time DESC, id DESC''')
+        return [_Post(row) for row in cursor.fetchall()]
 
 ## Add a post to the database.
 def AddPost(content):
@@ -27,5 +301,47 @@ def AddPost(content):
     Args:
       content: The text content of the new post.
     '''
-    t = time.strftime('%c', time.localtime())
-    DB.append((t, content))
+    with _Cursor(commit=True) as cursor:
+        cursor.execute('''INSERT INTO posts (content, search)
+                          VALUES (%s, to_tsvector(%s, %s))''',
+                       (content, SEARCH_CONFIG, content))
+
+def AddPosts(contents):
+    '''Add several new posts to the database in one transaction.
+
+    Args:
+      contents: A list of the text contents of the new posts.
+    '''
+    if not contents:
+        return
+    with _Cursor(commit=True) as cursor:
+        values = ','.join(cursor.mogrify('(%s, to_tsvector(%s, %s))',
+                                         (content, SEARCH_CONFIG, content))
+                          for content in contents)
+        cursor.execute('INSERT INTO posts (content, search) VALUES ' + values)
+
+## Search posts in the database.
+def SearchPosts(text, limit, offset=0):
+    '''Find the posts matching a search, the best matches first.
+
+    Posts are matched on all the words of the search, using the GIN index on
+    their search column, and ranked by how often and closely the words occur.
+    Posts that rank the same are sorted with the newest first.
+
+    Args:
+      text: The words to search for.
+      limit: The maximum number of posts to return.
+      offset: The number of matching posts to skip.
+
+    Returns:
+      A list of dictionaries in the same format as GetPosts().
+    '''
+    with _Cursor() as cursor:
+        cursor.execute('''SELECT content, time, id
+                          FROM posts, plainto_tsquery(%s, %s) AS query
+                          WHERE search @@ query
+                          ORDER BY ts_rank(search, query) DESC,
+                                   time DESC, id DESC
+                          LIMIT %s OFFSET %s''',
+                       (SEARCH_CONFIG, text, limit, offset))
+        return [_Post(row) for row in cursor.fetchall()]
@@ -0,0 +1,192 @@
+#
+# Batched, asynchronous saving of new forum posts.
+#
+
+import logging
+import os
+import Queue
+import threading
+import time
+
+import forumdb
+
+log = logging.getLogger('forum.ingest')
+
+class Busy(Exception):
+    '''Raised when a post cannot be queued because the queue is full.'''
+    pass
+
+class PostWriter(object):
+    '''Saves posts from a background thread, many per transaction.
+
+    Submit() queues a post and returns at once.  A writer thread commits
+    queued posts in batches of up to batch_size, waiting at most
+    flush_interval seconds after the first post of a batch for more to
+    arrive.  When max_queue posts are waiting, Submit() blocks for up to
+    submit_timeout seconds and then raises Busy.
+
+    With synchronous=True, Submit() saves each post itself before
+    returning, as forumdb.AddPost() would, and raises if it cannot.
+
+    A batch that cannot be saved is tried again up to max_retries times,
+    waiting retry_delay seconds and then twice as long each time.  If it
+    still fails its posts are saved one at a time, and the posts that
+    cannot be saved are logged as errors and counted in `failed`.
+
+    on_commit, if given, is called with the number of posts after every
+    successful commit.
+    '''
+
+    def __init__(self, batch_size=100, flush_interval=0.05, max_queue=10000,
+                 submit_timeout=1.0, synchronous=False, on_commit=None,
+                 max_retries=3, retry_delay=0.1):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.submit_timeout = submit_timeout
+        self.synchronous = synchronous
+        self.on_commit = on_commit
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.failed = 0
+        self._queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+
+    def Submit(self, content):
+        '''Queues a post to be saved.
+
+        Raises:
+          Busy: if the queue stayed full for submit_timeout seconds.
+          Whatever forumdb.AddPosts() raises, if synchronous and the post
+          could not be saved.
+        '''
+        if self.synchronous:
+            forumdb.AddPosts([content])
+            self._Committed(1)
+            return
+        self._EnsureThread()
+        try:
+            self._queue.put(content, True, self.submit_timeout)
+        except Queue.Full:
+            raise Busy('Too many posts waiting to be saved')
+
+    def Close(self):
+        '''Saves every queued post and stops the writer thread.'''
+        with self._lock:
+            running = (self._thread is not None and
+                       self._thread_pid == os.getpid())
+            if running and not self._thread.is_alive():
+                # Start a writer again to save what is still queued
+                self._StartThread()
+            thread = self._thread
+            self._thread = None
+        if running:
+            self._queue.put(None)
+            thread.join()
+
+    def _EnsureThread(self):
+        # Threads do not survive fork(), so each process starts its own
+        if not self._Running():
+            with self._lock:
+                if not self._Running():
+                    self._StartThread()
+
+    def _Running(self):
+        return (self._thread is not None and
+                self._thread_pid == os.getpid() and
+                self._thread.is_alive())
+
+    def _StartThread(self):
+        # The caller holds self._lock
+        self._thread = threading.Thread(target=self._Run,
+                                        name='forum-post-writer')
+        self._thread.daemon = True
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _Run(self):
+        while True:
+            content = self._queue.get()
+            if content is None:
+                return
+            batch = [content]
+            deadline = time.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        content = self._queue.get(True, remaining)
+                    else:
+                        content = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if content is None:
+                    stop = True
+                    break
+                batch.append(content)
+            self._SaveSafely(batch)
+            if stop:
+                # Drain anything queued behind the stop marker
+                rest = []
+                while True:
+                    try:
+                        content = self._queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if content is not None:
+                        rest.append(content)
+                if rest:
+                    self._SaveSafely(rest)
+                return
+
+    def _SaveSafely(self, batch):
+        # An error must not stop the writer thread, or nothing more would
+        # be saved
+        try:
+            self._Save(batch)
+        except Exception:
+            self.failed += len(batch)
+            log.exception('Could not save a batch of %d posts', len(batch))
+
+    def _Save(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                forumdb.AddPosts(batch)
+            except Exception:
+                if attempt == self.max_retries:
+                    break
+                log.warning('Could not save a batch of %d posts, trying '
+                            'again in %.2fs', len(batch), delay,
+                            exc_info=True)
+                time.sleep(delay)
+                delay *= 2
+            else:
+                self._Committed(len(batch))
+                return
+        # Save the posts one by one so one bad post does not lose the rest
+        # of the batch
+        lost = 0
+        for content in batch:
+            try:
+                forumdb.AddPosts([content])
+            except Exception:
+                log.exception('Could not save a post of %d characters',
+                              len(content))
+                lost += 1
+            else:
+                self._Committed(1)
+        if lost:
+            self.failed += lost
+            log.error('%d of a batch of %d posts were not saved', lost,
+                      len(batch))
+
+    def _Committed(self, count):
+        if self.on_commit is not None:
+            try:
+                self.on_commit(count)
+            except Exception:
+                log.exception('on_commit failed after saving %d posts',
+                              count)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# Load test for the DB Forum.
+#
+# Usage:
+#   python loadtest.py [--mode inprocess|socket] [--url http://host:port]
+#                      [--concurrency 8] [--duration 10] [--write-ratio 0.1]
+#                      [--output results.json] [--baseline previous.json]
+#
+# Clients in several threads send a mix of front page views and new posts
+# to the forum, either by calling its WSGI application directly (inprocess) or
+# over HTTP to a server started on a local port (socket), or to the server
+# at --url.  Error rates, and the rate and latency percentiles of the
+# successful requests, are reported for each route.  Results are written as JSON; given a baseline
+# from an earlier run, routes whose median latency got worse than the
+# tolerance are reported and the exit status is 1.
+#
+# The clients, and in socket mode the server started for them, share one
+# Python process, so at high concurrency they compete for the interpreter
+# lock; test a server started separately with --url to measure it alone.
+# Posts made by the load test are saved in the forum database.
+#
+
+import argparse
+import httplib
+import json
+import logging
+import platform
+import random
+import sys
+import threading
+import time
+import urllib
+import urlparse
+from StringIO import StringIO
+from wsgiref import util
+
+import forum
+import forumdb
+import server
+
+# Names of the routes measured
+VIEW = 'View'
+POST = 'Post'
+
+class Results(object):
+    '''The latencies of the successful requests, and the number of failed
+    ones, recorded for each route.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {VIEW: [], POST: []}
+        self.errors = {VIEW: 0, POST: 0}
+        self.statuses = {}
+
+    def Record(self, route, seconds, status):
+        '''Records a request; status is the HTTP status code, or None if the
+        request failed without a response.'''
+        with self._lock:
+            key = '%s %s' % (route, status or 'failed')
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            # A failure can be much faster or slower than a real response,
+            # so it is kept out of the latencies
+            if status is None or status >= 400:
+                self.errors[route] += 1
+            else:
+                self.timings[route].append(seconds)
+
+def Percentile(sorted_values, fraction):
+    '''Returns the value below which `fraction` of sorted_values fall.'''
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+## Clients
+
+class InProcessClient(object):
+    '''Sends requests by calling the WSGI application directly.'''
+
+    def __init__(self, app):
+        self.app = app
+
+    def Request(self, method, path, body=''):
+        '''Sends a request and reads the whole response.
+
+        Returns:
+          The HTTP status code.
+        '''
+        (path, sep, query) = path.partition('?')
+        env = {'REQUEST_METHOD': method,
+               'PATH_INFO': path,
+               'QUERY_STRING': query,
+               'CONTENT_LENGTH': str(len(body)),
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'wsgi.input': StringIO(body)}
+        util.setup_testing_defaults(env)
+        response = {}
+        def StartResponse(status, headers, exc_info=None):
+            response['status'] = status
+        result = self.app(env, StartResponse)
+        try:
+            for chunk in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return int(response['status'].split()[0])
+
+    def Close(self):
+        pass
+
+class HTTPClient(object):
+    '''Sends requests over one HTTP connection, reconnecting whenever the
+    server closes it.'''
+
+    def __init__(self, host, port):
+        self.connection = httplib.HTTPConnection(host, port, timeout=30)
+
+    def Request(self, method, path, body=''):
+        '''Sends a request and reads the whole response.
+
+        Returns:
+          The HTTP status code.
+        '''
+        headers = {}
+        if method == 'POST':
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.connection.request(method, path, body or None, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except Exception:
+            self.connection.close()
+            raise
+        return response.status
+
+    def Close(self):
+        self.connection.close()
+
+class QuietRequestHandler(server.KeepAliveRequestHandler):
+    '''Does not log each request.'''
+
+    def log_message(self, *args):
+        pass
+
+## Load generation
+
+def RunClient(client, results, deadline, requests, lock, write_ratio, rng):
+    '''Sends requests until the deadline or until `requests` is used up.
+
+    requests is a one-item list shared by all clients and guarded by lock,
+    holding the number of requests left to send, or None for no limit.
+    '''
+    while time.time() < deadline:
+        if requests[0] is not None:
+            with lock:
+                if requests[0] <= 0:
+                    return
+                requests[0] -= 1
+        if rng.random() < write_ratio:
+            route = POST
+            body = urllib.urlencode(
+                {'content': 'Load test post %d' % rng.randint(0, 10 ** 9)})
+            args = ('POST', '/post', body)
+        else:
+            route = VIEW
+            args = ('GET', '/')
+        start = time.time()
+        try:
+            status = client.Request(*args)
+        except Exception:
+            status = None
+        results.Record(route, time.time() - start, status)
+
+def Run(clients, duration, requests, write_ratio, seed):
+    '''Runs one client per thread and waits for them to finish.
+
+    Returns:
+      (results, elapsed seconds)
+    '''
+    results = Results()
+    deadline = time.time() + duration
+    remaining = [requests]
+    lock = threading.Lock()
+    threads = []
+    start = time.time()
+    for (i, client) in enumerate(clients):
+        thread = threading.Thread(
+            target=RunClient,
+            args=(client, results, deadline, remaining, lock, write_ratio,
+                  random.Random(seed + i)))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    for client in clients:
+        client.Close()
+    return (results, elapsed)
+
+def Summarize(results, elapsed):
+    '''Returns a dictionary of measurements for each route.
+
+    requests counts every request and requests_per_s only the successful
+    ones; the latencies are of the successful requests, and None if there
+    were none.
+    '''
+    summary = {}
+    for (route, timings) in sorted(results.timings.items()):
+        errors = results.errors[route]
+        count = len(timings) + errors
+        if not count:
+            continue
+        timings = sorted(timings)
+        result = summary[route] = {
+            'requests': count,
+            'errors': errors,
+            'error_rate': float(errors) / count,
+            'requests_per_s': len(timings) / elapsed if elapsed else None,
+            'mean_ms': None,
+            'p50_ms': None,
+            'p90_ms': None,
+            'p99_ms': None,
+            'max_ms': None,
+        }
+        if timings:
+            result.update({
+                'mean_ms': 1000.0 * sum(timings) / len(timings),
+                'p50_ms': 1000.0 * Percentile(timings, 0.50),
+                'p90_ms': 1000.0 * Percentile(timings, 0.90),
+                'p99_ms': 1000.0 * Percentile(timings, 0.99),
+                'max_ms': 1000.0 * timings[-1],
+            })
+    return summary
+
+def _Ms(value):
+    '''Formats a latency for the results table.'''
+    if value is None:
+        return '%9s' % '-'
+    return '%9.2f' % value
+
+def Compare(summary, baseline, tolerance):
+    '''Returns (route, ratio) for each route whose median latency grew by
+    more than `tolerance` times compared to the baseline.'''
+    regressions = []
+    for (route, result) in sorted(summary.items()):
+        before = baseline.get(route)
+        if not before or not before['p50_ms'] or result['p50_ms'] is None:
+            continue
+        ratio = result['p50_ms'] / before['p50_ms']
+        if ratio > tolerance:
+            regressions.append((route, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the DB Forum.')
+    parser.add_argument('--mode', choices=('inprocess', 'socket'),
+                        default='inprocess',
+                        help='call the WSGI application directly, or send '
+                             'HTTP requests to a server on a local socket')
+    parser.add_argument('--url',
+                        help='with --mode socket, the address of a running '
+                             'server to test instead of starting one')
+    parser.add_argument('--server-threads', type=int, default=8,
+                        help='request threads of the server started for '
+                             '--mode socket')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run for (default: %(default)s)')
+    parser.add_argument('--requests', type=int,
+                        help='stop after this many requests in total')
+    parser.add_argument('--write-ratio', type=float, default=0.1,
+                        help='fraction of requests that are posts')
+    parser.add_argument('--sync-posts', action='store_true',
+                        help='save each post before responding')
+    parser.add_argument('--throttle', action='store_true',
+                        help="keep the forum's post rate limits, which "
+                             'refuse most posts from a single test machine')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='allowed median latency ratio to the baseline')
+    args = parser.parse_args(argv)
+
+    # Report the errors of the post writer, which runs in this process
+    logging.basicConfig()
+    forum.WRITER.synchronous = args.sync_posts
+    if not args.throttle:
+        forum.THROTTLE = None
+    httpd = None
+    if args.mode == 'inprocess':
+        clients = [InProcessClient(forum.METRICS)
+                   for i in range(args.concurrency)]
+        # Each client calls the application in its own thread, like the
+        # request threads of a server (which size the pool themselves)
+        forumdb.SizePool(args.concurrency)
+    else:
+        if args.url:
+            address = urlparse.urlparse(args.url)
+            (host, port) = (address.hostname, address.port or 80)
+        else:
+            httpd = server.ThreadPoolWSGIServer(
+                ('localhost', 0), args.server_threads,
+                handler=QuietRequestHandler)
+            httpd.set_app(forum.METRICS)
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.daemon = True
+            thread.start()
+            (host, port) = httpd.server_address[:2]
+        clients = [HTTPClient(host, port) for i in range(args.concurrency)]
+
+    try:
+        (results, elapsed) = Run(clients, args.duration, args.requests,
+                                 args.write_ratio, args.seed)
+    finally:
+        if httpd is not None:
+            httpd.Stop()
+        forum.WRITER.Close()
+    summary = Summarize(results, elapsed)
+
+    print '%-6s %9s %8s %9s %9s %9s %9s %9s' % (
+        'route', 'requests', 'errors', 'ok req/s', 'p50 (ms)', 'p90 (ms)',
+        'p99 (ms)', 'max (ms)')
+    for (route, result) in sorted(summary.items()):
+        print '%-6s %9d %7.1f%% %9.1f %s %s %s %s' % (
+            route, result['requests'], 100 * result['error_rate'],
+            result['requests_per_s'] or 0, _Ms(result['p50_ms']),
+            _Ms(result['p90_ms']), _Ms(result['p99_ms']),
+            _Ms(result['max_ms']))
+    total = sum(result['requests'] for result in summary.values())
+    errors = sum(result['errors'] for result in summary.values())
+    print 'total: %d requests (%d failed) in %.1fs, %.1f ok req/s' % (
+        total, errors, elapsed, (total - errors) / elapsed if elapsed else 0)
+    for (key, count) in sorted(results.statuses.items()):
+        print '  %s: %d' % (key, count)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'mode': args.mode,
+            'url': args.url,
+            'server_threads': args.server_threads,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'elapsed': elapsed,
+            'write_ratio': args.write_ratio,
+            'sync_posts': args.sync_posts,
+            'throttle': args.throttle,
+            'seed': args.seed,
+        },
+        'results': summary,
+        'statuses': results.statuses,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = Compare(summary, baseline, args.tolerance)
+        for (route, ratio) in regressions:
+            print 'REGRESSION: %s median latency is %.2fx the baseline' % (
+                route, ratio)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
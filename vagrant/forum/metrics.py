@@ -0,0 +1,207 @@
+#
+# Request metrics for the forum.
+#
+# MetricsMiddleware wraps a WSGI application and records, per route, the
+# number of requests by status code, the time taken to handle them and the
+# part of it spent in the database, and the bytes sent.  The metrics are
+# served in the Prometheus text format at /metrics.
+#
+# Each server process keeps its own metrics, so with pre-forked workers
+# /metrics shows the worker that answered it.
+#
+# Counter and Histogram are the same as in tournament/instrument.py, and
+# loadtest.py's Percentile() and Compare() as in tournament_bench.py; the
+# two projects share no package.
+#
+
+import bisect
+import threading
+import time
+
+import forumdb
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Route name for paths that are not one of the application's routes
+OTHER = 'other'
+
+class Counter(object):
+    '''A count per set of label values.'''
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+
+    def Inc(self, key, amount=1):
+        '''Adds to the count for a tuple of label values.  The caller holds
+        the middleware's lock.'''
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def Render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help_text))
+        lines.append('# TYPE %s counter' % self.name)
+        for (key, value) in sorted(self._values.items()):
+            lines.append('%s{%s} %s' % (self.name, _Labels(self.labels, key),
+                                        value))
+
+class Histogram(object):
+    '''Observation counts per set of label values, in latency buckets.'''
+
+    def __init__(self, name, help_text, labels, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+
+    def Observe(self, key, value):
+        '''Records a value for a tuple of label values.  The caller holds
+        the middleware's lock.'''
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    def Render(self, lines):
+        name = self.name
+        lines.append('# HELP %s %s' % (name, self.help_text))
+        lines.append('# TYPE %s histogram' % name)
+        for (key, (counts, count, total)) in sorted(self._values.items()):
+            labels = _Labels(self.labels, key)
+            running = 0
+            for (bound, bucket_count) in zip(self.buckets, counts):
+                running += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %s'
+                             % (name, labels, bound, running))
+            lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, count))
+            lines.append('%s_sum{%s} %s' % (name, labels, total))
+            lines.append('%s_count{%s} %s' % (name, labels, count))
+
+def _Labels(names, values):
+    return ','.join('%s="%s"' % (name, value)
+                    for (name, value) in zip(names, values))
+
+class MetricsMiddleware(object):
+    '''WSGI middleware recording request metrics for an application.
+
+    Args:
+      app: the WSGI application.
+      routes: a dictionary of the first path components the application
+        handles to their handler functions, like forum.DISPATCH.  Requests
+        are counted under the name of their handler, or 'other'.
+      path: the path the metrics are served at.
+    '''
+
+    def __init__(self, app, routes, path='/metrics'):
+        self.app = app
+        self.routes = dict((component, handler.__name__)
+                           for (component, handler) in routes.items())
+        self.path = path
+        self._lock = threading.Lock()
+        self.requests = Counter('forum_requests_total',
+                                'Requests handled, by route and status.',
+                                ('route', 'status'))
+        self.request_seconds = Histogram(
+            'forum_request_seconds',
+            'Time taken to handle and send a response, by route.',
+            ('route',))
+        self.db_seconds = Histogram(
+            'forum_db_seconds',
+            'Time spent in the database per request, by route.',
+            ('route',))
+        self.db_statements = Counter(
+            'forum_db_statements_total',
+            'Database statements run, by route.', ('route',))
+        self.response_bytes = Counter(
+            'forum_response_bytes_total',
+            'Response body bytes sent, by route.', ('route',))
+
+    def __call__(self, env, resp):
+        path = env.get('PATH_INFO', '')
+        if path == self.path:
+            return self._Serve(resp)
+        route = self.routes.get(path.lstrip('/').split('/', 1)[0], OTHER)
+        request = _Request(self, route)
+        def StartResponse(status, headers, exc_info=None):
+            request.status = status.split(' ', 1)[0]
+            return resp(status, headers, exc_info)
+        try:
+            result = self.app(env, StartResponse)
+        except Exception:
+            request.status = '500'
+            request.Finish()
+            raise
+        return _MeteredResponse(result, request)
+
+    def Record(self, route, status, seconds, db_seconds, statements,
+               size):
+        '''Records a finished request.'''
+        with self._lock:
+            self.requests.Inc((route, status))
+            self.request_seconds.Observe((route,), seconds)
+            self.db_seconds.Observe((route,), db_seconds)
+            self.db_statements.Inc((route,), statements)
+            self.response_bytes.Inc((route,), size)
+
+    def Render(self):
+        '''Returns the metrics in the Prometheus text format.'''
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.request_seconds,
+                           self.db_seconds, self.db_statements,
+                           self.response_bytes):
+                metric.Render(lines)
+        return '\n'.join(lines) + '\n'
+
+    def _Serve(self, resp):
+        body = self.Render()
+        resp('200 OK', [('Content-type', 'text/plain; version=0.0.4'),
+                        ('Content-Length', str(len(body)))])
+        return [body]
+
+class _Request(object):
+    '''The measurements of a request in progress.'''
+
+    def __init__(self, middleware, route):
+        self.middleware = middleware
+        self.route = route
+        self.status = None
+        self.size = 0
+        self.start = time.time()
+        self.db_start = forumdb.DBTime()
+
+    def Finish(self):
+        (db_seconds, statements) = forumdb.DBTime()
+        self.middleware.Record(self.route, self.status or '500',
+                               time.time() - self.start,
+                               db_seconds - self.db_start[0],
+                               statements - self.db_start[1], self.size)
+
+class _MeteredResponse(object):
+    '''Counts the bytes of a response as they are sent, and records the
+    request when the server closes the response.'''
+
+    def __init__(self, result, request):
+        self.result = result
+        self.request = request
+
+    def __iter__(self):
+        request = self.request
+        for chunk in self.result:
+            request.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.request.Finish()
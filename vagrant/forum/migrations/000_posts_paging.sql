@@ -0,0 +1,23 @@
+-- Adds the primary key on posts.id and the index that pages of posts are
+-- read through, as in forum.sql, to a posts table created without them.
+-- Tables that already have them are left as they are.
+--
+-- Run with: psql forum -f migrations/000_posts_paging.sql
+--
+-- Run it before migrations/001_posts_search.sql.  Adding the primary key
+-- fails if two posts have the same id.
+
+\set ON_ERROR_STOP on
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'posts'::regclass AND contype = 'p') THEN
+        ALTER TABLE posts ADD PRIMARY KEY (id);
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS posts_time ON posts (time DESC, id DESC);
+
+ANALYZE posts;
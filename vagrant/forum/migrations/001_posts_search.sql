@@ -0,0 +1,10 @@
+-- Adds the full-text search column and index to an existing posts table, as
+-- in forum.sql, and fills it in for the posts already there.
+--
+-- Run with: psql forum -f migrations/001_posts_search.sql
+
+ALTER TABLE posts ADD COLUMN search TSVECTOR;
+
+UPDATE posts SET search = to_tsvector('english', content);
+
+CREATE INDEX posts_search ON posts USING GIN (search);
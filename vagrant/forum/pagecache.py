@@ -0,0 +1,78 @@
+#
+# Cache of rendered forum pages.
+#
+
+import collections
+import threading
+
+## A rendered page, ready to be sent.
+# body: the encoded page.
+# etag: the page's entity tag, including the quotes.
+# last_modified: the time of the newest post on the page, in seconds since
+#   the epoch, or None if the page has no posts.
+# version: what the page was rendered from; a cached page is only served
+#   while its version is current.
+Page = collections.namedtuple('Page',
+                              'body etag last_modified version')
+
+class PageCache(object):
+    '''A thread-safe least-recently-used cache of rendered pages.
+
+    The cache holds at most max_pages pages and max_bytes bytes of page
+    bodies; the least recently used pages are evicted to stay within both.
+    '''
+
+    def __init__(self, max_pages=256, max_bytes=16 * 1024 * 1024):
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pages = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def Get(self, key, version=None):
+        '''Returns the cached page for key if its version matches, or None.'''
+        with self._lock:
+            page = self._pages.pop(key, None)
+            if page is None or page.version != version:
+                if page is not None:
+                    self._bytes -= len(page.body)
+                self.misses += 1
+                return None
+            # Re-insert to mark it as the most recently used
+            self._pages[key] = page
+            self.hits += 1
+            return page
+
+    def Put(self, key, page):
+        '''Caches a page, evicting others as needed.
+
+        Pages larger than max_bytes are not cached.
+        '''
+        size = len(page.body)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            self._pages[key] = page
+            self._bytes += size
+            while (len(self._pages) > self.max_pages or
+                   self._bytes > self.max_bytes):
+                (evicted_key, evicted) = self._pages.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def Invalidate(self, key):
+        '''Drops the cached page for key, if any.'''
+        with self._lock:
+            page = self._pages.pop(key, None)
+            if page is not None:
+                self._bytes -= len(page.body)
+
+    def Clear(self):
+        '''Drops every cached page.'''
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
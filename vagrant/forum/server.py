@@ -0,0 +1,232 @@
+#
+# Production-style WSGI servers for the forum, built on wsgiref.
+#
+# serve() runs a WSGI application with a pool of threads, optionally in
+# several pre-forked worker processes sharing one listening socket, with
+# HTTP/1.1 keep-alive and graceful shutdown on SIGTERM or SIGINT.
+#
+
+import os
+import Queue
+import signal
+import socket
+import threading
+import time
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, \
+    ServerHandler
+
+import forumdb
+
+## Handlers
+
+class KeepAliveServerHandler(ServerHandler):
+    '''Sends HTTP/1.1 responses, keeping the connection open when the
+    response length is known.'''
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request = self.request_handler
+        if 'Content-Length' not in self.headers:
+            # Without a length the body can only end by closing
+            request.close_connection = True
+        if request.close_connection:
+            self.headers['Connection'] = 'close'
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    '''Handles requests on a connection until the client closes it, asks to
+    close it, or it is idle for the server's keepalive timeout.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    # Buffer each response and send it as soon as it is written.  Sending
+    # the headers in several small unbuffered writes makes a keep-alive
+    # client wait for a delayed ACK on every request.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.keepalive or None
+        WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+            while not self.close_connection and self.server.keepalive:
+                self.handle_one_request()
+        except socket.timeout:
+            pass
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        # parse_request() keeps HTTP/1.1 connections open unless the client
+        # asked otherwise.  Requests with a body close the connection too, as
+        # the application may not have read all of it.
+        if (self.request_version != 'HTTP/1.1' or
+                int(self.headers.getheader('Content-Length') or 0) > 0 or
+                self.server.shutting_down):
+            self.close_connection = True
+        handler = KeepAliveServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+## Servers
+
+class ThreadPoolWSGIServer(WSGIServer):
+    '''A WSGI server handling connections with a fixed pool of threads.
+
+    Accepted connections wait in a queue for a free thread.  On shutdown,
+    connections already accepted are served before the threads exit.  The
+    forum's connection pool is sized so every thread can get a database
+    connection without waiting.
+    '''
+
+    def __init__(self, server_address, threads=8, backlog=128, keepalive=5,
+                 handler=KeepAliveRequestHandler, listen_socket=None):
+        self.request_queue_size = backlog
+        self.keepalive = keepalive
+        self.shutting_down = False
+        WSGIServer.__init__(self, server_address, handler,
+                            bind_and_activate=listen_socket is None)
+        if listen_socket is not None:
+            # Serve on a socket that is already listening (pre-fork mode)
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+            self._SetupEnviron()
+        # A database connection for every request thread
+        forumdb.SizePool(threads)
+        self._connections = Queue.Queue()
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._Work,
+                                      name='forum-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _SetupEnviron(self):
+        '''Sets up the WSGI environment as server_bind() would.'''
+        (host, port) = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _Work(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            (request, client_address) = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def Stop(self):
+        '''Stops accepting connections, serves the ones already accepted,
+        and waits for the threads to finish.  Call from another thread than
+        the one running serve_forever().'''
+        self.shutting_down = True
+        self.shutdown()
+        for thread in self._threads:
+            self._connections.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.server_close()
+
+def _StopOnSignals(httpd):
+    '''Stops httpd gracefully when SIGTERM or SIGINT is received.'''
+    def Handle(signum, frame):
+        threading.Thread(target=httpd.Stop).start()
+    signal.signal(signal.SIGTERM, Handle)
+    signal.signal(signal.SIGINT, Handle)
+
+def _ServeForever(httpd, cleanup=None):
+    '''Runs httpd until it is stopped, then waits for its threads and calls
+    cleanup.'''
+    _StopOnSignals(httpd)
+    httpd.serve_forever()
+    while any(thread.is_alive() for thread in httpd._threads):
+        time.sleep(0.1)
+    if cleanup is not None:
+        cleanup()
+
+def serve(app, host='', port=8000, workers=1, threads=8, backlog=128,
+          keepalive=5, cleanup=None):
+    '''Serves a WSGI application until SIGTERM or SIGINT.
+
+    Args:
+      app: the WSGI application.
+      host, port: the address to listen on.
+      workers: the number of worker processes.  With more than one, the
+        listening socket is opened first and shared by forked workers.
+      threads: the number of request threads in each worker process.
+      backlog: the listen backlog of the socket.
+      keepalive: seconds an idle keep-alive connection is kept open; 0
+        closes every connection after one request.
+      cleanup: called with no arguments in each worker process once it has
+        finished serving requests.
+    '''
+    if workers <= 1:
+        httpd = ThreadPoolWSGIServer((host, port), threads, backlog, keepalive)
+        httpd.set_app(app)
+        _ServeForever(httpd, cleanup)
+        return
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                httpd = ThreadPoolWSGIServer((host, port), threads, backlog,
+                                             keepalive,
+                                             listen_socket=listener)
+                httpd.set_app(app)
+                _ServeForever(httpd, cleanup)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    listener.close()
+
+    # The parent only forwards shutdown signals and waits for the workers
+    def Forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, Forward)
+    signal.signal(signal.SIGINT, Forward)
+    while children:
+        try:
+            (pid, status) = os.wait()
+        except OSError:
+            # Interrupted by a signal; keep waiting
+            continue
+        if pid in children:
+            children.remove(pid)
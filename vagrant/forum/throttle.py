@@ -0,0 +1,243 @@
+#
+# Rate limiting and duplicate suppression for new forum posts.
+#
+# Each client may post at a sustained rate with short bursts (a token bucket
+# per client address), and a post whose content was already posted within a
+# short window is dropped.  The state is kept in memory by each server
+# process, or in Redis so that pre-forked workers share it.
+#
+
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger('forum.throttle')
+
+## Reasons Throttle.Check() gives for refusing a post
+RATE_LIMITED = 'rate limited'
+DUPLICATE = 'duplicate'
+
+class MemoryStore(object):
+    '''Throttling state in a bounded, thread-safe in-memory dictionary.
+
+    Entries expire once they no longer matter.  When more than max_keys are
+    held, the least recently used are dropped, which at worst lets a client
+    that has not posted for a while post again early.
+    '''
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def TakeToken(self, key, rate, burst, now):
+        '''Takes a token from the bucket for key, if it has one.
+
+        The bucket holds up to burst tokens and gains rate tokens a second.
+
+        Returns:
+          True if a token was taken.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            tokens = burst
+            if entry is not None and entry[0] > now:
+                (tokens, updated) = entry[1]
+                tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # The entry is not needed once the bucket would be full again
+            self._Set(key, now + (burst - tokens) / rate, (tokens, now), now)
+            return allowed
+
+    def ReturnToken(self, key, rate, burst, now):
+        '''Puts back a token taken from the bucket for key.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                # The bucket is full again already
+                return
+            (tokens, updated) = entry[1]
+            tokens = min(burst, tokens + (now - updated) * rate + 1)
+            self._Set(key, now + (burst - tokens) / rate, (tokens, now), now)
+
+    def AddIfAbsent(self, key, seconds, now):
+        '''Adds key for the given number of seconds unless it is present.
+
+        Returns:
+          True if key was added.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self._entries[key] = entry
+                return False
+            self._Set(key, now + seconds, True, now)
+            return True
+
+    def Remove(self, key):
+        '''Removes key if it is present.'''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _Set(self, key, expires, value, now):
+        entries = self._entries
+        entries[key] = (expires, value)
+        # Drop expired entries from the least recently used end
+        while entries:
+            (oldest, (oldest_expires, oldest_value)) = next(
+                entries.iteritems())
+            if oldest_expires > now:
+                break
+            del entries[oldest]
+        while len(entries) > self.max_keys:
+            entries.popitem(last=False)
+
+class RedisStore(object):
+    '''Throttling state in Redis, shared by every server process.
+
+    Args:
+      url: the Redis server, like redis://localhost:6379/0.
+      prefix: prepended to every key.
+    '''
+
+    # Takes a token from a bucket kept as a hash of its tokens and the time
+    # they were counted, in one atomic step
+    TAKE_TOKEN = '''
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens),
+                   'time', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+        return allowed
+    '''
+
+    # Puts a token back in a bucket, if the bucket still exists
+    RETURN_TOKEN = '''
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+        if not state[1] then
+            return 0
+        end
+        local tokens = tonumber(state[1])
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst,
+                          tokens + math.max(0, now - updated) * rate + 1)
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens),
+                   'time', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+        return 1
+    '''
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='forum:'):
+        if redis is None:
+            raise RuntimeError('The redis module is not installed')
+        self.prefix = prefix
+        self._client = redis.StrictRedis.from_url(url)
+        self._take_token = self._client.register_script(self.TAKE_TOKEN)
+        self._return_token = self._client.register_script(self.RETURN_TOKEN)
+
+    def TakeToken(self, key, rate, burst, now):
+        return bool(self._take_token(keys=[self.prefix + key],
+                                     args=[rate, burst, now]))
+
+    def ReturnToken(self, key, rate, burst, now):
+        self._return_token(keys=[self.prefix + key], args=[rate, burst, now])
+
+    def AddIfAbsent(self, key, seconds, now):
+        return bool(self._client.set(self.prefix + key, '1', nx=True,
+                                     px=int(seconds * 1000)))
+
+    def Remove(self, key):
+        self._client.delete(self.prefix + key)
+
+class Throttle(object):
+    '''Decides whether to accept new posts.
+
+    Args:
+      store: a MemoryStore or RedisStore.
+      rate: the posts a second each client may make, sustained.  Must be
+        positive: the buckets are refilled at this rate, and kept until
+        they are full again.
+      burst: the posts each client may make at once.
+      duplicate_seconds: how long the same content is refused for; 0
+        accepts repeated posts.
+
+    Raises:
+      ValueError if rate is not positive, here or when it is changed.
+    '''
+
+    def __init__(self, store, rate=0.2, burst=5, duplicate_seconds=60):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_seconds = duplicate_seconds
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        if not rate > 0:
+            raise ValueError('The post rate must be positive: %r' % (rate,))
+        self._rate = rate
+
+    def Check(self, client, content):
+        '''Checks a new post from client, and counts it if accepted.
+
+        If the store cannot be reached the post is accepted.
+
+        Returns:
+          None if the post may be saved, or RATE_LIMITED or DUPLICATE.
+        '''
+        now = time.time()
+        try:
+            if not self.store.TakeToken('bucket:' + client, self.rate,
+                                        self.burst, now):
+                return RATE_LIMITED
+            if self.duplicate_seconds > 0:
+                if not self.store.AddIfAbsent(self._PostKey(content),
+                                              self.duplicate_seconds, now):
+                    return DUPLICATE
+        except Exception:
+            log.exception('Could not check a post; accepting it')
+        return None
+
+    def Release(self, client, content):
+        '''Undoes Check() for a post that was accepted but not saved, so
+        that the client may send it again.'''
+        try:
+            self.store.ReturnToken('bucket:' + client, self.rate,
+                                   self.burst, time.time())
+            if self.duplicate_seconds > 0:
+                self.store.Remove(self._PostKey(content))
+        except Exception:
+            log.exception('Could not release a post')
+
+    def _PostKey(self, content):
+        return 'post:' + hashlib.sha1(content).hexdigest()
+
+    def RetryAfter(self):
+        '''Returns the seconds a rate limited client should wait.'''
+        return max(1, int(1 / self.rate + 0.5))
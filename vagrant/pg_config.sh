@@ -1,7 +1,14 @@
+# The tournament schema needs PostgreSQL 11 or later (partitioned Matches,
+# transition tables in the PlayerStats triggers), and trusty has 9.3, so
+# install it from the PostgreSQL apt repository, which keeps trusty's
+# packages in its archive
+wget -qO - https://www.postgresql.org/media/keys/ACCC4CF8.asc | apt-key add -
+echo "deb http://apt-archive.postgresql.org/pub/repos/apt trusty-pgdg main" \
+    > /etc/apt/sources.list.d/pgdg.list
 apt-get -qqy update
-apt-get -qqy install postgresql python-psycopg2
+apt-get -qqy install postgresql-11 python-psycopg2
 apt-get -qqy install python-flask python-sqlalchemy
-apt-get -qqy install python-pip
+apt-get -qqy install python-pip python-numpy
 pip install bleach
 pip install oauth2client
 pip install requests
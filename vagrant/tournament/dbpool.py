@@ -0,0 +1,257 @@
+#
+# dbpool.py -- a small thread-safe PostgreSQL connection pool
+#
+
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolError(Exception):
+    """Raised when a connection cannot be checked out of the pool."""
+    pass
+
+
+class ConnectionPool(object):
+    """Keeps open database connections around so they can be reused.
+
+    `minconn` connections are opened when the pool is created, and more on
+    demand by calling `connect`, up to `maxconn` at a time.  Returned
+    connections are kept idle for reuse, the most recently returned used
+    first; idle connections above `minconn` are closed once they have been
+    idle for longer than `idle_timeout` seconds, when a connection is
+    checked out or returned.
+
+    On checkout, a connection that has been idle for more than `ping_after`
+    seconds is health checked with a trivial query; broken connections are
+    discarded and replaced transparently.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, idle_timeout=300,
+                 ping_after=30, checkout_timeout=30):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: minconn=%s maxconn=%s"
+                             % (minconn, maxconn))
+        self.connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self.checkout_timeout = checkout_timeout
+
+        self._cond = threading.Condition(threading.Lock())
+        # Idle connections as (connection, time returned), most recent last
+        self._idle = []
+        # Number of connections that exist (idle, in use or being opened)
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'checkouts': 0,
+            'checkout_waits': 0,
+            'checkout_wait_seconds': 0.0,
+            'checkout_timeouts': 0,
+            'health_check_failures': 0,
+        }
+        now = time.time()
+        try:
+            for i in range(minconn):
+                self._size += 1
+                self._idle.append((self._open(), now))
+        except Exception:
+            self.closeall()
+            raise
+
+    def getconn(self):
+        """Checks a connection out of the pool.  Returns a connection."""
+        deadline = None
+        waited = False
+        start = time.time()
+        expired = []
+        self._cond.acquire()
+        try:
+            expired = self._expire_idle(start)
+            while True:
+                if self._closed:
+                    raise PoolError("Connection pool is closed")
+                if self._idle:
+                    (pgconn, idle_since) = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # Reserve the slot now, open the connection unlocked
+                    self._size += 1
+                    pgconn = None
+                    break
+                if deadline is None and self.checkout_timeout is not None:
+                    deadline = start + self.checkout_timeout
+                if not waited:
+                    waited = True
+                    self._stats['checkout_waits'] += 1
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats['checkout_timeouts'] += 1
+                        raise PoolError(
+                            "No connection available within %s seconds"
+                            % self.checkout_timeout)
+                self._cond.wait(remaining)
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['checkout_wait_seconds'] += time.time() - start
+        finally:
+            self._cond.release()
+            for expired_conn in expired:
+                self._close(expired_conn)
+
+        if pgconn is not None and not self._healthy(pgconn, idle_since):
+            self._discard(pgconn, reopen=True)
+            pgconn = None
+        if pgconn is None:
+            pgconn = self._open()
+        return pgconn
+
+    def putconn(self, pgconn, close=False):
+        """Returns a connection to the pool.
+
+        Any transaction still open on the connection is rolled back.  The
+        connection is closed instead of being kept if `close` is true or the
+        connection is broken.
+        """
+        if not close and not pgconn.closed:
+            try:
+                status = pgconn.get_transaction_status()
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    pgconn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or pgconn.closed:
+            self._discard(pgconn)
+            return
+
+        now = time.time()
+        expired = []
+        self._cond.acquire()
+        try:
+            pool_closed = self._closed
+            if not pool_closed:
+                self._idle.append((pgconn, now))
+                expired = self._expire_idle(now)
+                self._cond.notify()
+        finally:
+            self._cond.release()
+        if pool_closed:
+            self._discard(pgconn)
+        for expired_conn in expired:
+            self._close(expired_conn)
+
+    def closeall(self):
+        """Closes every idle connection and refuses further checkouts.
+
+        Connections that are checked out are closed when they are returned.
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            idle = [pgconn for (pgconn, idle_since) in self._idle]
+            self._idle = []
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        for pgconn in idle:
+            self._discard(pgconn)
+
+    def stats(self):
+        """Returns a dictionary of pool counters and gauges."""
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['minconn'] = self.minconn
+            stats['maxconn'] = self.maxconn
+        finally:
+            self._cond.release()
+        return stats
+
+    def _open(self):
+        """Opens a new connection for a slot that is already reserved."""
+        try:
+            pgconn = self.connect()
+        except Exception:
+            self._release_slot()
+            raise
+        self._cond.acquire()
+        try:
+            self._stats['connections_opened'] += 1
+        finally:
+            self._cond.release()
+        return pgconn
+
+    def _healthy(self, pgconn, idle_since):
+        """Checks that an idle connection can still be used."""
+        if pgconn.closed:
+            return False
+        if time.time() - idle_since < self.ping_after:
+            return True
+        try:
+            pgcurs = pgconn.cursor()
+            pgcurs.execute("SELECT 1;")
+            pgcurs.close()
+            pgconn.rollback()
+            return True
+        except psycopg2.Error:
+            self._cond.acquire()
+            try:
+                self._stats['health_check_failures'] += 1
+            finally:
+                self._cond.release()
+            return False
+
+    def _expire_idle(self, now):
+        """Removes connections idle for too long.  Called with the lock held.
+
+        Returns the connections that should be closed.
+        """
+        expired = []
+        keep = []
+        spare = self._size - self.minconn
+        # The list is ordered by return time, oldest first
+        for (pgconn, idle_since) in self._idle:
+            if spare > 0 and now - idle_since > self.idle_timeout:
+                expired.append(pgconn)
+                spare -= 1
+            else:
+                keep.append((pgconn, idle_since))
+        self._idle = keep
+        self._size -= len(expired)
+        return expired
+
+    def _discard(self, pgconn, reopen=False):
+        """Closes a connection.  Its slot is kept if it is to be reopened."""
+        if not reopen:
+            self._release_slot()
+        self._close(pgconn)
+
+    def _close(self, pgconn):
+        try:
+            pgconn.close()
+        except psycopg2.Error:
+            pass
+        self._cond.acquire()
+        try:
+            self._stats['connections_closed'] += 1
+        finally:
+            self._cond.release()
+
+    def _release_slot(self):
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
@@ -0,0 +1,320 @@
+#
+# engine.py -- in-memory tournament engine with write-behind persistence
+#
+
+import array
+import threading
+import time
+
+import pairing
+import tournament
+
+
+# Durability modes of TournamentEngine
+SYNC = 'sync'
+BATCHED = 'batched'
+
+
+class FlushError(Exception):
+    """Raised when a batch of changes could not be written to the database.
+
+    The batch is dropped and the engine reloaded from the database, so the
+    dropped changes no longer show in memory either.  `players` and
+    `results` are the dropped registrations, as (player_id, name), and
+    results, as (winner, loser).
+    """
+
+    def __init__(self, error, players, results):
+        Exception.__init__(self, "Could not write %d registrations and %d "
+                           "results: %s" % (len(players), len(results), error))
+        self.error = error
+        self.players = players
+        self.results = results
+
+
+class TournamentEngine(object):
+    """Serves one tournament from memory, writing changes to the database.
+
+    The tournament's players and match results are loaded once.  Wins and
+    matches are then kept in compact arrays indexed by player, so standings
+    and pairings never touch the database.
+
+    New registrations and results are written to the Players and Matches
+    tables according to `durability`:
+      SYNC: every change is committed before it is made in memory, so a
+            change that cannot be written raises and is not made.
+      BATCHED: changes are queued and committed together when a change
+               is made and `batch_size` changes are pending or
+               `flush_interval` seconds have passed since the last flush,
+               and on flush() or close().  There is no background flush:
+               the last changes before a quiet period stay queued until the
+               next change, flush() or close().  Queued changes are lost if
+               the process dies before they are flushed.  A batch that
+               cannot be written is dropped, the engine is reloaded from
+               the database and FlushError is raised.
+
+    The engine assumes it is the only writer of its tournament while open.
+    """
+
+    def __init__(self, tournament_id=tournament.DEFAULT_TOURNAMENT,
+                 durability=BATCHED, batch_size=1000, flush_interval=1.0):
+        if durability not in (SYNC, BATCHED):
+            raise ValueError("Unknown durability mode: %s" % durability)
+        self.tournament_id = tournament_id
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        # Player records, indexed by position; _index maps ids to positions
+        self._index = {}
+        self._ids = array.array('l')
+        self._names = []
+        self._wins = array.array('l')
+        self._matches = array.array('l')
+        self._opponents = {}
+        self._had_bye = set()
+        # Standings orders with and without tiebreakers, and the tiebreakers,
+        # recomputed when results change
+        self._ranked = None
+        self._tiebreakers = None
+        # Player ids reserved from the database but not yet used
+        self._free_ids = []
+        # Changes not yet written to the database
+        self._new_players = []
+        self._new_results = []
+        self._last_flush = time.time()
+        self.load()
+
+    def load(self):
+        """(Re)loads the tournament from the database.
+
+        Pending changes are flushed first.
+        """
+        with self._lock:
+            self.flush()
+            standings = tournament.playerStandings(self.tournament_id)
+            (opponents, had_bye) = tournament.previousOpponents(
+                self.tournament_id)
+            self._index = {}
+            self._ids = array.array('l')
+            self._names = []
+            self._wins = array.array('l')
+            self._matches = array.array('l')
+            for (player_id, name, wins, matches) in standings:
+                self._add_player(player_id, name, wins, matches)
+            self._opponents = opponents
+            self._had_bye = had_bye
+            self._ranked = None
+            self._tiebreakers = None
+
+    def countPlayers(self):
+        """Returns the number of players currently registered."""
+        return len(self._ids)
+
+    def registerPlayer(self, name):
+        """Adds a player to the tournament.  Returns the player's id."""
+        with self._lock:
+            if not self._free_ids:
+                # Ids reserved but not used are skipped once the engine is
+                # closed, so take only what the next batch can use
+                if self.durability == BATCHED:
+                    self._free_ids = self._reserve_ids(self.batch_size)
+                else:
+                    self._free_ids = self._reserve_ids(1)
+            player_id = self._free_ids.pop()
+            if self.durability == SYNC:
+                self._write([(player_id, name)], [])
+            self._add_player(player_id, name, 0, 0)
+            self._ranked = None
+            self._tiebreakers = None
+            if self.durability == BATCHED:
+                self._new_players.append((player_id, name))
+                self._changed()
+        return player_id
+
+    def reportMatch(self, winner, loser):
+        """Records the outcome of a single match between two players.
+
+        Args:
+          winner:  the id number of the player who won
+          loser:  the id number of the player who lost, or None for a bye
+        """
+        with self._lock:
+            winner_index = self._player_index(winner)
+            if loser is not None:
+                loser_index = self._player_index(loser)
+            if self.durability == SYNC:
+                self._write([], [(winner, loser)])
+            self._wins[winner_index] += 1
+            self._matches[winner_index] += 1
+            if loser is None:
+                self._had_bye.add(winner)
+            else:
+                self._matches[loser_index] += 1
+                self._opponents.setdefault(winner, set()).add(loser)
+                self._opponents.setdefault(loser, set()).add(winner)
+            self._ranked = None
+            self._tiebreakers = None
+            if self.durability == BATCHED:
+                self._new_results.append((winner, loser))
+                self._changed()
+
+    def playerStandings(self, tiebreakers=False):
+        """Returns the standings, in the same format as
+        tournament.playerStandings()."""
+        with self._lock:
+            order = self._standings_order(tiebreakers)
+            if not tiebreakers:
+                return [(self._ids[i], self._names[i], self._wins[i],
+                         self._matches[i]) for i in order]
+            (omw, sos) = self._compute_tiebreakers()
+            return [(self._ids[i], self._names[i], self._wins[i],
+                     self._matches[i], omw[i], sos[i]) for i in order]
+
+    def swissPairings(self):
+        """Returns the pairings for the next round, in the same format as
+        tournament.swissPairings()."""
+        with self._lock:
+            ranked = [self._ids[i] for i in self._standings_order(True)]
+            (pairs, bye) = pairing.pair_players(ranked, self._opponents,
+                                                self._had_bye)
+            names = self._names
+            index = self._index
+            swisspairs = [(id1, names[index[id1]], id2, names[index[id2]])
+                          for (id1, id2) in pairs]
+            if bye is not None:
+                swisspairs.append((bye, names[index[bye]], None, None))
+        return swisspairs
+
+    def flush(self):
+        """Writes all pending registrations and results in one transaction.
+
+        Raises:
+          FlushError: if they could not be written.  They are dropped and
+                      the engine reloaded; if the database cannot be read
+                      either, call load() again once it can.
+        """
+        with self._lock:
+            players = self._new_players
+            results = self._new_results
+            # Taken off the queue first, so a failed batch is not retried
+            # by every later change
+            self._new_players = []
+            self._new_results = []
+            self._last_flush = time.time()
+            if players or results:
+                try:
+                    self._write(players, results)
+                except Exception as error:
+                    self.load()
+                    raise FlushError(error, players, results)
+
+    def close(self):
+        """Flushes pending changes."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _add_player(self, player_id, name, wins, matches):
+        self._index[player_id] = len(self._ids)
+        self._ids.append(player_id)
+        self._names.append(name)
+        self._wins.append(wins)
+        self._matches.append(matches)
+
+    def _player_index(self, player_id):
+        try:
+            return self._index[player_id]
+        except KeyError:
+            raise ValueError("Player %s is not registered for tournament %s"
+                             % (player_id, self.tournament_id))
+
+    def _standings_order(self, tiebreakers=False):
+        """Returns player positions sorted by wins, best first, and then by
+        omw and id if asked to, as tournament.playerStandings() does."""
+        if self._ranked is None:
+            self._ranked = {}
+        order = self._ranked.get(tiebreakers)
+        if order is None:
+            wins = self._wins
+            if tiebreakers:
+                omw = self._compute_tiebreakers()[0]
+                ids = self._ids
+                key = lambda i: (-wins[i], -omw[i], ids[i])
+            else:
+                key = lambda i: -wins[i]
+            order = self._ranked[tiebreakers] = sorted(range(len(wins)),
+                                                       key=key)
+        return order
+
+    def _compute_tiebreakers(self):
+        """Returns arrays of the omw and sos of each player position, as
+        defined by tournament.playerStandings()."""
+        if self._tiebreakers is None:
+            count = len(self._ids)
+            omw = array.array('l', [0]) * count
+            sos = array.array('d', [0.0]) * count
+            index = self._index
+            wins = self._wins
+            matches = self._matches
+            for (player_id, opponents) in self._opponents.iteritems():
+                if not opponents:
+                    continue
+                total_wins = 0
+                total_rate = 0.0
+                for opponent in opponents:
+                    j = index[opponent]
+                    total_wins += wins[j]
+                    if matches[j]:
+                        total_rate += float(wins[j]) / matches[j]
+                i = index[player_id]
+                omw[i] = total_wins
+                sos[i] = total_rate / len(opponents)
+            self._tiebreakers = (omw, sos)
+        return self._tiebreakers
+
+    def _changed(self):
+        """Writes out the pending changes if there are enough of them or
+        they are due."""
+        pending = len(self._new_players) + len(self._new_results)
+        if (pending >= self.batch_size or
+                time.time() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _reserve_ids(self, count):
+        """Takes `count` player ids from the Players id sequence."""
+        query = """
+                SELECT nextval(pg_get_serial_sequence('Players', 'player_id'))
+                FROM generate_series(1, %s);
+                """
+        with tournament.db_cursor() as pgcurs:
+            pgcurs.execute(query, (count,))
+            ids = [row[0] for row in pgcurs]
+        # Hand out the lowest ids first
+        ids.reverse()
+        return ids
+
+    def _write(self, players, results):
+        with tournament.db_cursor() as pgcurs:
+            if players:
+                values = ",".join(
+                    pgcurs.mogrify("(%s,%s,%s)",
+                                   (player_id, self.tournament_id, name))
+                    for (player_id, name) in players)
+                pgcurs.execute("INSERT INTO Players"
+                               " (player_id, tournament_id, name)"
+                               " VALUES " + values + ";")
+            if results:
+                values = ",".join(
+                    pgcurs.mogrify("(%s,%s,%s)",
+                                   (self.tournament_id, winner, loser))
+                    for (winner, loser) in results)
+                pgcurs.execute("INSERT INTO Matches"
+                               " (tournament_id, winner_player_id,"
+                               "  loser_player_id)"
+                               " VALUES " + values + ";")
@@ -0,0 +1,262 @@
+#
+# instrument.py -- query instrumentation for tournament.py
+#
+# When enabled, every statement run through tournament.db_open() cursors is
+# timed and counted, and attributed to the tournament.py functions that were
+# running at the time.  Statements slower than a threshold are logged to the
+# 'tournament.slow_queries' logger.  When disabled (the default) the only
+# cost is one flag check per function call and per db_open().
+#
+# Usage:
+#   import instrument
+#   instrument.enable(slow_query_seconds=0.1)
+#   ...
+#   print instrument.render_prometheus()
+#
+
+import bisect
+import functools
+import logging
+import threading
+import time
+
+import psycopg2.extensions
+
+
+ENABLED = False
+
+# Statements taking at least this many seconds are logged; None disables it
+SLOW_QUERY_SECONDS = None
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used for statements run outside any tracked function
+UNTRACKED = 'other'
+
+slow_query_log = logging.getLogger('tournament.slow_queries')
+
+_local = threading.local()
+
+
+class Counter(object):
+    """A monotonically increasing count per label."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, label, amount=1):
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+class Histogram(object):
+    """Observation counts per label in cumulative latency buckets."""
+
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, label, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label)
+            if entry is None:
+                entry = self._values[label] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def values(self):
+        """Returns {label: (cumulative bucket counts, count, sum)}."""
+        with self._lock:
+            values = {}
+            for (label, (counts, count, total)) in self._values.items():
+                cumulative = []
+                running = 0
+                for bucket_count in counts:
+                    running += bucket_count
+                    cumulative.append(running)
+                values[label] = (cumulative, count, total)
+            return values
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+calls = Counter('tournament_calls_total',
+                'Calls of tournament.py functions.')
+queries = Counter('tournament_queries_total',
+                  'Statements executed, by calling function.')
+rows = Counter('tournament_rows_total',
+               'Rows returned or affected, by calling function.')
+slow_queries = Counter('tournament_slow_queries_total',
+                       'Statements slower than the slow query threshold.')
+query_seconds = Histogram('tournament_query_seconds',
+                          'Statement execution time, by calling function.')
+acquire_seconds = Histogram('tournament_connection_acquire_seconds',
+                            'Time taken to check a connection out of the '
+                            'pool.')
+
+COUNTERS = (calls, queries, rows, slow_queries)
+HISTOGRAMS = (query_seconds, acquire_seconds)
+
+
+def enable(slow_query_seconds=None):
+    """Starts recording metrics.
+
+    Args:
+      slow_query_seconds: log statements taking at least this long, or None
+                          to log none.
+    """
+    global ENABLED, SLOW_QUERY_SECONDS
+    SLOW_QUERY_SECONDS = slow_query_seconds
+    ENABLED = True
+
+
+def disable():
+    """Stops recording metrics.  Recorded values are kept."""
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """Clears all recorded values."""
+    for metric in COUNTERS + HISTOGRAMS:
+        metric.reset()
+
+
+def tracked(func):
+    """Decorator attributing the statements a function runs to its name.
+
+    Nested tracked calls are counted for every function on the stack, so
+    swissPairings() includes the queries made by playerStandings().
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        calls.inc(name)
+        stack = _stack()
+        stack.append(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+    return wrapper
+
+
+def record_acquire(seconds):
+    """Records the time taken to check out a pooled connection."""
+    acquire_seconds.observe(_current_function(), seconds)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor that records the time and row count of each statement."""
+
+    def execute(self, query, vars=None):
+        start = time.time()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            _record(self, query, time.time() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.time()
+        try:
+            return super(InstrumentedCursor, self).executemany(query,
+                                                               vars_list)
+        finally:
+            _record(self, query, time.time() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.time()
+        try:
+            return super(InstrumentedCursor, self).copy_expert(sql, file,
+                                                               size)
+        finally:
+            _record(self, sql, time.time() - start)
+
+
+def snapshot():
+    """Returns the recorded metrics as a dictionary keyed by metric name."""
+    metrics = {}
+    for counter in COUNTERS:
+        metrics[counter.name] = counter.values()
+    for histogram in HISTOGRAMS:
+        metrics[histogram.name] = dict(
+            (label, {'buckets': dict(zip(histogram.buckets, cumulative)),
+                     'count': count, 'sum': total})
+            for (label, (cumulative, count, total))
+            in histogram.values().items())
+    return metrics
+
+
+def render_prometheus():
+    """Returns the recorded metrics in the Prometheus text format."""
+    lines = []
+    for counter in COUNTERS:
+        lines.append('# HELP %s %s' % (counter.name, counter.help_text))
+        lines.append('# TYPE %s counter' % counter.name)
+        for (label, value) in sorted(counter.values().items()):
+            lines.append('%s{function="%s"} %s' % (counter.name, label, value))
+    for histogram in HISTOGRAMS:
+        name = histogram.name
+        lines.append('# HELP %s %s' % (name, histogram.help_text))
+        lines.append('# TYPE %s histogram' % name)
+        for (label, (cumulative, count, total)) in sorted(
+                histogram.values().items()):
+            for (bound, bucket_count) in zip(histogram.buckets, cumulative):
+                lines.append('%s_bucket{function="%s",le="%s"} %s'
+                             % (name, label, bound, bucket_count))
+            lines.append('%s_bucket{function="%s",le="+Inf"} %s'
+                         % (name, label, count))
+            lines.append('%s_sum{function="%s"} %s' % (name, label, total))
+            lines.append('%s_count{function="%s"} %s' % (name, label, count))
+    return '\n'.join(lines) + '\n'
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _current_function():
+    stack = _stack()
+    if stack:
+        return stack[-1]
+    return UNTRACKED
+
+
+def _record(cursor, query, seconds):
+    stack = _stack() or [UNTRACKED]
+    row_count = max(cursor.rowcount, 0)
+    for name in set(stack):
+        queries.inc(name)
+        rows.inc(name, row_count)
+        query_seconds.observe(name, seconds)
+    if SLOW_QUERY_SECONDS is not None and seconds >= SLOW_QUERY_SECONDS:
+        slow_queries.inc(stack[-1])
+        slow_query_log.warning("%.3fs in %s: %s", seconds, stack[-1],
+                               ' '.join(str(query).split())[:1000])
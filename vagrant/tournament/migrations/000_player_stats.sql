@@ -0,0 +1,136 @@
+-- Adds the PlayerStats table, the MatchTotals and Standings views and the
+-- triggers keeping PlayerStats up to date to a database created from the
+-- original, single-tournament tournament.sql, and fills in PlayerStats
+-- from the existing matches.  It can be run again on a single-tournament
+-- database, which gets the same definitions again, but stops with an error
+-- on a database already converted by 002_multi_tournament.sql.
+--
+-- Run with: psql tournament -f migrations/000_player_stats.sql
+--
+-- Needs PostgreSQL 10 or later, for the transition tables of the triggers.
+--
+-- Runs in one transaction, and blocks new players and matches while it
+-- runs so none are missed between filling in PlayerStats and creating the
+-- triggers.
+
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+-- The definitions below are the single-tournament ones; replacing the
+-- multi-tournament ones with them would break PlayerStats and its triggers
+DO $$
+BEGIN
+    IF to_regclass('Tournaments') IS NOT NULL THEN
+        RAISE EXCEPTION 'The database already has the multi-tournament '
+                        'schema; 000_player_stats.sql must not be run on it';
+    END IF;
+END
+$$;
+
+LOCK TABLE Players, Matches IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE TABLE IF NOT EXISTS PlayerStats (
+    player_id INTEGER PRIMARY KEY
+              REFERENCES Players(player_id) ON DELETE CASCADE,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    matches INTEGER NOT NULL DEFAULT 0,
+    points INTEGER NOT NULL DEFAULT 0
+    );
+
+CREATE INDEX IF NOT EXISTS PlayerStats_wins ON PlayerStats (wins DESC);
+
+-- An earlier Standings view aggregated Matches itself, with other column
+-- types, so it is dropped rather than replaced
+DROP VIEW IF EXISTS Standings;
+DROP VIEW IF EXISTS MatchTotals;
+
+CREATE VIEW MatchTotals AS
+    SELECT  player_id,
+            COALESCE(wins, 0) AS wins,
+            COALESCE(matches - wins, 0) AS losses,
+            COALESCE(matches, 0) AS matches
+    FROM Players LEFT JOIN
+        (SELECT player_id, SUM(won) AS wins, COUNT(*) AS matches
+         FROM (SELECT winner_player_id AS player_id, 1 AS won FROM Matches
+               UNION ALL
+               SELECT loser_player_id AS player_id, 0 AS won FROM Matches)
+               AS results
+         GROUP BY player_id)
+        AS records
+    USING (player_id);
+
+CREATE VIEW Standings AS
+    SELECT  player_id,
+            name,
+            wins,
+            matches
+    FROM Players JOIN PlayerStats USING (player_id);
+
+INSERT INTO PlayerStats (player_id, wins, losses, matches, points)
+    SELECT player_id, wins, losses, matches, wins FROM MatchTotals
+    ON CONFLICT (player_id) DO UPDATE
+        SET wins = EXCLUDED.wins,
+            losses = EXCLUDED.losses,
+            matches = EXCLUDED.matches,
+            points = EXCLUDED.points;
+
+CREATE OR REPLACE FUNCTION stats_add_players() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO PlayerStats (player_id)
+        SELECT player_id FROM new_players;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_apply_matches() RETURNS TRIGGER AS $$
+DECLARE
+    sign INTEGER := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    PERFORM 1 FROM PlayerStats
+        WHERE player_id IN (SELECT winner_player_id FROM changed_matches
+                            UNION
+                            SELECT loser_player_id FROM changed_matches)
+        ORDER BY player_id
+        FOR UPDATE;
+    UPDATE PlayerStats
+        SET wins = PlayerStats.wins + sign * totals.wins,
+            losses = PlayerStats.losses + sign * totals.losses,
+            matches = PlayerStats.matches + sign * totals.matches,
+            points = PlayerStats.points + sign * totals.wins
+        FROM (SELECT player_id,
+                     SUM(won) AS wins,
+                     SUM(1 - won) AS losses,
+                     COUNT(*) AS matches
+              FROM (SELECT winner_player_id AS player_id, 1 AS won
+                    FROM changed_matches
+                    UNION ALL
+                    SELECT loser_player_id AS player_id, 0 AS won
+                    FROM changed_matches)
+                    AS results
+              GROUP BY player_id)
+             AS totals
+        WHERE PlayerStats.player_id = totals.player_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS Players_stats ON Players;
+CREATE TRIGGER Players_stats AFTER INSERT ON Players
+    REFERENCING NEW TABLE AS new_players
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_add_players();
+
+DROP TRIGGER IF EXISTS Matches_stats_insert ON Matches;
+CREATE TRIGGER Matches_stats_insert AFTER INSERT ON Matches
+    REFERENCING NEW TABLE AS changed_matches
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_apply_matches();
+
+DROP TRIGGER IF EXISTS Matches_stats_delete ON Matches;
+CREATE TRIGGER Matches_stats_delete AFTER DELETE ON Matches
+    REFERENCING OLD TABLE AS changed_matches
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_apply_matches();
+
+COMMIT;
+
+ANALYZE PlayerStats;
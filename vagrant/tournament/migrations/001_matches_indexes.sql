@@ -0,0 +1,13 @@
+-- Adds the Matches indexes from tournament.sql to an existing database.
+--
+-- Run with: psql tournament -f migrations/001_matches_indexes.sql
+--
+-- The indexes are built CONCURRENTLY so matches can still be reported while
+-- the migration runs.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS Matches_winner
+    ON Matches (winner_player_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS Matches_loser
+    ON Matches (loser_player_id);
+
+ANALYZE Matches;
@@ -0,0 +1,153 @@
+-- Converts a single-tournament database to the multi-tournament schema of
+-- tournament.sql.  Existing players and matches become tournament 1, the
+-- default tournament, and the existing Matches table becomes its partition.
+--
+-- Run with: psql tournament -f migrations/002_multi_tournament.sql
+--
+-- Requires PostgreSQL 11 or later, migrations/000_player_stats.sql and
+-- 001_matches_indexes.sql.
+-- Runs in one transaction and locks Players and Matches while it runs.
+
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+CREATE TABLE Tournaments (
+    tournament_id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    archived BOOLEAN NOT NULL DEFAULT FALSE
+    );
+
+INSERT INTO Tournaments (name) VALUES ('Default');
+
+DROP VIEW Standings;
+DROP VIEW MatchTotals;
+DROP TRIGGER Matches_stats_insert ON Matches;
+DROP TRIGGER Matches_stats_delete ON Matches;
+
+-- Players and their stats belong to the default tournament
+ALTER TABLE Players
+    ADD COLUMN tournament_id INTEGER NOT NULL DEFAULT 1
+        REFERENCES Tournaments(tournament_id) ON DELETE CASCADE,
+    ADD UNIQUE (tournament_id, player_id);
+ALTER TABLE Players ALTER COLUMN tournament_id DROP DEFAULT;
+
+ALTER TABLE PlayerStats ADD COLUMN tournament_id INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE PlayerStats ALTER COLUMN tournament_id DROP DEFAULT;
+DROP INDEX PlayerStats_wins;
+CREATE INDEX PlayerStats_standings ON PlayerStats (tournament_id, wins DESC);
+
+-- The existing Matches table becomes the default tournament's partition.
+-- Its key and foreign keys are replaced by the partitioned table's, and it
+-- keeps its match_id sequence.
+ALTER TABLE Matches RENAME TO Matches_1;
+ALTER INDEX Matches_winner RENAME TO Matches_1_winner_player_id_idx;
+ALTER INDEX Matches_loser RENAME TO Matches_1_loser_player_id_idx;
+ALTER TABLE Matches_1
+    DROP CONSTRAINT matches_pkey,
+    DROP CONSTRAINT matches_winner_player_id_fkey,
+    DROP CONSTRAINT matches_loser_player_id_fkey,
+    ADD COLUMN tournament_id INTEGER NOT NULL DEFAULT 1,
+    ALTER COLUMN match_id DROP DEFAULT;
+ALTER TABLE Matches_1 ALTER COLUMN tournament_id DROP DEFAULT;
+
+CREATE TABLE Matches (
+    tournament_id INTEGER NOT NULL,
+    match_id INTEGER NOT NULL DEFAULT nextval('matches_match_id_seq'),
+    winner_player_id INTEGER,
+    loser_player_id INTEGER,
+    PRIMARY KEY (tournament_id, match_id),
+    FOREIGN KEY (tournament_id, winner_player_id)
+        REFERENCES Players(tournament_id, player_id),
+    FOREIGN KEY (tournament_id, loser_player_id)
+        REFERENCES Players(tournament_id, player_id)
+    ) PARTITION BY LIST (tournament_id);
+ALTER SEQUENCE matches_match_id_seq OWNED BY Matches.match_id;
+
+CREATE INDEX Matches_winner ON Matches (winner_player_id);
+CREATE INDEX Matches_loser ON Matches (loser_player_id);
+
+ALTER TABLE Matches ATTACH PARTITION Matches_1 FOR VALUES IN (1);
+
+-- Functions, views and triggers as in tournament.sql
+
+CREATE FUNCTION create_tournament(tournament_name TEXT) RETURNS INTEGER AS $$
+DECLARE
+    new_id INTEGER;
+BEGIN
+    INSERT INTO Tournaments (name) VALUES (tournament_name)
+        RETURNING tournament_id INTO new_id;
+    EXECUTE format('CREATE TABLE Matches_%s PARTITION OF Matches '
+                   'FOR VALUES IN (%s)', new_id, new_id);
+    RETURN new_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION archive_tournament(archive_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    UPDATE Tournaments SET archived = TRUE
+        WHERE tournament_id = archive_id AND NOT archived;
+    IF FOUND THEN
+        EXECUTE format('ALTER TABLE Matches DETACH PARTITION Matches_%s',
+                       archive_id);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION drop_tournament(drop_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('DROP TABLE IF EXISTS Matches_%s', drop_id);
+    DELETE FROM Tournaments WHERE tournament_id = drop_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE VIEW MatchTotals AS
+    SELECT  tournament_id,
+            player_id,
+            COALESCE(wins, 0) AS wins,
+            COALESCE(matches - wins, 0) AS losses,
+            COALESCE(matches, 0) AS matches
+    FROM Players LEFT JOIN
+        (SELECT tournament_id, player_id,
+                SUM(won) AS wins, COUNT(*) AS matches
+         FROM (SELECT tournament_id, winner_player_id AS player_id, 1 AS won
+               FROM Matches
+               UNION ALL
+               SELECT tournament_id, loser_player_id AS player_id, 0 AS won
+               FROM Matches)
+               AS results
+         GROUP BY tournament_id, player_id)
+        AS records
+    USING (tournament_id, player_id);
+
+-- The tournament is taken from PlayerStats alone and names are joined on
+-- the primary key, so the join stays cheap even when a new tournament has
+-- no statistics yet.
+CREATE VIEW Standings AS
+    SELECT  PlayerStats.tournament_id,
+            player_id,
+            name,
+            wins,
+            matches
+    FROM PlayerStats JOIN Players USING (player_id);
+
+CREATE OR REPLACE FUNCTION stats_add_players() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO PlayerStats (player_id, tournament_id)
+        SELECT player_id, tournament_id FROM new_players;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER Matches_stats_insert AFTER INSERT ON Matches
+    REFERENCING NEW TABLE AS changed_matches
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_apply_matches();
+
+CREATE TRIGGER Matches_stats_delete AFTER DELETE ON Matches
+    REFERENCING OLD TABLE AS changed_matches
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_apply_matches();
+
+COMMIT;
+
+ANALYZE Players;
+ANALYZE Matches;
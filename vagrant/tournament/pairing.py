@@ -0,0 +1,122 @@
+#
+# pairing.py -- Swiss pairing that avoids rematches and assigns byes
+#
+# The pairing works on player ids only, so it can be shared by everything
+# that pairs players (tournament.swissPairings() and friends).
+#
+
+import collections
+
+
+# How many of the next-ranked unpaired players are considered as opponents
+# before falling back to repairing an earlier pair.
+DEFAULT_WINDOW = 16
+
+# How many of the most recent pairs a repair may swap players with.
+DEFAULT_REPAIR_DEPTH = 8
+
+
+def pair_players(ranked, opponents, had_bye=(), window=DEFAULT_WINDOW,
+                 repair_depth=DEFAULT_REPAIR_DEPTH):
+    """Pairs players for the next round of a Swiss tournament.
+
+    Players are paired in standings order: each unpaired player is paired
+    with the highest-ranked of the next `window` unpaired players that they
+    have not played yet.  If all of those are rematches, one of the last
+    `repair_depth` pairs is split up to make two new pairs without a rematch.
+    Only if that fails too is a rematch accepted.  Each player therefore
+    costs a bounded amount of work, and pairing stays linear in the number
+    of players.
+
+    With an odd number of players, the lowest-ranked player who has not had
+    a bye yet sits out the round.
+
+    Args:
+      ranked: player ids, best ranked first.
+      opponents: a mapping from player id to the set of ids of the players
+                 they have already played.  Players missing from it have
+                 not played anyone.
+      had_bye: ids of the players who have already had a bye.
+      window: the number of candidate opponents considered per player.
+      repair_depth: the number of earlier pairs a repair may rearrange.
+
+    Returns:
+      A tuple (pairs, bye) where pairs is a list of (id1, id2) tuples, id1
+      ranked above id2, and bye is the id of the player sitting out, or None.
+    """
+    no_opponents = frozenset()
+    pending = collections.deque(ranked)
+    bye = None
+    if len(pending) % 2:
+        bye = _pick_bye(pending, had_bye)
+        pending.remove(bye)
+
+    pairs = []
+    while pending:
+        player = pending.popleft()
+        played = opponents.get(player, no_opponents)
+        for index in range(min(window, len(pending))):
+            if pending[index] not in played:
+                break
+        else:
+            index = None
+        if index is not None:
+            pairs.append((player, pending[index]))
+            del pending[index]
+            continue
+        # Everyone in reach is a rematch.  Pair with the next player anyway,
+        # unless an earlier pair can be split to avoid it.
+        other = pending.popleft()
+        if not _repair(pairs, player, other, opponents, repair_depth):
+            pairs.append((player, other))
+    return (pairs, bye)
+
+
+def opponents_from_matches(matches):
+    """Builds the previous opponents and byes of every player.
+
+    Args:
+      matches: an iterable of (winner, loser) player id pairs; a loser of
+               None records a bye for the winner.
+
+    Returns:
+      A tuple (opponents, had_bye) to pass to pair_players().
+    """
+    opponents = collections.defaultdict(set)
+    had_bye = set()
+    for (winner, loser) in matches:
+        if loser is None:
+            had_bye.add(winner)
+            continue
+        opponents[winner].add(loser)
+        opponents[loser].add(winner)
+    return (opponents, had_bye)
+
+
+def _pick_bye(ranked, had_bye):
+    """Returns the lowest-ranked player without a bye, or the lowest-ranked
+    player if everyone has had one."""
+    for player in reversed(ranked):
+        if player not in had_bye:
+            return player
+    return ranked[-1]
+
+
+def _repair(pairs, player, other, opponents, depth):
+    """Tries to re-pair one of the last `depth` pairs (a, b) with the rematch
+    (player, other) as (a, player) and (b, other), or the other way round.
+
+    Returns True and updates `pairs` if a rearrangement without rematches
+    was found.
+    """
+    no_opponents = frozenset()
+    played = opponents.get(player, no_opponents)
+    other_played = opponents.get(other, no_opponents)
+    for index in range(len(pairs) - 1, max(len(pairs) - depth, 0) - 1, -1):
+        (a, b) = pairs[index]
+        for (x, y) in ((a, b), (b, a)):
+            if x not in played and y not in other_played:
+                pairs[index] = (x, player)
+                pairs.append((y, other))
+                return True
+    return False
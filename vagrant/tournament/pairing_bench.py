@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# pairing_bench.py -- times pairing.pair_players() for large fields
+#
+# Usage:
+#   python pairing_bench.py [--players 1000 10000 100000] [--rounds 6]
+#
+# For each field size, plays `rounds` rounds with random results (pairing
+# every round with pair_players()) and reports how long pairing took.  No
+# database is needed.
+#
+
+import argparse
+import random
+import time
+
+import pairing
+
+
+def play_rounds(players, rounds, rng):
+    """Plays `rounds` random rounds between `players` players.
+
+    Returns:
+      A tuple (timings, rematches): the seconds each round's pairing took,
+      and the total number of rematches paired.
+    """
+    ids = range(1, players + 1)
+    wins = dict((player, 0) for player in ids)
+    matches = []
+    timings = []
+    rematches = 0
+    for round_no in range(rounds):
+        start = time.time()
+        ranked = sorted(ids, key=lambda player: -wins[player])
+        (opponents, had_bye) = pairing.opponents_from_matches(matches)
+        (pairs, bye) = pairing.pair_players(ranked, opponents, had_bye)
+        timings.append(time.time() - start)
+        for (id1, id2) in pairs:
+            if id2 in opponents.get(id1, ()):
+                rematches += 1
+            if rng.random() < 0.5:
+                (id1, id2) = (id2, id1)
+            wins[id1] += 1
+            matches.append((id1, id2))
+        if bye is not None:
+            wins[bye] += 1
+            matches.append((bye, None))
+    return (timings, rematches)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time Swiss pairing for large numbers of players.")
+    parser.add_argument('--players', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    print "%10s %8s %12s %12s %10s" % ("players", "rounds", "mean (s)",
+                                       "max (s)", "rematches")
+    for players in args.players:
+        rng = random.Random(args.seed)
+        (timings, rematches) = play_rounds(players, args.rounds, rng)
+        print "%10d %8d %12.4f %12.4f %10d" % (
+            players, args.rounds, sum(timings) / len(timings), max(timings),
+            rematches)
+
+
+if __name__ == '__main__':
+    main()
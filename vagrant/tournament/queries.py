@@ -0,0 +1,76 @@
+#
+# queries.py -- SQL shared by tournament.py and tournament_async.py
+#
+# The statements are written with psycopg2's named parameters, like
+# %(tournament_id)s; tournament_async.py numbers them for asyncpg.  This
+# module imports no database driver, so both APIs run the same statements.
+#
+
+
+# Queries whose plans are checked by tournament_test.testQueryPlans()
+MATCH_COUNT_QUERY = """
+    SELECT COUNT(*) FROM Matches
+    WHERE tournament_id = %(tournament_id)s
+      AND (winner_player_id = %(player_id)s OR loser_player_id = %(player_id)s);
+    """
+
+# Wins and matches are kept up to date in PlayerStats as matches are
+# reported (see tournament.sql), so standings are a plain table read.
+STANDINGS_QUERY = """
+    SELECT player_id, name, wins, matches
+    FROM Standings
+    WHERE tournament_id = %(tournament_id)s
+    ORDER BY wins DESC;
+    """
+
+# Standings with tiebreakers, computed in the same query: the distinct
+# opponents each player has met (byes excluded) are found in one pass over
+# the tournament's matches, and their records joined from PlayerStats.
+#   omw: Opponent Match Wins, the total wins of the player's opponents.
+#   sos: strength of schedule, the mean win rate of the player's opponents.
+# Ties are broken by omw and then by id; sos is only reported, as a float
+# it could be rounded differently here and in engine.py.
+# Nested loops are disabled for the query (TIEBREAKER_SETTINGS): until a
+# new tournament has been analyzed its players are estimated at one row,
+# and the planner would then recompute every player's schedule once per
+# player (minutes for 10000 players instead of a fraction of a second).
+TIEBREAKER_SETTINGS = """
+    SET LOCAL enable_nestloop = off;
+    """
+
+TIEBREAKER_STANDINGS_SELECT = """
+    WITH Opponents AS (
+        SELECT winner_player_id AS player_id, loser_player_id AS opponent_id
+        FROM Matches
+        WHERE tournament_id = %(tournament_id)s
+          AND loser_player_id IS NOT NULL
+        UNION
+        SELECT loser_player_id, winner_player_id
+        FROM Matches
+        WHERE tournament_id = %(tournament_id)s
+          AND loser_player_id IS NOT NULL
+    ), Schedules AS (
+        SELECT Opponents.player_id,
+               SUM(PlayerStats.wins) AS omw,
+               AVG(PlayerStats.wins::float
+                   / NULLIF(PlayerStats.matches, 0)) AS sos
+        FROM Opponents JOIN PlayerStats
+             ON PlayerStats.player_id = Opponents.opponent_id
+        WHERE PlayerStats.tournament_id = %(tournament_id)s
+        GROUP BY Opponents.player_id
+    )
+    SELECT player_id, name, wins, matches,
+           COALESCE(omw, 0)::integer AS omw, COALESCE(sos, 0) AS sos
+    FROM Standings LEFT JOIN Schedules USING (player_id)
+    WHERE tournament_id = %(tournament_id)s
+    ORDER BY wins DESC, omw DESC, player_id;
+    """
+
+TIEBREAKER_STANDINGS_QUERY = TIEBREAKER_SETTINGS + TIEBREAKER_STANDINGS_SELECT
+
+# Who has played whom, for pairing.opponents_from_matches()
+OPPONENTS_QUERY = """
+    SELECT winner_player_id, loser_player_id
+    FROM Matches
+    WHERE tournament_id = %(tournament_id)s;
+    """
@@ -0,0 +1,198 @@
+#
+# rating.py -- Elo ratings of a tournament's players, computed with NumPy
+#
+# Usage:
+#   ratings = rating.Ratings(tournament_id)
+#   ...
+#   tournament.reportMatch(winner, loser, tournament_id)
+#   ratings.refresh()
+#   pairs = tournament.swissPairings(tournament_id, ratings=ratings)
+#
+
+import numpy
+
+import tournament
+
+
+# Rating of a player who has not played yet
+INITIAL_RATING = 1500.0
+
+# Largest rating change a single match can cause
+K_FACTOR = 32.0
+
+# Match ids below the highest one read that refresh() reads again, for
+# results committed after results with higher ids
+REFRESH_WINDOW = 1000
+
+
+class Ratings(object):
+    """Elo ratings of the players of one tournament.
+
+    All of the tournament's results are read in one query, in the order
+    they were reported, and applied in batches: each batch holds matches
+    between distinct players, so its rating changes are computed together
+    with array operations and give exactly the ratings of replaying the
+    results one by one.  refresh() then applies only the results reported
+    since.  Byes do not change ratings.
+
+    Match ids are handed out when a result is inserted, not when it is
+    committed, so a result can show up after results with higher ids.
+    refresh() reads the last `refresh_window` ids again and skips the
+    results it has applied, so such a result is applied late, after the
+    ones it was read after.  A result committed after more than
+    `refresh_window` higher ids were read is missed until load().
+
+    Ratings are kept in an array indexed by player id.  The object can be
+    used as a mapping from player ids to ratings, e.g. as the `ratings` of
+    tournament.swissPairings().
+    """
+
+    def __init__(self, tournament_id=tournament.DEFAULT_TOURNAMENT,
+                 k_factor=K_FACTOR, initial_rating=INITIAL_RATING,
+                 refresh_window=REFRESH_WINDOW):
+        self.tournament_id = tournament_id
+        self.k_factor = k_factor
+        self.initial_rating = initial_rating
+        self.refresh_window = refresh_window
+        self.load()
+
+    def load(self):
+        """(Re)computes the ratings from all of the tournament's results.
+
+        Call this after matches are deleted.
+        """
+        self._ratings = numpy.empty(0)
+        self._count = 0
+        self._last_match_id = 0
+        # Ids of the results applied within the refresh window
+        self._recent_ids = set()
+        self.refresh()
+
+    def refresh(self):
+        """Applies the results reported since the last load() or refresh().
+
+        Returns:
+          The number of results applied.
+        """
+        query = """
+                SELECT match_id, winner_player_id, loser_player_id
+                FROM Matches
+                WHERE tournament_id = %s AND match_id > %s
+                  AND loser_player_id IS NOT NULL
+                ORDER BY match_id;
+                """
+        low = max(0, self._last_match_id - self.refresh_window)
+        with tournament.db_cursor(False) as pgcurs:
+            pgcurs.execute(query, (self.tournament_id, low))
+            rows = pgcurs.fetchall()
+        recent = self._recent_ids
+        rows = [row for row in rows if row[0] not in recent]
+        if not rows:
+            return 0
+        results = numpy.array(rows, dtype=numpy.int64)
+        match_ids = results[:, 0]
+        self._last_match_id = max(self._last_match_id, int(match_ids.max()))
+        low = self._last_match_id - self.refresh_window
+        recent = set(match_id for match_id in recent if match_id > low)
+        recent.update(int(match_id) for match_id in match_ids[match_ids > low])
+        self._recent_ids = recent
+        self.apply(results[:, 1], results[:, 2])
+        return len(rows)
+
+    def apply(self, winners, losers):
+        """Updates the ratings with results, in order.
+
+        Results applied here are not read from the database, so they are
+        applied again by load(), but not by refresh() unless they are in
+        the database with a match id it has not read yet.
+
+        Args:
+          winners, losers: sequences of the player ids of the winner and the
+                           loser of each match.
+        """
+        winners = numpy.asarray(winners, dtype=numpy.int64)
+        losers = numpy.asarray(losers, dtype=numpy.int64)
+        if not len(winners):
+            return
+        self._grow(max(winners.max(), losers.max()) + 1)
+        ratings = self._ratings
+        k_factor = self.k_factor
+        for batch in _disjoint_batches(winners, losers):
+            batch_winners = winners[batch]
+            batch_losers = losers[batch]
+            expected = 1.0 / (1.0 + 10.0 ** ((ratings[batch_losers] -
+                                              ratings[batch_winners]) / 400.0))
+            change = k_factor * (1.0 - expected)
+            ratings[batch_winners] += change
+            ratings[batch_losers] -= change
+
+    def get(self, player_id, default=None):
+        """Returns a player's rating, or `default` for a player id beyond
+        those the ratings hold, as for a dict.  Ids are held up to the
+        highest one with a result applied or passed to ratings()."""
+        if 0 <= player_id < self._count:
+            return float(self._ratings[player_id])
+        return default
+
+    def __getitem__(self, player_id):
+        """Returns a player's rating; players who have not played yet have
+        the initial rating."""
+        return self.get(player_id, self.initial_rating)
+
+    def ratings(self, player_ids):
+        """Returns a NumPy array of the ratings of the given players."""
+        player_ids = numpy.asarray(player_ids, dtype=numpy.int64)
+        if len(player_ids):
+            self._grow(player_ids.max() + 1)
+        return self._ratings[player_ids]
+
+    def _grow(self, size):
+        """Extends the ratings to hold at least `size` player ids."""
+        if size > len(self._ratings):
+            grown = numpy.empty(max(size, 2 * len(self._ratings)))
+            grown.fill(self.initial_rating)
+            grown[:len(self._ratings)] = self._ratings
+            self._ratings = grown
+        self._count = max(self._count, size)
+
+
+def _disjoint_batches(winners, losers):
+    """Splits matches into batches in which no player appears twice.
+
+    Each match goes in the batch after the latest batch holding an earlier
+    match of either of its players, so every player's matches stay in
+    order.  The batch numbers are found with array operations: starting
+    from zero, each pass raises every player's batch numbers, in the order
+    of their matches, to at least one more than the previous one.  A pass
+    is repeated until nothing changes, which is at most once per batch and
+    usually far fewer times, since results are reported round by round.
+
+    Returns:
+      A list of arrays of match positions, one per batch, in order.
+    """
+    count = len(winners)
+    # Each player's appearances, in the order of their matches
+    players = numpy.column_stack((winners, losers)).ravel()
+    slots = numpy.argsort(players, kind='mergesort')
+    slot_players = players[slots]
+    slot_matches = slots // 2
+    firsts = numpy.ones(len(slots), dtype=bool)
+    firsts[1:] = slot_players[1:] != slot_players[:-1]
+    positions = numpy.arange(len(slots))
+    # How many earlier matches the player has; the offset keeps the running
+    # maximum from crossing from one player to the next
+    rank = positions - numpy.maximum.accumulate(
+        numpy.where(firsts, positions, 0))
+    offset = (numpy.cumsum(firsts) - 1) * (2 * count + 1) - rank
+    batches = numpy.zeros(count, dtype=numpy.int64)
+    slot_batches = numpy.empty(len(slots), dtype=numpy.int64)
+    while True:
+        slot_batches[slots] = numpy.maximum.accumulate(
+            batches[slot_matches] + offset) - offset
+        raised = slot_batches.reshape(count, 2).max(axis=1)
+        if numpy.array_equal(raised, batches):
+            break
+        batches = raised
+    order = numpy.argsort(batches, kind='mergesort')
+    sizes = numpy.bincount(batches)
+    return numpy.split(order, numpy.cumsum(sizes)[:-1])
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# simulate.py -- Monte Carlo simulation of Swiss tournaments
+#
+# Usage:
+#   python simulate.py [--players 64] [--runs 1000] [--rounds 8]
+#                      [--spread 200] [--seed 1] [--output results.json]
+#                      [--replay RUN]
+#
+# Plays `runs` tournaments of `players` players in memory.  Every player has
+# a hidden strength (normally distributed, in Elo points), each round is
+# paired with pairing.pair_players() in the same standings order as
+# tournament.swissPairings() (wins, then opponent match wins, then id), and
+# the results of a round are drawn for all runs at once with NumPy.  For
+# each round the share of runs with a clear (untied) leader is reported,
+# along with the rounds needed before a run first has one.
+#
+# With --replay, the players and results of one run are written to a new
+# tournament in the local tournament database with registerPlayers() and
+# reportMatches(), e.g. as a realistic dataset for tournament_bench.py
+# --tournament.
+#
+
+import argparse
+import json
+import math
+import sys
+
+import numpy
+
+import pairing
+
+
+def simulate(players, runs, rounds, spread, rng):
+    """Plays `runs` Swiss tournaments of `players` players each.
+
+    Player ids are 0 to players - 1.  Opponent match wins count every
+    opponent, so a rematch (which pair_players() only makes when it has no
+    other choice) counts twice, where tournament.py counts it once.
+
+    Args:
+      players: the number of players in each tournament.
+      runs: the number of tournaments.
+      rounds: the number of rounds each tournament plays.
+      spread: the standard deviation of player strengths, in Elo points.
+      rng: a numpy.random.RandomState.
+
+    Returns:
+      A dictionary of arrays:
+        strength: (runs, players) player strengths.
+        wins: (runs, rounds, players) wins after each round.
+        omw: (runs, rounds, players) opponent match wins after each round.
+        winners, losers: (runs, rounds, players // 2) the winner and loser
+                         of every match of every round.
+        byes: (runs, rounds) the player given a bye each round, or -1.
+    """
+    strength = rng.normal(0.0, spread, (runs, players))
+    run_index = numpy.arange(runs)[:, None]
+    ids = numpy.arange(players)
+    size = players // 2
+    wins = numpy.zeros((runs, players), dtype=numpy.int64)
+    opponents = numpy.empty((runs, rounds, players), dtype=numpy.int64)
+    opponents.fill(-1)
+    history = {
+        'strength': strength,
+        'wins': numpy.zeros((runs, rounds, players), dtype=numpy.int64),
+        'omw': numpy.zeros((runs, rounds, players), dtype=numpy.int64),
+        'winners': numpy.zeros((runs, rounds, size), dtype=numpy.int64),
+        'losers': numpy.zeros((runs, rounds, size), dtype=numpy.int64),
+        'byes': numpy.empty((runs, rounds), dtype=numpy.int64),
+    }
+    history['byes'].fill(-1)
+    played = [dict() for run in xrange(runs)]
+    had_bye = [set() for run in xrange(runs)]
+    omw = numpy.zeros((runs, players), dtype=numpy.int64)
+
+    for round_no in xrange(rounds):
+        # Rank every run like tournament.TIEBREAKER_STANDINGS_QUERY does
+        ranked = numpy.lexsort((numpy.broadcast_to(ids, wins.shape), -omw,
+                                -wins))
+        first = numpy.empty((runs, size), dtype=numpy.int64)
+        second = numpy.empty((runs, size), dtype=numpy.int64)
+        for run in xrange(runs):
+            (pairs, bye) = pairing.pair_players(ranked[run].tolist(),
+                                                played[run], had_bye[run])
+            first[run] = [id1 for (id1, id2) in pairs]
+            second[run] = [id2 for (id1, id2) in pairs]
+            for (id1, id2) in pairs:
+                played[run].setdefault(id1, set()).add(id2)
+                played[run].setdefault(id2, set()).add(id1)
+            if bye is not None:
+                had_bye[run].add(bye)
+                history['byes'][run, round_no] = bye
+
+        # Play the round of every run at once
+        expected = 1.0 / (1.0 + 10.0 ** ((strength[run_index, second] -
+                                          strength[run_index, first]) /
+                                         400.0))
+        first_won = rng.random_sample(expected.shape) < expected
+        winners = numpy.where(first_won, first, second)
+        losers = numpy.where(first_won, second, first)
+        wins[run_index, winners] += 1
+        byes = history['byes'][:, round_no]
+        with_bye = numpy.nonzero(byes >= 0)[0]
+        wins[with_bye, byes[with_bye]] += 1
+        opponents[run_index, round_no, first] = second
+        opponents[run_index, round_no, second] = first
+
+        met = opponents[:, :round_no + 1, :]
+        opponent_wins = wins[run_index[:, :, None], numpy.maximum(met, 0)]
+        omw = numpy.where(met >= 0, opponent_wins, 0).sum(axis=1)
+        history['wins'][:, round_no] = wins
+        history['omw'][:, round_no] = omw
+        history['winners'][:, round_no] = winners
+        history['losers'][:, round_no] = losers
+    return history
+
+
+def summarize(history):
+    """Computes tie and round-count statistics of simulated tournaments.
+
+    Returns:
+      A dictionary with, per round, the share of runs with a clear leader
+      on wins alone and after the omw tiebreaker, the mean number of players
+      tied for the most wins and the share of runs led by their strongest
+      player; and the rounds runs needed to first have a clear leader on
+      wins (percentiles, and the share of runs that never had one).
+    """
+    wins = history['wins']
+    omw = history['omw']
+    (runs, rounds, players) = wins.shape
+    strongest = history['strength'].argmax(axis=1)
+    per_round = []
+    clear = numpy.zeros((runs, rounds), dtype=bool)
+    for round_no in xrange(rounds):
+        round_wins = wins[:, round_no]
+        top = round_wins == round_wins.max(axis=1)[:, None]
+        tied = top.sum(axis=1)
+        clear[:, round_no] = tied == 1
+        # Among the players tied on wins, is the best omw unique?
+        top_omw = numpy.where(top, omw[:, round_no], -1)
+        clear_omw = (top_omw == top_omw.max(axis=1)[:, None]).sum(axis=1) == 1
+        leader = numpy.lexsort((
+            numpy.broadcast_to(numpy.arange(players), round_wins.shape),
+            -omw[:, round_no], -round_wins))[:, 0]
+        per_round.append({
+            'round': round_no + 1,
+            'clear_leader': float(clear[:, round_no].mean()),
+            'clear_leader_tiebreak': float(clear_omw.mean()),
+            'mean_tied_for_first': float(tied.mean()),
+            'strongest_leads': float((leader == strongest).mean()),
+        })
+    ever = clear.any(axis=1)
+    first_clear = clear.argmax(axis=1)[ever] + 1
+    needed = {'never': float(1 - ever.mean())}
+    if len(first_clear):
+        for (name, q) in (('p50', 50), ('p90', 90), ('p99', 99)):
+            needed[name] = float(numpy.percentile(first_clear, q))
+    return {'per_round': per_round, 'rounds_to_clear_leader': needed}
+
+
+def replay(history, run, name=None):
+    """Writes one simulated run to a new tournament in the database.
+
+    Players are registered as "Simulated Player <id>" and the matches
+    reported round by round, byes included.
+
+    Returns:
+      The new tournament's id.
+    """
+    # Imported here so that simulating needs no database driver
+    import tournament
+    (runs, rounds, players) = history['wins'].shape
+    tournament_id = tournament.createTournament(
+        name or "Simulated run %d" % run)
+    ids = tournament.registerPlayers(
+        ("Simulated Player %d" % player for player in xrange(players)),
+        tournament_id)
+
+    def results():
+        for round_no in xrange(rounds):
+            for (winner, loser) in zip(history['winners'][run, round_no],
+                                       history['losers'][run, round_no]):
+                yield (ids[winner], ids[loser])
+            bye = history['byes'][run, round_no]
+            if bye >= 0:
+                yield (ids[bye], None)
+
+    tournament.reportMatches(results(), tournament_id)
+    return tournament_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Simulate Swiss tournaments to plan rounds.")
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--runs', type=int, default=1000,
+                        help="tournaments to simulate (default: %(default)s)")
+    parser.add_argument('--rounds', type=int,
+                        help="rounds per tournament (default: two more "
+                             "than log2 of the players)")
+    parser.add_argument('--spread', type=float, default=200.0,
+                        help="standard deviation of player strength, in Elo "
+                             "points (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write statistics to this JSON file")
+    parser.add_argument('--replay', type=int, metavar='RUN',
+                        help="write this run to a new tournament in the "
+                             "database")
+    args = parser.parse_args(argv)
+    if args.players < 2:
+        parser.error("at least 2 players are needed")
+    rounds = args.rounds or int(math.ceil(math.log(args.players, 2))) + 2
+    if args.replay is not None and not 0 <= args.replay < args.runs:
+        parser.error("--replay must be a run number below --runs")
+
+    rng = numpy.random.RandomState(args.seed)
+    history = simulate(args.players, args.runs, rounds, args.spread, rng)
+    stats = summarize(history)
+
+    print "%d runs of %d players, %d rounds" % (args.runs, args.players,
+                                                rounds)
+    print "%6s %14s %16s %12s %16s" % ("round", "clear leader",
+                                       "+ tiebreaker", "tied first",
+                                       "strongest leads")
+    for row in stats['per_round']:
+        print "%6d %13.1f%% %15.1f%% %12.2f %15.1f%%" % (
+            row['round'], 100 * row['clear_leader'],
+            100 * row['clear_leader_tiebreak'], row['mean_tied_for_first'],
+            100 * row['strongest_leads'])
+    needed = stats['rounds_to_clear_leader']
+    print "Rounds to a clear leader: %s; never in %.1f%% of runs" % (
+        ", ".join("%s %g" % (name, needed[name])
+                  for name in ('p50', 'p90', 'p99') if name in needed),
+        100 * needed['never'])
+
+    if args.output:
+        report = {
+            'meta': {
+                'players': args.players,
+                'runs': args.runs,
+                'rounds': rounds,
+                'spread': args.spread,
+                'seed': args.seed,
+            },
+            'results': stats,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.replay is not None:
+        tournament_id = replay(history, args.replay)
+        print "Replayed run %d into tournament %d." % (args.replay,
+                                                       tournament_id)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
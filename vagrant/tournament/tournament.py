@@ -3,56 +3,254 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import collections
+import contextlib
+import csv
+import itertools
+import json
+import os
+import threading
+import time
+
 import psycopg2
+import psycopg2.extensions
+
+import instrument
+import pairing
+from dbpool import ConnectionPool
+from queries import (MATCH_COUNT_QUERY, OPPONENTS_QUERY, STANDINGS_QUERY,
+                     TIEBREAKER_SETTINGS, TIEBREAKER_STANDINGS_QUERY,
+                     TIEBREAKER_STANDINGS_SELECT)
+
+
+# Connection string for the tournament database
+DSN = "dbname=tournament"
+
+# Class of the connections opened by connect().  A subclass can be set here
+# (before the pool is created, or followed by configurePool()) to change
+# how cursors behave, as tournament_bench.py does to count queries.
+CONNECTION_FACTORY = psycopg2.extensions.connection
+
+# Default settings for the connection pool, see configurePool()
+POOL_CONFIG = {
+    'minconn': 1,
+    'maxconn': 10,
+    'idle_timeout': 300,
+    'ping_after': 30,
+    'checkout_timeout': 30,
+}
+
+# Tournament used by every function when no tournament id is given; it is
+# created by tournament.sql
+DEFAULT_TOURNAMENT = 1
+
+# Formats exportStandings(), exportMatches() and exportPairings() can write
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# Rows fetched at a time from the server-side cursor of a JSON Lines export
+EXPORT_FETCH_SIZE = 2000
+
+# Tables saved by snapshotDatabase() and loaded by restoreDatabase(), in
+# load order, with the file and the columns saved for each.  The matches of
+# each tournament are saved to their own file, named after MATCHES_FILE.
+SNAPSHOT_TABLES = (
+    ('Tournaments', 'tournaments.csv', ('tournament_id', 'name', 'archived')),
+    ('Players', 'players.csv', ('player_id', 'tournament_id', 'name')),
+)
+MATCHES_FILE = 'matches_%d.csv'
+MATCHES_COLUMNS = ('tournament_id', 'match_id', 'winner_player_id',
+                   'loser_player_id')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Pool each checked out connection came from, so db_close() returns it there
+# even if configurePool() has replaced the pool in the meantime
+_conn_pools = {}
 
 
 def connect():
     """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    return psycopg2.connect(DSN, connection_factory=CONNECTION_FACTORY)
+
+
+def configurePool(**settings):
+    """(Re)creates the connection pool used by all the functions here.
+
+    Args:
+      settings: any of the POOL_CONFIG keys - minconn, maxconn,
+                idle_timeout (seconds an idle connection above minconn is
+                kept), ping_after (seconds idle before a checkout health
+                check) and checkout_timeout (seconds to wait for a free
+                connection).
+    """
+    global _pool
+    config = dict(POOL_CONFIG)
+    for key in settings:
+        if key not in config:
+            raise TypeError("Unknown pool setting: %s" % key)
+    config.update(settings)
+    with _pool_lock:
+        old_pool = _pool
+        _pool = ConnectionPool(connect, **config)
+        POOL_CONFIG.update(settings)
+    if old_pool is not None:
+        old_pool.closeall()
+
+
+def getPool():
+    """Returns the connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(connect, **POOL_CONFIG)
+    return _pool
+
+
+def poolStats():
+    """Returns a dictionary of connection pool counters and gauges."""
+    return getPool().stats()
 
 
 def db_open():
-    """Returns a database connection, and cursor"""
-    pgconn = connect()
+    """Returns a database connection (from the pool), and cursor"""
+    pool = getPool()
+    if instrument.ENABLED:
+        start = time.time()
+        pgconn = pool.getconn()
+        instrument.record_acquire(time.time() - start)
+        _conn_pools[pgconn] = pool
+        pgcurs = pgconn.cursor(cursor_factory=instrument.InstrumentedCursor)
+        return (pgconn, pgcurs)
+    pgconn = pool.getconn()
+    _conn_pools[pgconn] = pool
     pgcurs = pgconn.cursor()
     return (pgconn, pgcurs)
 
 
 def db_close(pgconn, do_commit=True):
-    """Closes a database connection, after commiting(if requested to)"""
-    if do_commit:
-        pgconn.commit()
-    pgconn.close()
+    """Returns a database connection to the pool it came from, after
+    commiting(if requested to) or rolling back"""
+    try:
+        if do_commit:
+            pgconn.commit()
+        else:
+            pgconn.rollback()
+    finally:
+        _conn_pools.pop(pgconn).putconn(pgconn)
+
+
+@contextlib.contextmanager
+def db_cursor(do_commit=True):
+    """Yields a cursor on a pooled connection.
+
+    The connection is committed (if requested to) and returned to the pool
+    at the end of the block, or rolled back if the block raises.
+    """
+    (pgconn, pgcurs) = db_open()
+    try:
+        yield pgcurs
+    except Exception:
+        db_close(pgconn, False)
+        raise
+    db_close(pgconn, do_commit)
 
 
-def deleteMatches():
-    """Remove all the match records from the database."""
-    (pgconn, pgcurs) = db_open()
-    sql = "DELETE FROM Matches;"
-    pgcurs.execute(sql)
-    db_close(pgconn)
+def _batches(iterable, size):
+    """Yields lists of up to `size` consecutive items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
-def deletePlayers():
-    """Remove all the player records from the database."""
-    (pgconn, pgcurs) = db_open()
-    sql = "DELETE FROM Players;"
-    pgcurs.execute(sql)
-    db_close(pgconn)
+@instrument.tracked
+def createTournament(name):
+    """Adds a tournament to the database.
 
+    Args:
+      name: the tournament's name.
 
-def countPlayers():
+    Returns:
+      The new tournament's id.
+    """
+    with db_cursor() as pgcurs:
+        pgcurs.execute("SELECT create_tournament(%s);", (name,))
+        tournament_id = pgcurs.fetchone()[0]
+    return tournament_id
+
+
+@instrument.tracked
+def archiveTournament(tournament_id):
+    """Closes a tournament.
+
+    Its matches are detached from the Matches table into their own table, so
+    no more matches can be reported.  Its players and standings are kept.
+    """
+    with db_cursor() as pgcurs:
+        pgcurs.execute("SELECT archive_tournament(%s);", (tournament_id,))
+
+
+@instrument.tracked
+def dropTournament(tournament_id):
+    """Removes a tournament along with all its players and matches."""
+    with db_cursor() as pgcurs:
+        pgcurs.execute("SELECT drop_tournament(%s);", (tournament_id,))
+
+
+@instrument.tracked
+def listTournaments():
+    """Returns a list of (id, name, archived) tuples of every tournament."""
+    query = """
+            SELECT tournament_id, name, archived
+            FROM Tournaments
+            ORDER BY tournament_id;
+            """
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute(query)
+        tournaments = pgcurs.fetchall()
+    return tournaments
+
+
+@instrument.tracked
+def deleteMatches(tournament_id=DEFAULT_TOURNAMENT):
+    """Remove all the match records of a tournament from the database."""
+    # Emptying the tournament's partition is much cheaper than a DELETE,
+    # but skips the PlayerStats triggers, so reset the stats here.
+    sql = "TRUNCATE Matches_%d;" % int(tournament_id)
+    with db_cursor() as pgcurs:
+        pgcurs.execute(sql)
+        pgcurs.execute("""
+            UPDATE PlayerStats SET wins = 0, losses = 0, matches = 0,
+                                   points = 0
+            WHERE tournament_id = %s;
+            """, (tournament_id,))
+
+
+@instrument.tracked
+def deletePlayers(tournament_id=DEFAULT_TOURNAMENT):
+    """Remove all the player records of a tournament from the database."""
+    sql = "DELETE FROM Players WHERE tournament_id = %s;"
+    with db_cursor() as pgcurs:
+        pgcurs.execute(sql, (tournament_id,))
+
+
+@instrument.tracked
+def countPlayers(tournament_id=DEFAULT_TOURNAMENT):
     """Returns the number of players currently registered."""
-    (pgconn, pgcurs) = db_open()
-    query = "SELECT COUNT(*) FROM Players;"
-    pgcurs.execute(query)
-    result = pgcurs.fetchone()
+    query = "SELECT COUNT(*) FROM Players WHERE tournament_id = %s;"
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute(query, (tournament_id,))
+        result = pgcurs.fetchone()
     count = result[0]
-    db_close(pgconn, False)
     return count
 
 
-def registerPlayer(name):
+@instrument.tracked
+def registerPlayer(name, tournament_id=DEFAULT_TOURNAMENT):
     """Adds a player to the tournament database.
 
     The database assigns a unique serial id number for the player.  (This
@@ -60,115 +258,464 @@ def registerPlayer(name):
 
     Args:
       name: the player's full name (need not be unique).
+      tournament_id: the tournament the player registers for.
     """
-    (pgconn, pgcurs) = db_open()
-    query = "INSERT INTO Players (name) VALUES (%s);"
-    pgcurs.execute(query, (name,))
-    db_close(pgconn)
+    query = "INSERT INTO Players (tournament_id, name) VALUES (%s, %s);"
+    with db_cursor() as pgcurs:
+        pgcurs.execute(query, (tournament_id, name))
 
 
-def getNumberOfMatches(playerid):
+@instrument.tracked
+def registerPlayers(names, tournament_id=DEFAULT_TOURNAMENT, batch_size=1000):
+    """Adds many players to the tournament database in one transaction.
+
+    Names are read lazily and inserted in multi-row batches, so `names` can
+    be a generator of any length.
+
+    Args:
+      names: an iterable of the players' full names.
+      tournament_id: the tournament the players register for.
+      batch_size: the number of players inserted per statement.
+
+    Returns:
+      A list of the assigned player ids, in the same order as `names`.
+    """
+    player_ids = []
+    with db_cursor() as pgcurs:
+        for batch in _batches(names, batch_size):
+            values = ",".join(pgcurs.mogrify("(%s,%s)", (tournament_id, name))
+                              for name in batch)
+            query = ("INSERT INTO Players (tournament_id, name) VALUES " +
+                     values + " RETURNING player_id;")
+            pgcurs.execute(query)
+            player_ids.extend(row[0] for row in pgcurs.fetchall())
+    return player_ids
+
+
+@instrument.tracked
+def getNumberOfMatches(playerid, tournament_id=DEFAULT_TOURNAMENT):
     """
     Returns number of matches playes by a player
     """
 
-    (pgconn, pgcurs) = db_open()
-    query = """
-            SELECT COUNT(*) FROM Matches
-            WHERE winner_player_id = %s OR loser_player_id = %s
-            """
-    pgcurs.execute(query, (playerid, playerid))
-    row = pgcurs.fetchone()
+    params = {'tournament_id': tournament_id, 'player_id': playerid}
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute(MATCH_COUNT_QUERY, params)
+        row = pgcurs.fetchone()
     match_count = row[0]
-    db_close(pgconn)
     return match_count
 
 
-def playerStandings():
+@instrument.tracked
+def playerStandings(tournament_id=DEFAULT_TOURNAMENT, tiebreakers=False):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a
     player tied for first place if there is currently a tie.
 
+    Args:
+      tournament_id: the tournament to return the standings of.
+      tiebreakers: also return each player's tiebreakers, and break ties in
+                   wins by omw (then by id) rather than arbitrarily.
+
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
         id: the player's unique id (assigned by the database)
         name: the player's full name (as registered)
         wins: the number of matches the player has won
         matches: the number of matches the player has played
+      With tiebreakers, each tuple also ends with (omw, sos):
+        omw: Opponent Match Wins, the total number of wins of the different
+             players this player has played
+        sos: strength of schedule, the mean win rate of those players
     """
-    plStandings = []
-    (pgconn, pgcurs) = db_open()
-    query = """
-            SELECT  player_id,
-                    name,
-                    CASE WHEN victories IS NOT NULL
-                       THEN victories
-                       ELSE 0 END AS victories
-            FROM Players LEFT JOIN
-                (SELECT winner_player_id, COUNT(winner_player_id) AS victories
-                 FROM Matches
-                 GROUP BY winner_player_id)
-                AS inner_match
-            ON winner_player_id=player_id
-            ORDER BY victories DESC;
-            """
-    pgcurs.execute(query)
-    rows = pgcurs.fetchall()
-    for row in rows:
-        # Convert the tuple to list so we can add the 'Number of matches'
-        plrecord = list(row)
-        # Query 'Number of matches' played by this player
-        no_of_matches = getNumberOfMatches(plrecord[0])
-        # Append 'Number of matches' to this player's record
-        plrecord.append(no_of_matches)
-        # Convert the list back to immutable tuple
-        row = tuple(plrecord)
-        plStandings.append(row)
-    db_close(pgconn, False)
+    query = STANDINGS_QUERY
+    if tiebreakers:
+        query = TIEBREAKER_STANDINGS_QUERY
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute(query, {'tournament_id': tournament_id})
+        plStandings = pgcurs.fetchall()
     return plStandings
 
 
-def reportMatch(winner, loser):
+@instrument.tracked
+def reportMatch(winner, loser, tournament_id=DEFAULT_TOURNAMENT):
     """Records the outcome of a single match between two players.
 
     Args:
       winner:  the id number of the player who won
-      loser:  the id number of the player who lost
+      loser:  the id number of the player who lost, or None to record a bye
+              (a free win) for the winner
+      tournament_id: the tournament both players are registered for
     """
-    (pgconn, pgcurs) = db_open()
     query = """
-            INSERT INTO Matches (winner_player_id, loser_player_id)
-            VALUES (%s,%s);
+            INSERT INTO Matches
+                (tournament_id, winner_player_id, loser_player_id)
+            VALUES (%s,%s,%s);
             """
-    pgcurs.execute(query, (winner, loser))
-    db_close(pgconn)
+    with db_cursor() as pgcurs:
+        pgcurs.execute(query, (tournament_id, winner, loser))
+
+
+@instrument.tracked
+def previousOpponents(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns who has played whom in a tournament, from a single query.
+
+    Returns:
+      A tuple (opponents, had_bye): opponents maps each player id to the set
+      of ids of the players they have played, and had_bye is the set of ids
+      of the players who have had a bye.
+    """
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute(OPPONENTS_QUERY, {'tournament_id': tournament_id})
+        (opponents, had_bye) = pairing.opponents_from_matches(pgcurs)
+    return (opponents, had_bye)
+
+
+def _stats_scope(tournament_id):
+    """Returns the SQL condition and parameters limiting stats maintenance
+    to one tournament, or to every tournament that is not archived."""
+    if tournament_id is None:
+        return ("tournament_id IN (SELECT tournament_id FROM Tournaments"
+                "                  WHERE NOT archived)", ())
+    return ("tournament_id = %s", (tournament_id,))
+
 
+@instrument.tracked
+def verifyPlayerStats(tournament_id=None):
+    """Compares the maintained PlayerStats with a recount of Matches.
 
-def swissPairings():
+    Args:
+      tournament_id: the tournament to check, or None to check every
+                     tournament that is not archived.
+
+    Returns:
+      A list of tuples, one per player whose stats have drifted, each of
+      which contains (id, stored, expected), where stored and expected are
+      (wins, losses, matches, points) tuples.  Stored is None if the player
+      has no PlayerStats row.
+    """
+    (scope, params) = _stats_scope(tournament_id)
+    query = """
+            SELECT  player_id,
+                    s.wins, s.losses, s.matches, s.points,
+                    t.wins, t.losses, t.matches, t.wins
+            FROM MatchTotals AS t LEFT JOIN PlayerStats AS s
+            USING (tournament_id, player_id)
+            WHERE %s
+              AND (s.wins, s.losses, s.matches, s.points)
+                  IS DISTINCT FROM (t.wins, t.losses, t.matches, t.wins)
+            ORDER BY player_id;
+            """ % scope
+    drift = []
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute(query, params)
+        for row in pgcurs:
+            stored = row[1:5]
+            if stored[0] is None:
+                stored = None
+            drift.append((row[0], stored, tuple(row[5:9])))
+    return drift
+
+
+@instrument.tracked
+def rebuildPlayerStats(tournament_id=None):
+    """Recomputes PlayerStats from the Matches table.
+
+    Matches is locked against writes while the stats are rebuilt.
+
+    Args:
+      tournament_id: the tournament to rebuild, or None to rebuild every
+                     tournament that is not archived.
+
+    Returns:
+      The number of players whose stats were rebuilt.
+    """
+    (scope, params) = _stats_scope(tournament_id)
+    with db_cursor() as pgcurs:
+        pgcurs.execute("LOCK TABLE Matches IN SHARE MODE;")
+        count = _rebuild_stats(pgcurs, scope, params)
+    return count
+
+
+def _rebuild_stats(pgcurs, scope, params):
+    """Recomputes the PlayerStats matching an SQL condition from Matches.
+    Returns the number of players whose stats were rebuilt."""
+    pgcurs.execute("DELETE FROM PlayerStats WHERE %s;" % scope, params)
+    pgcurs.execute("""
+        INSERT INTO PlayerStats
+            (player_id, tournament_id, wins, losses, matches, points)
+        SELECT player_id, tournament_id, wins, losses, matches, wins
+        FROM MatchTotals
+        WHERE %s;
+        """ % scope, params)
+    return pgcurs.rowcount
+
+
+@instrument.tracked
+def reportMatches(results, tournament_id=DEFAULT_TOURNAMENT, batch_size=1000):
+    """Records the outcomes of many matches in one transaction.
+
+    Results are read lazily and inserted in multi-row batches, so `results`
+    can be a generator of any length.
+
+    Args:
+      results: an iterable of (winner, loser) player id pairs.
+      tournament_id: the tournament all the players are registered for.
+      batch_size: the number of matches inserted per statement.
+    """
+    with db_cursor() as pgcurs:
+        for batch in _batches(results, batch_size):
+            values = ",".join(pgcurs.mogrify("(%s,%s,%s)",
+                                             (tournament_id, winner, loser))
+                              for (winner, loser) in batch)
+            query = ("INSERT INTO Matches"
+                     " (tournament_id, winner_player_id, loser_player_id)"
+                     " VALUES " + values + ";")
+            pgcurs.execute(query)
+
+
+@instrument.tracked
+def swissPairings(tournament_id=DEFAULT_TOURNAMENT, ratings=None):
     """Returns a list of pairs of players for the next round of a match.
 
-    Assuming that there are an even number of players registered, each player
-    appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    Each player appears exactly once in the pairings.  Each player is paired
+    with another player with an equal or nearly-equal win record, that is, a
+    player close to him or her in the standings, whom he or she has not
+    played yet (see pairing.pair_players()).  Players with equal wins are
+    ranked by their ratings, if given, and then by their tiebreakers (see
+    playerStandings()).  If there is an odd number of players, the lowest
+    ranked player who has not had a bye yet gets one.
+
+    Args:
+      tournament_id: the tournament to pair the players of.
+      ratings: optional mapping of player ids to ratings, like a
+               rating.Ratings, used to rank players with equal wins.  It
+               must give a rating for every player in the tournament.
 
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
         name1: the first player's name
-        id2: the second player's unique id
-        name2: the second player's name
-    """
-    swisspairs = []
-    results = playerStandings()
-
-    # Results of playerStandings are sorted by number of victories
-    # so pairing up two consecutive players will produce correct Swiss pairs
-    nr_pairs = len(results) / 2
-    for i in range(nr_pairs):
-        off = i*2
-        apair = (results[off][0], results[off][1],
-                 results[off+1][0], results[off+1][1])
-        swisspairs.append(apair)
+        id2: the second player's unique id, or None for a bye
+        name2: the second player's name, or None for a bye
+      A bye, if any, is the last entry; report it with reportMatch(id1, None).
+    """
+    results = playerStandings(tournament_id, tiebreakers=True)
+    if ratings is not None:
+        # Stable, so players with equal ratings keep their tiebreaker order
+        results.sort(key=lambda row: (-row[2], -ratings[row[0]]))
+    (opponents, had_bye) = previousOpponents(tournament_id)
+
+    # Results of playerStandings are sorted by number of victories, so
+    # pairing players in that order produces Swiss pairs
+    names = dict((row[0], row[1]) for row in results)
+    (pairs, bye) = pairing.pair_players([row[0] for row in results],
+                                        opponents, had_bye)
+    swisspairs = [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+    if bye is not None:
+        swisspairs.append((bye, names[bye], None, None))
     return swisspairs
+
+
+def _export_rows(pgcurs, query, params, out, format):
+    """Writes the rows of a query to the file `out`, as they are read.
+
+    CSV is written by the server with COPY; JSON Lines (one object per row,
+    keyed by column name, built by the server with row_to_json) are read
+    through a server-side cursor EXPORT_FETCH_SIZE rows at a time.  Either
+    way only a bounded number of rows is held in memory.
+    """
+    query = query.strip().rstrip(';')
+    if format == 'csv':
+        pgcurs.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)"
+                           % pgcurs.mogrify(query, params), out)
+        return
+    named = pgcurs.connection.cursor('export')
+    try:
+        named.execute("SELECT row_to_json(r)::text FROM (%s) AS r" % query,
+                      params)
+        while True:
+            rows = named.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            out.writelines(row[0] + "\n" for row in rows)
+    finally:
+        named.close()
+
+
+def _check_format(format):
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % format)
+
+
+def _matches_table(pgcurs, tournament_id):
+    """Returns the table holding a tournament's matches: Matches, or the
+    standalone table an archived tournament's matches were detached to."""
+    pgcurs.execute("SELECT archived FROM Tournaments WHERE tournament_id = %s;",
+                   (tournament_id,))
+    row = pgcurs.fetchone()
+    if row and row[0]:
+        return "Matches_%d" % int(tournament_id)
+    return "Matches"
+
+
+@instrument.tracked
+def exportStandings(out, tournament_id=DEFAULT_TOURNAMENT, format='csv',
+                    tiebreakers=False):
+    """Writes a tournament's standings to a file, streaming them from the
+    database.
+
+    Args:
+      out: a file open for writing.
+      tournament_id: the tournament to export the standings of.
+      format: 'csv' (with a header row) or 'jsonl' (JSON Lines).
+      tiebreakers: also export omw and sos, as playerStandings() does.
+    """
+    _check_format(format)
+    query = STANDINGS_QUERY
+    with db_cursor(False) as pgcurs:
+        if tiebreakers:
+            pgcurs.execute(TIEBREAKER_SETTINGS)
+            query = TIEBREAKER_STANDINGS_SELECT
+        _export_rows(pgcurs, query, {'tournament_id': tournament_id}, out,
+                     format)
+
+
+@instrument.tracked
+def exportMatches(out, tournament_id=DEFAULT_TOURNAMENT, format='csv'):
+    """Writes a tournament's match history to a file, in the order the
+    matches were reported, streaming it from the database.
+
+    Args:
+      out: a file open for writing.
+      tournament_id: the tournament to export the matches of; archived
+                     tournaments are exported too.
+      format: 'csv' (with a header row) or 'jsonl' (JSON Lines).
+    """
+    _check_format(format)
+    with db_cursor(False) as pgcurs:
+        query = """
+                SELECT match_id, winner_player_id, loser_player_id
+                FROM %s
+                WHERE tournament_id = %%(tournament_id)s
+                ORDER BY match_id
+                """ % _matches_table(pgcurs, tournament_id)
+        _export_rows(pgcurs, query, {'tournament_id': tournament_id}, out,
+                     format)
+
+
+@instrument.tracked
+def exportPairings(out, tournament_id=DEFAULT_TOURNAMENT, format='csv',
+                   ratings=None):
+    """Writes the pairings for a tournament's next round to a file.
+
+    The pairings are computed by swissPairings(), which holds the standings
+    in memory, and written one pair per row (id1, name1, id2, name2).
+
+    Args:
+      out: a file open for writing.
+      tournament_id: the tournament to pair the players of.
+      format: 'csv' (with a header row) or 'jsonl' (JSON Lines).
+      ratings: passed on to swissPairings().
+    """
+    _check_format(format)
+    columns = ('id1', 'name1', 'id2', 'name2')
+    pairs = swissPairings(tournament_id, ratings=ratings)
+    if format == 'csv':
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(pairs)
+        return
+    for pair in pairs:
+        out.write(json.dumps(collections.OrderedDict(zip(columns, pair))) +
+                  "\n")
+
+
+@instrument.tracked
+def snapshotDatabase(directory):
+    """Saves every tournament, player and match to CSV files.
+
+    The tables are read in one consistent snapshot with COPY, so memory use
+    does not depend on their size.  The matches of archived tournaments are
+    saved too.  restoreDatabase() loads the files back.
+
+    Args:
+      directory: an existing directory to write the files (see
+                 SNAPSHOT_TABLES and MATCHES_FILE) to.
+    """
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, "
+                       "READ ONLY;")
+        pgcurs.execute("SELECT tournament_id FROM Tournaments;")
+        tables = list(SNAPSHOT_TABLES)
+        # Read each tournament's partition, or its detached table if it
+        # has been archived
+        tables.extend(("Matches_%d" % tournament_id,
+                       MATCHES_FILE % tournament_id, MATCHES_COLUMNS)
+                      for (tournament_id,) in pgcurs.fetchall())
+        for (table, filename, columns) in tables:
+            with open(os.path.join(directory, filename), 'w') as out:
+                pgcurs.copy_expert(
+                    "COPY %s (%s) TO STDOUT WITH (FORMAT csv, HEADER)"
+                    % (table, ", ".join(columns)), out)
+
+
+@instrument.tracked
+def restoreDatabase(directory):
+    """Replaces every tournament, player and match with those saved by
+    snapshotDatabase().
+
+    Everything is loaded with COPY in one transaction.  Each tournament's
+    matches are copied into a new table which is then attached as its
+    Matches partition, so the foreign keys are checked and the indexes
+    built once per table rather than once per match.  PlayerStats are then
+    rebuilt, archived tournaments detached again and the id sequences moved
+    past the restored ids.
+
+    Args:
+      directory: the directory holding the snapshot files.
+
+    Returns:
+      A dictionary of the number of rows restored per table (Tournaments,
+      Players and Matches).
+    """
+    counts = {}
+    with db_cursor() as pgcurs:
+        pgcurs.execute("SELECT drop_tournament(tournament_id) "
+                       "FROM Tournaments;")
+        for (table, filename, columns) in SNAPSHOT_TABLES:
+            with open(os.path.join(directory, filename)) as source:
+                pgcurs.copy_expert(
+                    "COPY %s (%s) FROM STDIN WITH (FORMAT csv, HEADER)"
+                    % (table, ", ".join(columns)), source)
+            counts[table] = pgcurs.rowcount
+        counts['Matches'] = 0
+        pgcurs.execute("SELECT tournament_id FROM Tournaments;")
+        for (tournament_id,) in pgcurs.fetchall():
+            table = "Matches_%d" % tournament_id
+            pgcurs.execute("CREATE TABLE %s (LIKE Matches INCLUDING DEFAULTS "
+                           "INCLUDING CONSTRAINTS);" % table)
+            with open(os.path.join(directory,
+                                   MATCHES_FILE % tournament_id)) as source:
+                pgcurs.copy_expert(
+                    "COPY %s (%s) FROM STDIN WITH (FORMAT csv, HEADER)"
+                    % (table, ", ".join(MATCHES_COLUMNS)), source)
+            counts['Matches'] += pgcurs.rowcount
+            pgcurs.execute("ALTER TABLE Matches ATTACH PARTITION %s "
+                           "FOR VALUES IN (%d);" % (table, tournament_id))
+        _rebuild_stats(pgcurs, "TRUE", ())
+        for (table, column) in (('Tournaments', 'tournament_id'),
+                                ('Players', 'player_id'),
+                                ('Matches', 'match_id')):
+            pgcurs.execute("""
+                SELECT setval(pg_get_serial_sequence(%%s, %%s),
+                              COALESCE(MAX(%s), 0) + 1, false)
+                FROM %s;
+                """ % (column, table), (table.lower(), column))
+        pgcurs.execute("SELECT tournament_id FROM Tournaments WHERE archived;")
+        for (tournament_id,) in pgcurs.fetchall():
+            pgcurs.execute("ALTER TABLE Matches DETACH PARTITION Matches_%d;"
+                           % tournament_id)
+        pgcurs.execute("ANALYZE Players, Matches, PlayerStats;")
+    return counts
@@ -12,13 +12,186 @@ CREATE DATABASE tournament;
 
 \c tournament;
 
+-- Every player, match and stat belongs to one tournament.  An archived
+-- tournament keeps its players and standings, but its matches have been
+-- detached from the Matches table (see archive_tournament()).
+CREATE TABLE Tournaments (
+    tournament_id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    archived BOOLEAN NOT NULL DEFAULT FALSE
+    );
+
 CREATE TABLE Players (
     player_id SERIAL PRIMARY KEY,
-    name VARCHAR(50)
+    tournament_id INTEGER NOT NULL
+                  REFERENCES Tournaments(tournament_id) ON DELETE CASCADE,
+    name VARCHAR(50),
+    UNIQUE (tournament_id, player_id)
     );
 
+-- Matches are partitioned by tournament, with one partition (named
+-- Matches_<tournament_id>) per tournament.  Per-event queries only touch
+-- that event's partition, and clearing, archiving or dropping an event's
+-- matches is a TRUNCATE, DETACH or DROP of its partition.  The foreign keys
+-- include the tournament so players can only play in their own tournament.
 CREATE TABLE Matches (
-    match_id SERIAL PRIMARY KEY,
-    winner_player_id INTEGER REFERENCES Players(player_id),
-    loser_player_id INTEGER REFERENCES Players(player_id)
+    tournament_id INTEGER NOT NULL,
+    match_id SERIAL,
+    winner_player_id INTEGER,
+    loser_player_id INTEGER,
+    PRIMARY KEY (tournament_id, match_id),
+    FOREIGN KEY (tournament_id, winner_player_id)
+        REFERENCES Players(tournament_id, player_id),
+    FOREIGN KEY (tournament_id, loser_player_id)
+        REFERENCES Players(tournament_id, player_id)
+    ) PARTITION BY LIST (tournament_id);
+
+-- Per-player match lookups (getNumberOfMatches() and the foreign key checks
+-- when players are deleted) search on either side of a match.  Created on
+-- every partition.
+CREATE INDEX Matches_winner ON Matches (winner_player_id);
+CREATE INDEX Matches_loser ON Matches (loser_player_id);
+
+-- Creates a tournament and its Matches partition.  Returns its id.
+CREATE FUNCTION create_tournament(tournament_name TEXT) RETURNS INTEGER AS $$
+DECLARE
+    new_id INTEGER;
+BEGIN
+    INSERT INTO Tournaments (name) VALUES (tournament_name)
+        RETURNING tournament_id INTO new_id;
+    EXECUTE format('CREATE TABLE Matches_%s PARTITION OF Matches '
+                   'FOR VALUES IN (%s)', new_id, new_id);
+    RETURN new_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Closes a tournament: its partition is detached from Matches and kept as
+-- a standalone table, while its players and standings stay in place.
+CREATE FUNCTION archive_tournament(archive_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    UPDATE Tournaments SET archived = TRUE
+        WHERE tournament_id = archive_id AND NOT archived;
+    IF FOUND THEN
+        EXECUTE format('ALTER TABLE Matches DETACH PARTITION Matches_%s',
+                       archive_id);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Deletes a tournament with all of its players and matches.
+CREATE FUNCTION drop_tournament(drop_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('DROP TABLE IF EXISTS Matches_%s', drop_id);
+    DELETE FROM Tournaments WHERE tournament_id = drop_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Win/loss record of every player, maintained incrementally by the
+-- triggers below as players and matches are added or removed, so reading
+-- standings never has to aggregate the whole Matches table.
+-- points: one per win; kept separate from wins so other results can score.
+CREATE TABLE PlayerStats (
+    player_id INTEGER PRIMARY KEY
+              REFERENCES Players(player_id) ON DELETE CASCADE,
+    tournament_id INTEGER NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    matches INTEGER NOT NULL DEFAULT 0,
+    points INTEGER NOT NULL DEFAULT 0
     );
+
+CREATE INDEX PlayerStats_standings ON PlayerStats (tournament_id, wins DESC);
+
+-- Win/loss record of every player recomputed from Matches.  Wins and
+-- matches are aggregated in a single pass: every match contributes a row
+-- for its winner (won=1) and a row for its loser (won=0).  Used to rebuild
+-- and verify PlayerStats.
+CREATE VIEW MatchTotals AS
+    SELECT  tournament_id,
+            player_id,
+            COALESCE(wins, 0) AS wins,
+            COALESCE(matches - wins, 0) AS losses,
+            COALESCE(matches, 0) AS matches
+    FROM Players LEFT JOIN
+        (SELECT tournament_id, player_id,
+                SUM(won) AS wins, COUNT(*) AS matches
+         FROM (SELECT tournament_id, winner_player_id AS player_id, 1 AS won
+               FROM Matches
+               UNION ALL
+               SELECT tournament_id, loser_player_id AS player_id, 0 AS won
+               FROM Matches)
+               AS results
+         GROUP BY tournament_id, player_id)
+        AS records
+    USING (tournament_id, player_id);
+
+-- One row per registered player with their win record.  The tournament is
+-- taken from PlayerStats alone and names are joined on the primary key, so
+-- the join stays cheap even when a new tournament has no statistics yet.
+CREATE VIEW Standings AS
+    SELECT  PlayerStats.tournament_id,
+            player_id,
+            name,
+            wins,
+            matches
+    FROM PlayerStats JOIN Players USING (player_id);
+
+CREATE FUNCTION stats_add_players() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO PlayerStats (player_id, tournament_id)
+        SELECT player_id, tournament_id FROM new_players;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Applies the matches inserted into (or deleted from) Matches by one
+-- statement to PlayerStats.  Both triggers name their transition table
+-- changed_matches; rows are locked in player_id order before they are
+-- updated so concurrent reports cannot deadlock.
+CREATE FUNCTION stats_apply_matches() RETURNS TRIGGER AS $$
+DECLARE
+    sign INTEGER := CASE TG_OP WHEN 'INSERT' THEN 1 ELSE -1 END;
+BEGIN
+    PERFORM 1 FROM PlayerStats
+        WHERE player_id IN (SELECT winner_player_id FROM changed_matches
+                            UNION
+                            SELECT loser_player_id FROM changed_matches)
+        ORDER BY player_id
+        FOR UPDATE;
+    UPDATE PlayerStats
+        SET wins = PlayerStats.wins + sign * totals.wins,
+            losses = PlayerStats.losses + sign * totals.losses,
+            matches = PlayerStats.matches + sign * totals.matches,
+            points = PlayerStats.points + sign * totals.wins
+        FROM (SELECT player_id,
+                     SUM(won) AS wins,
+                     SUM(1 - won) AS losses,
+                     COUNT(*) AS matches
+              FROM (SELECT winner_player_id AS player_id, 1 AS won
+                    FROM changed_matches
+                    UNION ALL
+                    SELECT loser_player_id AS player_id, 0 AS won
+                    FROM changed_matches)
+                    AS results
+              GROUP BY player_id)
+             AS totals
+        WHERE PlayerStats.player_id = totals.player_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER Players_stats AFTER INSERT ON Players
+    REFERENCING NEW TABLE AS new_players
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_add_players();
+
+CREATE TRIGGER Matches_stats_insert AFTER INSERT ON Matches
+    REFERENCING NEW TABLE AS changed_matches
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_apply_matches();
+
+CREATE TRIGGER Matches_stats_delete AFTER DELETE ON Matches
+    REFERENCING OLD TABLE AS changed_matches
+    FOR EACH STATEMENT EXECUTE PROCEDURE stats_apply_matches();
+
+-- tournament.py uses this tournament (DEFAULT_TOURNAMENT) when no
+-- tournament id is given.
+SELECT create_tournament('Default');
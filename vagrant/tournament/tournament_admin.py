@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# tournament_admin.py -- maintenance commands for the tournament database
+#
+# Usage:
+#   python tournament_admin.py verify-stats [--tournament ID]
+#   python tournament_admin.py rebuild-stats [--tournament ID]
+#   python tournament_admin.py list-tournaments
+#   python tournament_admin.py create-tournament NAME
+#   python tournament_admin.py archive-tournament ID
+#   python tournament_admin.py drop-tournament ID
+#   python tournament_admin.py export standings|matches|pairings
+#                              [--tournament ID] [--format csv|jsonl]
+#                              [--tiebreakers] [--output FILE]
+#   python tournament_admin.py snapshot DIRECTORY
+#   python tournament_admin.py restore DIRECTORY
+#
+
+import argparse
+import os
+import sys
+
+import tournament
+
+
+def verify_stats(args):
+    """Reports players whose PlayerStats differ from a recount of Matches."""
+    drift = tournament.verifyPlayerStats(args.tournament)
+    for (player_id, stored, expected) in drift:
+        print "player %s: stored %s, expected %s" % (player_id, stored,
+                                                     expected)
+    if drift:
+        print "%d player(s) have drifted stats." % len(drift)
+        return 1
+    print "Player stats match the Matches table."
+    return 0
+
+
+def rebuild_stats(args):
+    """Recomputes PlayerStats from the Matches table."""
+    count = tournament.rebuildPlayerStats(args.tournament)
+    print "Rebuilt stats for %d player(s)." % count
+    return 0
+
+
+def list_tournaments(args):
+    """Lists every tournament."""
+    for (tournament_id, name, archived) in tournament.listTournaments():
+        print "%d\t%s%s" % (tournament_id, name,
+                             " (archived)" if archived else "")
+    return 0
+
+
+def create_tournament(args):
+    """Creates a tournament and prints its id."""
+    print tournament.createTournament(args.name)
+    return 0
+
+
+def archive_tournament(args):
+    """Closes a tournament, detaching its matches but keeping standings."""
+    tournament.archiveTournament(args.id)
+    return 0
+
+
+def drop_tournament(args):
+    """Deletes a tournament with all its players and matches."""
+    tournament.dropTournament(args.id)
+    return 0
+
+
+def export(args):
+    """Writes standings, match history or the next pairings as CSV or JSON
+    Lines."""
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, 'w')
+    try:
+        if args.what == 'standings':
+            tournament.exportStandings(out, args.tournament, args.format,
+                                       tiebreakers=args.tiebreakers)
+        elif args.what == 'matches':
+            tournament.exportMatches(out, args.tournament, args.format)
+        else:
+            tournament.exportPairings(out, args.tournament, args.format)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def snapshot(args):
+    """Saves every tournament, player and match to CSV files."""
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    tournament.snapshotDatabase(args.directory)
+    print "Snapshot saved to %s." % args.directory
+    return 0
+
+
+def restore(args):
+    """Replaces the whole database with a snapshot."""
+    counts = tournament.restoreDatabase(args.directory)
+    print "Restored %d tournament(s), %d player(s) and %d match(es)." % (
+        counts['Tournaments'], counts['Players'], counts['Matches'])
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Maintenance commands for the tournament database.")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser(
+        'verify-stats', help=verify_stats.__doc__)
+    command.add_argument(
+        '--tournament', type=int,
+        help="tournament id (default: every tournament not archived)")
+    command.set_defaults(func=verify_stats)
+
+    command = commands.add_parser(
+        'rebuild-stats', help=rebuild_stats.__doc__)
+    command.add_argument(
+        '--tournament', type=int,
+        help="tournament id (default: every tournament not archived)")
+    command.set_defaults(func=rebuild_stats)
+
+    command = commands.add_parser(
+        'list-tournaments', help=list_tournaments.__doc__)
+    command.set_defaults(func=list_tournaments)
+
+    command = commands.add_parser(
+        'create-tournament', help=create_tournament.__doc__)
+    command.add_argument('name')
+    command.set_defaults(func=create_tournament)
+
+    command = commands.add_parser(
+        'archive-tournament', help=archive_tournament.__doc__)
+    command.add_argument('id', type=int)
+    command.set_defaults(func=archive_tournament)
+
+    command = commands.add_parser(
+        'drop-tournament', help=drop_tournament.__doc__)
+    command.add_argument('id', type=int)
+    command.set_defaults(func=drop_tournament)
+
+    command = commands.add_parser('export', help=export.__doc__)
+    command.add_argument('what', choices=('standings', 'matches', 'pairings'))
+    command.add_argument('--tournament', type=int,
+                         default=tournament.DEFAULT_TOURNAMENT,
+                         help="tournament id (default: %(default)s)")
+    command.add_argument('--format', choices=tournament.EXPORT_FORMATS,
+                         default='csv')
+    command.add_argument('--tiebreakers', action='store_true',
+                         help="add omw and sos columns to standings")
+    command.add_argument('--output', help="file to write (default: stdout)")
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('snapshot', help=snapshot.__doc__)
+    command.add_argument('directory')
+    command.set_defaults(func=snapshot)
+
+    command = commands.add_parser('restore', help=restore.__doc__)
+    command.add_argument('directory')
+    command.set_defaults(func=restore)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+#
+# tournament_async.py -- asyncio counterpart of tournament.py
+#
+# Requires Python 3.7 or later and asyncpg.  Every function here is a
+# coroutine that behaves like the tournament.py function of the same name
+# and returns the same tuple shapes, but uses a pool of asyncpg connections
+# instead of blocking the event loop:
+#
+#   import tournament_async as tournament
+#   await tournament.reportMatch(winner, loser, tournament_id)
+#   pairs = await tournament.swissPairings(tournament_id)
+#
+
+import asyncio
+
+import asyncpg
+
+import pairing
+import queries
+
+
+# Connection string for the tournament database (libpq environment
+# variables such as PGHOST and PGUSER apply)
+DSN = "postgresql:///tournament"
+
+# Default settings for the connection pool, see configurePool()
+POOL_CONFIG = {
+    'min_size': 1,
+    'max_size': 10,
+    'max_inactive_connection_lifetime': 300,
+    'timeout': 30,
+}
+
+# Tournament used by every function when no tournament id is given; it is
+# created by tournament.sql
+DEFAULT_TOURNAMENT = 1
+
+
+def _numbered(query, *names):
+    """Turns the named parameters of a queries.py statement into asyncpg's
+    numbered ones, $1 for the first name and so on."""
+    for (number, name) in enumerate(names, 1):
+        query = query.replace("%%(%s)s" % name, "$%d" % number)
+    if "%(" in query:
+        raise ValueError("Unnumbered parameter in query: %s" % query)
+    return query
+
+
+# The queries of tournament.py (see queries.py).  asyncpg cannot send
+# several statements with parameters, so nested loops are turned off for
+# the tiebreaker standings separately (TIEBREAKER_SETTINGS), in the same
+# transaction.
+MATCH_COUNT_QUERY = _numbered(queries.MATCH_COUNT_QUERY,
+                              'tournament_id', 'player_id')
+STANDINGS_QUERY = _numbered(queries.STANDINGS_QUERY, 'tournament_id')
+TIEBREAKER_SETTINGS = queries.TIEBREAKER_SETTINGS
+TIEBREAKER_STANDINGS_QUERY = _numbered(queries.TIEBREAKER_STANDINGS_SELECT,
+                                       'tournament_id')
+OPPONENTS_QUERY = _numbered(queries.OPPONENTS_QUERY, 'tournament_id')
+
+# Task creating the connection pool; awaiting the task lets every
+# coroutine that needs the pool wait for the same one
+_pool_task = None
+
+
+async def configurePool(**settings):
+    """(Re)creates the connection pool used by all the functions here.
+
+    Args:
+      settings: any of the POOL_CONFIG keys - min_size, max_size,
+                max_inactive_connection_lifetime (seconds an idle
+                connection is kept) and timeout (seconds to wait when
+                opening a connection).
+    """
+    global _pool_task
+    for key in settings:
+        if key not in POOL_CONFIG:
+            raise TypeError("Unknown pool setting: %s" % key)
+    POOL_CONFIG.update(settings)
+    old_task = _pool_task
+    _pool_task = asyncio.ensure_future(
+        asyncpg.create_pool(DSN, **POOL_CONFIG))
+    if old_task is not None:
+        await (await old_task).close()
+    await _pool_task
+
+
+async def getPool():
+    """Returns the connection pool, creating it on first use.
+
+    The pool belongs to the event loop it was created in.
+    """
+    global _pool_task
+    if _pool_task is None:
+        _pool_task = asyncio.ensure_future(
+            asyncpg.create_pool(DSN, **POOL_CONFIG))
+    return await asyncio.shield(_pool_task)
+
+
+async def closePool():
+    """Closes the connection pool and all its connections."""
+    global _pool_task
+    if _pool_task is not None:
+        (task, _pool_task) = (_pool_task, None)
+        await (await task).close()
+
+
+async def deleteMatches(tournament_id=DEFAULT_TOURNAMENT):
+    """Remove all the match records of a tournament from the database."""
+    # See tournament.deleteMatches()
+    sql = "TRUNCATE Matches_%d;" % int(tournament_id)
+    pool = await getPool()
+    async with pool.acquire() as pgconn:
+        async with pgconn.transaction():
+            await pgconn.execute(sql)
+            await pgconn.execute("""
+                UPDATE PlayerStats SET wins = 0, losses = 0, matches = 0,
+                                       points = 0
+                WHERE tournament_id = $1;
+                """, tournament_id)
+
+
+async def deletePlayers(tournament_id=DEFAULT_TOURNAMENT):
+    """Remove all the player records of a tournament from the database."""
+    pool = await getPool()
+    await pool.execute("DELETE FROM Players WHERE tournament_id = $1;",
+                       tournament_id)
+
+
+async def countPlayers(tournament_id=DEFAULT_TOURNAMENT):
+    """Returns the number of players currently registered."""
+    pool = await getPool()
+    return await pool.fetchval(
+        "SELECT COUNT(*) FROM Players WHERE tournament_id = $1;",
+        tournament_id)
+
+
+async def registerPlayer(name, tournament_id=DEFAULT_TOURNAMENT):
+    """Adds a player to the tournament database.
+
+    Args:
+      name: the player's full name (need not be unique).
+      tournament_id: the tournament the player registers for.
+    """
+    pool = await getPool()
+    await pool.execute(
+        "INSERT INTO Players (tournament_id, name) VALUES ($1, $2);",
+        tournament_id, name)
+
+
+async def registerPlayers(names, tournament_id=DEFAULT_TOURNAMENT):
+    """Adds many players to the tournament database in one statement.
+
+    Returns:
+      A list of the assigned player ids, in the same order as `names`.
+    """
+    query = """
+            INSERT INTO Players (tournament_id, name)
+            SELECT $1, name FROM unnest($2::text[]) WITH ORDINALITY
+                                 AS new (name, position)
+            ORDER BY position
+            RETURNING player_id;
+            """
+    pool = await getPool()
+    rows = await pool.fetch(query, tournament_id, list(names))
+    return [row[0] for row in rows]
+
+
+async def getNumberOfMatches(playerid, tournament_id=DEFAULT_TOURNAMENT):
+    """Returns the number of matches played by a player."""
+    pool = await getPool()
+    return await pool.fetchval(MATCH_COUNT_QUERY, tournament_id, playerid)
+
+
+async def playerStandings(tournament_id=DEFAULT_TOURNAMENT,
+                          tiebreakers=False):
+    """Returns a list of the players and their win records, sorted by wins.
+
+    See tournament.playerStandings() for the tuples returned.
+    """
+    pool = await getPool()
+    async with pool.acquire() as pgconn:
+        return await _standings(pgconn, tournament_id, tiebreakers)
+
+
+async def reportMatch(winner, loser, tournament_id=DEFAULT_TOURNAMENT):
+    """Records the outcome of a single match between two players.
+
+    Args:
+      winner:  the id number of the player who won
+      loser:  the id number of the player who lost, or None to record a bye
+              (a free win) for the winner
+      tournament_id: the tournament both players are registered for
+    """
+    query = """
+            INSERT INTO Matches
+                (tournament_id, winner_player_id, loser_player_id)
+            VALUES ($1, $2, $3);
+            """
+    pool = await getPool()
+    await pool.execute(query, tournament_id, winner, loser)
+
+
+async def reportMatches(results, tournament_id=DEFAULT_TOURNAMENT):
+    """Records the outcomes of many matches in one transaction.
+
+    Args:
+      results: an iterable of (winner, loser) player id pairs.
+      tournament_id: the tournament all the players are registered for.
+    """
+    query = """
+            INSERT INTO Matches
+                (tournament_id, winner_player_id, loser_player_id)
+            SELECT $1, winner, loser
+            FROM unnest($2::integer[], $3::integer[]) AS new (winner, loser);
+            """
+    results = list(results)
+    pool = await getPool()
+    await pool.execute(query, tournament_id,
+                       [winner for (winner, loser) in results],
+                       [loser for (winner, loser) in results])
+
+
+async def swissPairings(tournament_id=DEFAULT_TOURNAMENT, ratings=None):
+    """Returns a list of pairs of players for the next round of a match.
+
+    The standings and previous opponents are read on one connection, in one
+    snapshot, and paired with pairing.pair_players() like
+    tournament.swissPairings(), which describes the arguments and result.
+    """
+    pool = await getPool()
+    async with pool.acquire() as pgconn:
+        async with pgconn.transaction(isolation='repeatable_read',
+                                      readonly=True):
+            results = await _standings(pgconn, tournament_id, True)
+            matches = await pgconn.fetch(OPPONENTS_QUERY, tournament_id)
+    if ratings is not None:
+        # Stable, so players with equal ratings keep their tiebreaker order
+        results.sort(key=lambda row: (-row[2], -ratings[row[0]]))
+    (opponents, had_bye) = pairing.opponents_from_matches(matches)
+
+    names = dict((row[0], row[1]) for row in results)
+    (pairs, bye) = pairing.pair_players([row[0] for row in results],
+                                        opponents, had_bye)
+    swisspairs = [(id1, names[id1], id2, names[id2]) for (id1, id2) in pairs]
+    if bye is not None:
+        swisspairs.append((bye, names[bye], None, None))
+    return swisspairs
+
+
+async def _standings(pgconn, tournament_id, tiebreakers):
+    """Reads the standings on a connection, as a list of tuples."""
+    if not tiebreakers:
+        rows = await pgconn.fetch(STANDINGS_QUERY, tournament_id)
+    elif pgconn.is_in_transaction():
+        await pgconn.execute(TIEBREAKER_SETTINGS)
+        rows = await pgconn.fetch(TIEBREAKER_STANDINGS_QUERY, tournament_id)
+    else:
+        async with pgconn.transaction(readonly=True):
+            await pgconn.execute(TIEBREAKER_SETTINGS)
+            rows = await pgconn.fetch(TIEBREAKER_STANDINGS_QUERY,
+                                      tournament_id)
+    return [tuple(row) for row in rows]
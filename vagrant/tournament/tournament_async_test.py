@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+#
+# Test cases for tournament_async.py
+# Like tournament_test.py, these tests use the default tournament of the
+# local tournament database and delete its players and matches.
+#
+
+import asyncio
+
+import tournament_async as tournament
+
+
+async def testRegisterAndCount():
+    """
+    Test that players are registered and counted.
+    """
+    await tournament.deleteMatches()
+    await tournament.deletePlayers()
+    if await tournament.countPlayers() != 0:
+        raise ValueError("After deletion, countPlayers should return zero.")
+    await tournament.registerPlayer("Chandra Nalaar")
+    ids = await tournament.registerPlayers(["Markov Chaney", "Joe Malik"])
+    if await tournament.countPlayers() != 3 or len(ids) != 2:
+        raise ValueError("countPlayers should count every registration.")
+    print("1. Players are registered and counted.")
+
+
+async def testStandingsShape():
+    """
+    Test that standings have the same shape as tournament.playerStandings().
+    """
+    await tournament.deleteMatches()
+    await tournament.deletePlayers()
+    [id1, id2] = await tournament.registerPlayers(["Melpomene Murray",
+                                                   "Randy Schwartz"])
+    await tournament.reportMatch(id1, id2)
+    standings = await tournament.playerStandings()
+    if standings != [(id1, "Melpomene Murray", 1, 1),
+                     (id2, "Randy Schwartz", 0, 1)]:
+        raise ValueError("Standings should be (id, name, wins, matches) "
+                         "tuples. Got {s}".format(s=standings))
+    standings = await tournament.playerStandings(tiebreakers=True)
+    if [row[4:] for row in standings] != [(0, 0.0), (1, 1.0)]:
+        raise ValueError("Tiebreakers should be (omw, sos). "
+                         "Got {s}".format(s=standings))
+    print("2. Standings are tuples like tournament.playerStandings().")
+
+
+async def testConcurrentReports():
+    """
+    Test that many results can be reported and paired at once.
+    """
+    await tournament.deleteMatches()
+    await tournament.deletePlayers()
+    ids = await tournament.registerPlayers(
+        "Concurrent Player %d" % i for i in range(40))
+    await asyncio.gather(*[tournament.reportMatch(ids[i], ids[i + 1])
+                           for i in range(0, 40, 2)])
+    standings = await tournament.playerStandings()
+    if sum(row[2] for row in standings) != 20:
+        raise ValueError("Every concurrent report should be recorded.")
+    print("3. Concurrent reports are all recorded.")
+    rounds = await asyncio.gather(*[tournament.swissPairings()
+                                    for i in range(10)])
+    if any(pairs != rounds[0] for pairs in rounds):
+        raise ValueError("Concurrent pairings should agree.")
+    pairs = rounds[0]
+    if len(pairs) != 20 or any(len(pair) != 4 for pair in pairs):
+        raise ValueError("Pairings should be (id1, name1, id2, name2) "
+                         "tuples.")
+    winners = set(row[0] for row in standings if row[2])
+    for (id1, name1, id2, name2) in pairs:
+        if (id1 in winners) != (id2 in winners):
+            raise ValueError("Winners should be paired with winners.")
+    print("4. Concurrent pairings agree and pair players with equal wins.")
+    await tournament.deleteMatches()
+    if sum(row[3] for row in await tournament.playerStandings()):
+        raise ValueError("deleteMatches should reset the standings.")
+    print("5. deleteMatches() resets the standings.")
+
+
+async def main():
+    try:
+        await testRegisterAndCount()
+        await testStandingsShape()
+        await testConcurrentReports()
+    finally:
+        await tournament.closePool()
+    print("Success!  All tests pass!")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
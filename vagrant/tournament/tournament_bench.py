@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# tournament_bench.py -- benchmarks the tournament module at scale
+#
+# Usage:
+#   python tournament_bench.py [--players 10000] [--matches 50000]
+#                              [--tournament ID]
+#                              [--output results.json]
+#                              [--baseline previous.json]
+#
+# Seeds a new tournament in the local tournament database with random
+# players and matches (or uses an existing tournament, such as one written
+# by simulate.py --replay), then times each public function of tournament.py
+# and reports latency percentiles, throughput, connections opened and
+# queries issued per function.  Results are written as JSON; given a
+# baseline from an earlier run, functions whose median latency got worse
+# than the tolerance are reported and the exit status is 1.
+#
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import psycopg2.extensions
+
+import tournament
+
+
+class QueryCounter(object):
+    """Counts the statements executed through CountingCursor."""
+    count = 0
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        QueryCounter.count += 1
+        return super(CountingCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        QueryCounter.count += 1
+        return super(CountingCursor, self).executemany(query, vars_list)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return super(CountingConnection, self).cursor(*args, **kwargs)
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value below which `fraction` of sorted_values fall."""
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def seed(tournament_id, players, matches, rng):
+    """Registers `players` players and reports `matches` random matches.
+
+    Returns:
+      The registered player ids.
+    """
+    ids = tournament.registerPlayers(
+        ("Bench Player %d" % i for i in xrange(players)), tournament_id)
+    tournament.reportMatches(
+        (tuple(rng.sample(ids, 2)) for i in xrange(matches)), tournament_id)
+    return ids
+
+
+def benchmark(name, func, iterations):
+    """Calls func() `iterations` times and measures each call.
+
+    Returns:
+      A dictionary of the measurements.
+    """
+    opened = tournament.poolStats()['connections_opened']
+    queries = QueryCounter.count
+    timings = []
+    start = time.time()
+    for i in xrange(iterations):
+        call_start = time.time()
+        func()
+        timings.append(time.time() - call_start)
+    elapsed = time.time() - start
+    queries = QueryCounter.count - queries
+    timings.sort()
+    return {
+        'calls': iterations,
+        'mean_ms': 1000.0 * sum(timings) / iterations,
+        'p50_ms': 1000.0 * percentile(timings, 0.50),
+        'p99_ms': 1000.0 * percentile(timings, 0.99),
+        'max_ms': 1000.0 * timings[-1],
+        'throughput_per_s': iterations / elapsed if elapsed else None,
+        'connections_opened':
+            tournament.poolStats()['connections_opened'] - opened,
+        'queries': queries,
+        'queries_per_call': float(queries) / iterations,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns (name, ratio) for each function whose median latency grew by
+    more than `tolerance` times compared to the baseline."""
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        before = baseline.get(name)
+        if not before or not before['p50_ms']:
+            continue
+        ratio = result['p50_ms'] / before['p50_ms']
+        if ratio > tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the tournament module.")
+    parser.add_argument('--players', type=int, default=10000,
+                        help="players to seed (default: %(default)s)")
+    parser.add_argument('--matches', type=int, default=50000,
+                        help="matches to seed (default: %(default)s)")
+    parser.add_argument('--iterations', type=int, default=200,
+                        help="calls per single-row function")
+    parser.add_argument('--table-iterations', type=int, default=20,
+                        help="calls per whole-tournament function "
+                             "(playerStandings, swissPairings)")
+    parser.add_argument('--tournament', type=int,
+                        help="benchmark this existing tournament instead of "
+                             "seeding a new one; it is kept afterwards, "
+                             "with the players and matches added here")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline',
+                        help="JSON results of an earlier run to compare to")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help="allowed median latency ratio to the baseline")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the benchmark tournament afterwards")
+    args = parser.parse_args(argv)
+
+    tournament.CONNECTION_FACTORY = CountingConnection
+    tournament.configurePool()
+    rng = random.Random(args.seed)
+
+    if args.tournament is not None:
+        tournament_id = args.tournament
+        args.keep = True
+    else:
+        tournament_id = tournament.createTournament("Benchmark")
+    try:
+        start = time.time()
+        if args.tournament is not None:
+            ids = [row[0] for row in tournament.playerStandings(tournament_id)]
+            args.players = len(ids)
+            args.matches = None
+        else:
+            ids = seed(tournament_id, args.players, args.matches, rng)
+        seed_seconds = time.time() - start
+
+        functions = [
+            ('registerPlayer', args.iterations,
+             lambda: tournament.registerPlayer("Bench Player", tournament_id)),
+            ('reportMatch', args.iterations,
+             lambda: tournament.reportMatch(*rng.sample(ids, 2),
+                                            tournament_id=tournament_id)),
+            ('countPlayers', args.iterations,
+             lambda: tournament.countPlayers(tournament_id)),
+            ('getNumberOfMatches', args.iterations,
+             lambda: tournament.getNumberOfMatches(rng.choice(ids),
+                                                   tournament_id)),
+            ('playerStandings', args.table_iterations,
+             lambda: tournament.playerStandings(tournament_id)),
+            ('playerStandings+tb', args.table_iterations,
+             lambda: tournament.playerStandings(tournament_id,
+                                                tiebreakers=True)),
+            ('swissPairings', args.table_iterations,
+             lambda: tournament.swissPairings(tournament_id)),
+        ]
+        results = {}
+        print "%-20s %8s %10s %10s %10s %8s %8s" % (
+            "function", "calls", "p50 (ms)", "p99 (ms)", "ops/s",
+            "conns", "q/call")
+        for (name, iterations, func) in functions:
+            result = benchmark(name, func, iterations)
+            results[name] = result
+            print "%-20s %8d %10.2f %10.2f %10.1f %8d %8.1f" % (
+                name, result['calls'], result['p50_ms'], result['p99_ms'],
+                result['throughput_per_s'], result['connections_opened'],
+                result['queries_per_call'])
+    finally:
+        if not args.keep:
+            tournament.dropTournament(tournament_id)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'players': args.players,
+            'matches': args.matches,
+            'seed': args.seed,
+            'seed_seconds': seed_seconds,
+            'tournament': args.tournament,
+            'pool': dict(tournament.POOL_CONFIG),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for (name, ratio) in regressions:
+            print "REGRESSION: %s median latency is %.2fx the baseline" % (
+                name, ratio)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,21 @@
 # If you do add any of the extra credit options, be sure to add/modify these test cases
 # as appropriate to account for your module's added functionality.
 
+import csv
+import json
+import logging
+import random
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
 from tournament import *
+import dbpool
+import engine
+import instrument
+import rating
+import simulate
 
 def testCount():
     """
@@ -323,6 +337,642 @@ def testPairings_8players_3rounds():
     print "18. All players paired correctly for round #3 (after round#2)"
 
 
+def testBulkRegistrationAndReports():
+    """
+    Test that players and matches can be registered/reported in bulk from
+    generators, and that standings reflect them.
+    """
+    deleteMatches()
+    deletePlayers()
+    names = ("Bulk Player %d" % i for i in range(2500))
+    ids = registerPlayers(names, batch_size=1000)
+    if len(ids) != 2500 or len(set(ids)) != 2500:
+        raise ValueError(
+            "registerPlayers should return one unique id per player. Got {n}".format(n=len(ids)))
+    c = countPlayers()
+    if c != 2500:
+        raise ValueError(
+            "After bulk registration, countPlayers() should be 2500. Got {c}".format(c=c))
+    print "19. registerPlayers() registers every player and returns their ids."
+    reportMatches((ids[i], ids[i+1]) for i in range(0, len(ids), 2))
+    standings = playerStandings()
+    winners = set(ids[0::2])
+    for (i, n, w, m) in standings:
+        if m != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if (i in winners) != (w == 1):
+            raise ValueError("Bulk reported match winners should have one win recorded.")
+    print "20. reportMatches() records every match."
+
+
+def testPlayerStats():
+    """
+    Test that the maintained player stats match a recount of the matches,
+    and that drifted stats are detected and rebuilt.
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Player %d" % i for i in range(6)])
+    reportMatches([(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], ids[5])])
+    reportMatch(ids[0], ids[2])
+    if verifyPlayerStats():
+        raise ValueError("Player stats should match the reported matches.")
+    with db_cursor() as pgcurs:
+        pgcurs.execute("UPDATE PlayerStats SET wins = wins + 1 "
+                       "WHERE player_id = %s;", (ids[1],))
+    drift = verifyPlayerStats()
+    if [row[0] for row in drift] != [ids[1]]:
+        raise ValueError("verifyPlayerStats() should report drifted stats.")
+    print "21. verifyPlayerStats() detects drifted player stats."
+    rebuildPlayerStats()
+    if verifyPlayerStats():
+        raise ValueError("rebuildPlayerStats() should repair drifted stats.")
+    deleteMatches()
+    for (i, n, w, m) in playerStandings():
+        if w != 0 or m != 0:
+            raise ValueError("After deleting matches, player stats should be reset.")
+    print "22. rebuildPlayerStats() repairs drifted player stats."
+
+
+def seqScannedTables(plan):
+    """
+    Returns the names of the tables read by sequential scans in an
+    EXPLAIN (FORMAT JSON) plan node and its children.
+    """
+    tables = set()
+    if plan['Node Type'] == 'Seq Scan':
+        tables.add(plan['Relation Name'].lower())
+    for child in plan.get('Plans', []):
+        tables |= seqScannedTables(child)
+    return tables
+
+
+def scannedIndexes(plan):
+    """
+    Returns the names of the indexes read in an EXPLAIN (FORMAT JSON) plan
+    node and its children.
+    """
+    indexes = set()
+    if 'Index Name' in plan:
+        indexes.add(plan['Index Name'].lower())
+    for child in plan.get('Plans', []):
+        indexes |= scannedIndexes(child)
+    return indexes
+
+
+def scannedMatches(tables):
+    """
+    Returns True if Matches, or any of its partitions, is among tables.
+    """
+    return any(table == 'matches' or table.startswith('matches_')
+               for table in tables)
+
+
+def explainAnalyze(query, params=None):
+    """
+    Runs EXPLAIN ANALYZE on a query and returns the root plan node.
+    """
+    with db_cursor(False) as pgcurs:
+        pgcurs.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, params)
+        plan = pgcurs.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def testQueryPlans():
+    """
+    Test that the standings and match count queries use indexes rather than
+    sequential scans on a large dataset.
+    """
+    deleteMatches()
+    deletePlayers()
+    rng = random.Random(2)
+    ids = registerPlayers("Seeded Player %d" % i for i in range(20000))
+    reportMatches(tuple(rng.sample(ids, 2)) for i in range(100000))
+    # A small tournament next to the large one, whose standings should be
+    # read through the indexes rather than by scanning every player
+    small = createTournament("Small Event")
+    small_ids = registerPlayers(["Small Player %d" % i for i in range(20)],
+                                small)
+    reportMatches(zip(small_ids[::2], small_ids[1::2]), small)
+    with db_cursor() as pgcurs:
+        pgcurs.execute("ANALYZE Players; ANALYZE Matches; ANALYZE PlayerStats;")
+    plan = explainAnalyze(STANDINGS_QUERY, {'tournament_id': small})
+    scanned = seqScannedTables(plan)
+    if scanned & set(['playerstats', 'players']) or \
+            'playerstats_standings' not in scannedIndexes(plan):
+        raise ValueError("The standings query should read PlayerStats through "
+                         "PlayerStats_standings. Scanned {s}".format(s=scanned))
+    dropTournament(small)
+    print "23. The standings query reads PlayerStats through its index."
+    scanned = seqScannedTables(
+        explainAnalyze(MATCH_COUNT_QUERY, {'tournament_id': DEFAULT_TOURNAMENT,
+                                           'player_id': ids[0]}))
+    if scannedMatches(scanned):
+        raise ValueError("The match count query should use the Matches indexes.")
+    print "24. The match count query uses the Matches indexes."
+    deleteMatches()
+    deletePlayers()
+
+
+def testTournaments():
+    """
+    Test that players, matches and standings are kept separate per
+    tournament, and that tournaments can be archived and dropped.
+    """
+    deleteMatches()
+    deletePlayers()
+    other = createTournament("Other Event")
+    [id1, id2] = registerPlayers(["Ada Default", "Bob Default"])
+    [id3, id4, id5] = registerPlayers(["Cy Other", "Di Other", "Ed Other"],
+                                      other)
+    reportMatch(id1, id2)
+    reportMatch(id3, id4, other)
+    reportMatch(id5, id3, other)
+    if countPlayers() != 2 or countPlayers(other) != 3:
+        raise ValueError("Players should only be counted in their own tournament.")
+    if set(row[0] for row in playerStandings(other)) != set([id3, id4, id5]):
+        raise ValueError("Standings should only list the tournament's players.")
+    try:
+        reportMatch(id1, id3)
+    except psycopg2.IntegrityError:
+        pass
+    else:
+        raise ValueError("Players of different tournaments should not be matched.")
+    print "25. Players, matches and standings are kept per tournament."
+    deleteMatches(other)
+    for (i, n, w, m) in playerStandings(other):
+        if w != 0 or m != 0:
+            raise ValueError("Deleting a tournament's matches should reset its standings.")
+    if [row[2:] for row in playerStandings() if row[0] == id1] != [(1, 1)]:
+        raise ValueError("Deleting a tournament's matches should not affect others.")
+    print "26. Matches are deleted per tournament."
+    reportMatch(id4, id5, other)
+    archiveTournament(other)
+    if [row[2:] for row in playerStandings(other) if row[0] == id4] != [(1, 1)]:
+        raise ValueError("An archived tournament should keep its standings.")
+    try:
+        reportMatch(id5, id4, other)
+    except psycopg2.Error:
+        pass
+    else:
+        raise ValueError("Matches should not be reported for an archived tournament.")
+    dropTournament(other)
+    if countPlayers(other) != 0 or other in [row[0] for row in listTournaments()]:
+        raise ValueError("A dropped tournament should be removed with its players.")
+    print "27. Tournaments are archived and dropped."
+    deleteMatches()
+    deletePlayers()
+
+
+def testPairingsAvoidRematches():
+    """
+    Test that pairings avoid rematches, even when adjacent players in the
+    standings have already played each other.
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4] = registerPlayers(["Wade", "Xena", "Yuri", "Zoe"])
+    reportMatch(id1, id2)
+    reportMatch(id3, id4)
+    reportMatch(id1, id3)
+    reportMatch(id2, id4)
+    # Standings are id1 (2 wins), id2 and id3 (1 win), id4; every pairing of
+    # adjacent players except id1-id4 / id2-id3 is a rematch
+    pairings = swissPairings()
+    pairs = set(frozenset([pair[0], pair[2]]) for pair in pairings)
+    if pairs != set([frozenset([id1, id4]), frozenset([id2, id3])]):
+        raise ValueError("swissPairings should avoid rematches. Got {p}".format(p=pairings))
+    print "28. swissPairings() avoids rematches."
+
+
+def testPairingsOddPlayers():
+    """
+    Test that with an odd number of players, one player gets a bye, and
+    that nobody gets a second bye.
+    """
+    deleteMatches()
+    deletePlayers()
+    ids = registerPlayers(["Odd %d" % i for i in range(5)])
+    byes = set()
+    for round_no in range(5):
+        pairings = swissPairings()
+        if len(pairings) != 3 or pairings[-1][2] is not None:
+            raise ValueError("Five players should get two pairs and a bye.")
+        paired = [pair[0] for pair in pairings] + [pair[2] for pair in pairings[:-1]]
+        if sorted(paired) != sorted(ids):
+            raise ValueError("Each player should appear once in the pairings.")
+        bye = pairings[-1][0]
+        if bye in byes:
+            raise ValueError("No player should get a second bye.")
+        byes.add(bye)
+        for (id1, name1, id2, name2) in pairings:
+            reportMatch(id1, id2)
+    for (i, n, w, m) in playerStandings():
+        if m != 5:
+            raise ValueError("Byes should count as matches played.")
+    if verifyPlayerStats():
+        raise ValueError("Byes should be counted in player stats.")
+    print "29. With an odd number of players, each player gets at most one bye."
+
+
+def testEngine():
+    """
+    Test that the in-memory engine serves the same standings as the
+    database, and writes its changes to the database when flushed.
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2] = registerPlayers(["Disk One", "Disk Two"])
+    reportMatch(id1, id2)
+    memory = engine.TournamentEngine(durability=engine.BATCHED,
+                                     flush_interval=3600)
+    ids = [memory.registerPlayer("Memory %d" % i) for i in range(4)]
+    if memory.countPlayers() != 6 or countPlayers() != 2:
+        raise ValueError("Batched registrations should only be written on flush.")
+    for pair in memory.swissPairings():
+        memory.reportMatch(pair[0], pair[2])
+    standings = memory.playerStandings()
+    if sorted(row[3] for row in standings) != [1, 1, 1, 1, 2, 2]:
+        raise ValueError("The engine should keep match counts in memory.")
+    print "30. The engine serves standings and pairings from memory."
+    memory.flush()
+    if sorted(playerStandings()) != sorted(standings):
+        raise ValueError("After a flush, the database should match the engine.")
+    if verifyPlayerStats():
+        raise ValueError("Flushed results should be counted in player stats.")
+    synced = engine.TournamentEngine(durability=engine.SYNC)
+    synced.reportMatch(ids[0], ids[1])
+    if getNumberOfMatches(ids[0]) != 2:
+        raise ValueError("Synchronous results should be written immediately.")
+    print "31. The engine writes registrations and results to the database."
+    synced_id = synced.registerPlayer("Synced")
+    [next_id] = registerPlayers(["After Synced"])
+    if next_id != synced_id + 1:
+        raise ValueError("A synchronous engine should reserve one player id "
+                         "at a time. Got {a} then {b}"
+                         .format(a=synced_id, b=next_id))
+    print "49. A synchronous engine reserves one player id at a time."
+
+
+class ListHandler(logging.Handler):
+    """
+    Logging handler that keeps the records it receives.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def testInstrumentation():
+    """
+    Test that instrumentation counts the queries of each function and logs
+    slow queries, and records nothing when disabled.
+    """
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Traced %d" % i for i in range(4)])
+    handler = ListHandler()
+    instrument.slow_query_log.addHandler(handler)
+    instrument.reset()
+    instrument.enable(slow_query_seconds=0)
+    try:
+        swissPairings()
+        countPlayers()
+        exportStandings(StringIO())
+    finally:
+        instrument.disable()
+        instrument.slow_query_log.removeHandler(handler)
+    countPlayers()
+    metrics = instrument.snapshot()
+    if metrics['tournament_calls_total'].get('countPlayers') != 1:
+        raise ValueError("Calls made while instrumentation is disabled should not be counted.")
+    queries = metrics['tournament_queries_total']
+    if (queries.get('swissPairings'), queries.get('playerStandings')) != (2, 1):
+        raise ValueError("Queries should be counted for every function running them. "
+                         "Got {q}".format(q=queries))
+    if metrics['tournament_rows_total'].get('playerStandings') != 4:
+        raise ValueError("Rows returned should be counted.")
+    if queries.get('exportStandings') != 1:
+        raise ValueError("COPY statements should be counted.")
+    if len(handler.records) != 4:
+        raise ValueError("Every statement over the threshold should be logged.")
+    if 'tournament_query_seconds_count{function="countPlayers"} 1' \
+            not in instrument.render_prometheus():
+        raise ValueError("Query timings should be exported as histograms.")
+    print "32. Instrumentation counts, times and logs the queries of each function."
+
+
+def testTiebreakers():
+    """
+    Test that standings with tiebreakers rank players with equal wins by
+    the wins of their opponents, in the database and in the engine.
+    """
+    deleteMatches()
+    deletePlayers()
+    [p4, p3, p2, p1, p5] = registerPlayers(
+        ["Fourth", "Third", "Second", "First", "Bye"])
+    reportMatches([(p1, p2), (p3, p4), (p5, None), (p1, p3), (p4, p2)])
+    standings = playerStandings(tiebreakers=True)
+    if [len(row) for row in standings] != [6] * 5:
+        raise ValueError("Each standings row should have 6 columns with tiebreakers.")
+    expected = [(p1, 1, 0.25), (p3, 3, 0.75), (p4, 1, 0.25), (p5, 0, 0.0),
+                (p2, 3, 0.75)]
+    got = [(row[0], row[4], row[5]) for row in standings]
+    if ([(i, omw) for (i, omw, sos) in got] !=
+            [(i, omw) for (i, omw, sos) in expected] or
+            any(abs(a[2] - b[2]) > 1e-9 for (a, b) in zip(got, expected))):
+        raise ValueError("Ties in wins should be broken by opponent match wins. "
+                         "Got {g}".format(g=got))
+    if sorted(row[:4] for row in standings) != sorted(playerStandings()):
+        raise ValueError("Tiebreakers should not change the other columns.")
+    print "33. playerStandings() breaks ties with opponent match wins."
+    memory = engine.TournamentEngine()
+    if [row[:5] for row in memory.playerStandings(tiebreakers=True)] != \
+            [row[:5] for row in standings]:
+        raise ValueError("The engine should compute the same tiebreakers.")
+    print "34. The engine breaks ties in the same way."
+
+
+def testRatings():
+    """
+    Test that ratings match Elo ratings computed one match at a time, are
+    updated with new results, and rank players with equal wins for pairing.
+    """
+    deleteMatches()
+    deletePlayers()
+    rng = random.Random(7)
+    ids = registerPlayers("Rated Player %d" % i for i in range(12))
+    results = [tuple(rng.sample(ids, 2)) for i in range(60)]
+    reportMatches(results)
+    expected = dict((i, rating.INITIAL_RATING) for i in ids)
+    for (winner, loser) in results:
+        change = rating.K_FACTOR * (1 - 1 / (1 + 10 ** (
+            (expected[loser] - expected[winner]) / 400.0)))
+        expected[winner] += change
+        expected[loser] -= change
+    ratings = rating.Ratings()
+    if any(abs(ratings[i] - expected[i]) > 1e-6 for i in ids):
+        raise ValueError("Ratings should equal Elo ratings computed one "
+                         "match at a time.")
+    unknown = max(ids) + 1000
+    if ratings.get(unknown) is not None or ratings.get(unknown, 0) != 0 or \
+            ratings[unknown] != rating.INITIAL_RATING:
+        raise ValueError("Players without ratings should get the default, "
+                         "or the initial rating when indexed.")
+    print "35. Ratings equal Elo ratings computed one match at a time."
+    reportMatch(ids[0], ids[1])
+    before = (ratings[ids[0]], ratings[ids[1]])
+    if ratings.refresh() != 1:
+        raise ValueError("refresh() should apply only the new result.")
+    if not (ratings[ids[0]] > before[0] and ratings[ids[1]] < before[1]):
+        raise ValueError("A new result should move the players' ratings.")
+    if any(abs(ratings[i] - rating.Ratings()[i]) > 1e-6 for i in ids):
+        raise ValueError("Refreshed ratings should equal reloaded ratings.")
+    print "36. Ratings are updated with new results."
+    late = connect()
+    try:
+        with late.cursor() as pgcurs:
+            pgcurs.execute("INSERT INTO Matches"
+                           " (tournament_id, winner_player_id,"
+                           "  loser_player_id)"
+                           " VALUES (%s, %s, %s);",
+                           (DEFAULT_TOURNAMENT, ids[2], ids[3]))
+        # A result with a higher id, committed first
+        reportMatch(ids[4], ids[5])
+        first = ratings.refresh()
+        before = ratings[ids[2]]
+        late.commit()
+    finally:
+        late.close()
+    if first != 1 or ratings.refresh() != 1 or \
+            not ratings[ids[2]] > before or ratings.refresh() != 0:
+        raise ValueError("A result committed after one with a higher id "
+                         "should be applied once.")
+    print "48. A result committed out of id order is applied by refresh()."
+    deleteMatches()
+    deletePlayers()
+    [low, high, other] = registerPlayers(["Low", "High", "Other"])
+    ratings = {low: 1400.0, high: 1600.0, other: 1500.0}
+    pairs = swissPairings(ratings=ratings)
+    if [(id1, id2) for (id1, name1, id2, name2) in pairs] != \
+            [(high, other), (low, None)]:
+        raise ValueError("Players with equal wins should be paired by "
+                         "rating. Got {p}".format(p=pairs))
+    print "37. swissPairings() ranks players with equal wins by rating."
+    deletePlayers()
+    [w1, l1, w2, l2] = registerPlayers(["W1", "L1", "W2", "L2"])
+    reportMatches([(w1, l1), (w2, l2)])
+    ratings = rating.Ratings()
+    [n1, n2] = registerPlayers(["New 1", "New 2"])
+    pairs = [set([id1, id2]) for (id1, name1, id2, name2)
+             in swissPairings(ratings=ratings)]
+    if pairs != [set([w1, w2]), set([n1, n2]), set([l1, l2])]:
+        raise ValueError("Players registered after the ratings were loaded "
+                         "should have the initial rating. Got {p}"
+                         .format(p=pairs))
+    print "38. Players registered after the ratings are loaded are ranked " \
+          "with the initial rating."
+
+
+def testExportAndRestore():
+    """
+    Test that standings and matches are exported as CSV and JSON Lines, and
+    that a snapshot restores the same tournaments, standings and matches.
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3] = registerPlayers(["Ann, the First", "Bob", "Cy"])
+    reportMatches([(id1, id2), (id3, None)])
+    out = StringIO()
+    exportStandings(out)
+    rows = list(csv.reader(StringIO(out.getvalue())))
+    if rows[0] != ['player_id', 'name', 'wins', 'matches'] or \
+            sorted(tuple(row) for row in rows[1:]) != sorted(
+                tuple(str(value) for value in row)
+                for row in playerStandings()):
+        raise ValueError("CSV standings should match playerStandings(). "
+                         "Got {r}".format(r=rows))
+    out = StringIO()
+    exportMatches(out, format='jsonl')
+    matches = [json.loads(line) for line in out.getvalue().splitlines()]
+    if [(m['winner_player_id'], m['loser_player_id']) for m in matches] != \
+            [(id1, id2), (id3, None)]:
+        raise ValueError("JSON Lines matches should list every match in "
+                         "order. Got {m}".format(m=matches))
+    print "39. Standings and matches are exported as CSV and JSON Lines."
+    directory = tempfile.mkdtemp()
+    try:
+        snapshotDatabase(directory)
+        (tournaments, standings) = (listTournaments(), playerStandings())
+        deleteMatches()
+        deletePlayers()
+        counts = restoreDatabase(directory)
+        if counts['Matches'] < 2 or listTournaments() != tournaments or \
+                sorted(playerStandings()) != sorted(standings):
+            raise ValueError("A restored snapshot should have the same "
+                             "tournaments and standings.")
+        if verifyPlayerStats(DEFAULT_TOURNAMENT):
+            raise ValueError("Restored stats should match the matches.")
+        [new_id] = registerPlayers(["After Restore"])
+        if new_id <= max(id1, id2, id3):
+            raise ValueError("Ids should continue after the restored ones.")
+    finally:
+        shutil.rmtree(directory)
+    print "40. A snapshot restores the same tournaments and standings."
+
+
+def testSimulateReplay():
+    """
+    Test that a simulated run replays into the database with the same
+    results.
+    """
+    history = simulate.simulate(7, 3, 3, 200.0,
+                                simulate.numpy.random.RandomState(5))
+    tournament_id = simulate.replay(history, 1)
+    try:
+        standings = playerStandings(tournament_id)
+        if sorted(row[2] for row in standings) != \
+                sorted(history['wins'][1, -1].tolist()):
+            raise ValueError("Replayed standings should have the simulated "
+                             "wins.")
+        if any(row[3] != 3 for row in standings):
+            raise ValueError("Every replayed player should have played each "
+                             "round, byes included.")
+    finally:
+        dropTournament(tournament_id)
+    print "41. A simulated run replays into a new tournament."
+
+
+def testEngineWriteFailures():
+    """
+    Test that changes the engine cannot write are not kept in memory, and
+    that a failed batch does not block later ones.
+    """
+    deleteMatches()
+    deletePlayers()
+    [id1, id2] = registerPlayers(["Kept One", "Kept Two"])
+    synced = engine.TournamentEngine(durability=engine.SYNC)
+    try:
+        # Names are limited to 50 characters in the database
+        synced.registerPlayer("x" * 60)
+    except psycopg2.DataError:
+        pass
+    else:
+        raise ValueError("A registration that cannot be written should raise.")
+    if synced.countPlayers() != 2:
+        raise ValueError("A registration that was not written should not be "
+                         "kept in memory.")
+    memory = engine.TournamentEngine(durability=engine.BATCHED,
+                                     flush_interval=3600)
+    bad = memory.registerPlayer("y" * 60)
+    memory.reportMatch(bad, id1)
+    try:
+        memory.flush()
+    except engine.FlushError as error:
+        if [p[0] for p in error.players] != [bad] or \
+                error.results != [(bad, id1)]:
+            raise ValueError("FlushError should list the dropped changes.")
+    else:
+        raise ValueError("A batch that cannot be written should raise.")
+    if memory.countPlayers() != 2 or \
+            sorted(memory.playerStandings()) != sorted(playerStandings()):
+        raise ValueError("After a failed flush the engine should match the "
+                         "database.")
+    memory.reportMatch(id1, id2)
+    memory.flush()
+    if getNumberOfMatches(id1) != 1:
+        raise ValueError("A batch after a failed one should be written.")
+    print "42. Changes the engine cannot write are dropped and reported."
+
+
+def testConnectionPool():
+    """
+    Test that the pool opens minconn connections up front, reuses the most
+    recently returned connection, times out, replaces broken connections and
+    closes connections left idle for too long.
+    """
+    pool = dbpool.ConnectionPool(connect, minconn=2, maxconn=2,
+                                 checkout_timeout=0.05)
+    try:
+        if pool.stats()['connections_opened'] != 2 or pool.stats()['idle'] != 2:
+            raise ValueError("The pool should open minconn connections up front.")
+        first = pool.getconn()
+        second = pool.getconn()
+        try:
+            pool.getconn()
+        except dbpool.PoolError:
+            pass
+        else:
+            raise ValueError("A full pool should time out.")
+        if pool.stats()['checkout_timeouts'] != 1:
+            raise ValueError("Timeouts should be counted.")
+        print "43. The pool opens minconn connections and times out when full."
+        pool.putconn(first)
+        pool.putconn(second)
+        if pool.getconn() is not second:
+            raise ValueError("The most recently returned connection should be "
+                             "reused first.")
+        pool.putconn(second)
+    finally:
+        pool.closeall()
+    print "44. The most recently returned connection is reused first."
+    pool = dbpool.ConnectionPool(connect, minconn=1, maxconn=3, ping_after=0)
+    try:
+        pgconn = pool.getconn()
+        backend = pgconn.get_backend_pid()
+        pool.putconn(pgconn)
+        with db_cursor() as pgcurs:
+            pgcurs.execute("SELECT pg_terminate_backend(%s);", (backend,))
+        time.sleep(0.1)
+        pgconn = pool.getconn()
+        with pgconn.cursor() as pgcurs:
+            pgcurs.execute("SELECT 1;")
+        if pool.stats()['health_check_failures'] != 1 or \
+                pgconn.get_backend_pid() == backend:
+            raise ValueError("A broken connection should be replaced.")
+        pool.putconn(pgconn)
+        print "45. Broken idle connections are found and replaced."
+        pool.idle_timeout = 0.05
+        conns = [pool.getconn() for i in range(3)]
+        for pgconn in conns:
+            pool.putconn(pgconn)
+        time.sleep(0.1)
+        closed = pool.stats()['connections_closed']
+        pool.getconn()
+        stats = pool.stats()
+        if stats['connections_closed'] != closed + 2 or stats['size'] != 1:
+            raise ValueError("Connections idle for too long should be closed "
+                             "on checkout, down to minconn. Got {s}"
+                             .format(s=stats))
+    finally:
+        pool.closeall()
+    print "46. Connections idle for too long are closed down to minconn."
+    saved_config = dict(POOL_CONFIG)
+    configurePool(minconn=1, maxconn=1)
+    try:
+        with db_cursor() as pgcurs:
+            old_pool = getPool()
+            configurePool(minconn=1, maxconn=1)
+            pgcurs.execute("SELECT 1;")
+        if old_pool.stats()['size'] != 0:
+            raise ValueError("A connection should be closed by the pool it "
+                             "came from once that pool is replaced.")
+        stats = poolStats()
+        if stats['size'] != 1 or stats['in_use'] != 0:
+            raise ValueError("A connection from a replaced pool should not be "
+                             "returned to the new one. Got {s}"
+                             .format(s=stats))
+    finally:
+        configurePool(**saved_config)
+    print "47. Connections go back to the pool they came from."
+
+
+
 if __name__ == '__main__':
     testCount()
     testStandingsBeforeMatches()
@@ -330,4 +980,18 @@ if __name__ == '__main__':
     testReportMatches_8players()
     testPairings()
     testPairings_8players_3rounds()
+    testBulkRegistrationAndReports()
+    testPlayerStats()
+    testQueryPlans()
+    testTournaments()
+    testPairingsAvoidRematches()
+    testPairingsOddPlayers()
+    testEngine()
+    testInstrumentation()
+    testTiebreakers()
+    testRatings()
+    testExportAndRestore()
+    testSimulateReplay()
+    testEngineWriteFailures()
+    testConnectionPool()
     print "Success!  All tests pass!"